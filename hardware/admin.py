@@ -1,5 +1,5 @@
 from django.contrib import admin
-from hardware.models import Product, Category, cartOrder,cartOrderItem, Wishlist, Order, ProductImage,Product_Review,OrderItem,ProductView,SearchHistory
+from hardware.models import Product, Category, cartOrder,cartOrderItem, Wishlist, Order, ProductImage,Product_Review,OrderItem,ProductView,SearchHistory,SimilarProduct
 # Register your models here.
 
 class ProductImageAdmin(admin.TabularInline):
@@ -44,6 +44,9 @@ class ProductViewAdmin(admin.ModelAdmin):
 class SearchHistoryAdmin(admin.ModelAdmin):
   list_display = ['user', 'product', 'timestamp', 'query']
 
+class SimilarProductAdmin(admin.ModelAdmin):
+    list_display = ['product', 'rank', 'neighbor', 'score']
+
 
     
 admin.site.register(Product, productAdmin)
@@ -55,4 +58,5 @@ admin.site.register(Wishlist,WishlistAdmin)
 admin.site.register(Order,OrderAdmin)
 admin.site.register(OrderItem,OrderItemAdmin)
 admin.site.register(ProductView, ProductViewAdmin)
-admin.site.register(SearchHistory, SearchHistoryAdmin)
\ No newline at end of file
+admin.site.register(SearchHistory, SearchHistoryAdmin)
+admin.site.register(SimilarProduct, SimilarProductAdmin)
\ No newline at end of file
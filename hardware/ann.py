@@ -0,0 +1,273 @@
+"""
+Nearest-neighbour engines for the TF-IDF recommender.
+
+Each engine offers the part of sklearn's NearestNeighbors API that the
+recommender uses: fit(matrix) and kneighbors(X, n_neighbors). kneighbors
+returns (distances, indices), with one array per query row sorted best
+first. Distances are cosine distances. Rows are L2-normalised TF-IDF, so
+the distance is 1 - dot product. Only neighbours with a positive
+similarity are returned, so a row can hold fewer than n_neighbors entries.
+
+    brute  exact scan of the whole catalog (one sparse product per batch)
+    lsh    random-hyperplane LSH candidates, re-ranked exactly
+
+Engines never copy the fitted matrix. An engine that builds tables of its
+own can save(directory) them next to a model artifact. load_index() then
+memory-maps them back, so worker processes share them instead of
+rebuilding them. After an incremental model patch, update_index() gives
+a new engine that only re-indexes the rows that changed.
+"""
+import os
+
+import numpy as np
+from django.conf import settings
+from scipy import sparse
+
+
+def _top_per_row(sims, n_neighbors):
+    """Split a (queries x candidates) CSR similarity matrix into per-row top-n lists."""
+    sims = sims.tocsr()
+    row_of = np.repeat(np.arange(sims.shape[0]), np.diff(sims.indptr))
+    cols, scores = sims.indices, sims.data
+    keep = scores > 0
+    row_of, cols, scores = row_of[keep], cols[keep], scores[keep]
+
+    # Sort by (row, score desc, col) and keep the first n of every row
+    order = np.lexsort((cols, -scores, row_of))
+    row_of, cols, scores = row_of[order], cols[order], scores[order]
+    rank = np.arange(len(row_of)) - np.searchsorted(row_of, row_of)
+    keep = rank < n_neighbors
+    row_of, cols, scores = row_of[keep], cols[keep], scores[keep]
+
+    splits = np.searchsorted(row_of, np.arange(1, sims.shape[0]))
+    return (
+        [1.0 - s for s in np.split(scores, splits)],
+        np.split(cols, splits),
+    )
+
+
+class BruteForceIndex:
+    """Exact cosine neighbours: every query is scored against the whole catalog."""
+
+    def __init__(self, batch_size=1024):
+        self.batch_size = batch_size
+        self._matrix = None
+
+    def get_params(self):
+        return {"batch_size": self.batch_size}
+
+    def fit(self, matrix):
+        self._matrix = sparse.csr_matrix(matrix, copy=False)
+        return self
+
+    def updated(self, matrix, changed=(), removed=None):
+        """Nothing is precomputed, so the patched matrix is used as it is."""
+        return BruteForceIndex(self.batch_size).fit(matrix)
+
+    def kneighbors(self, X, n_neighbors=5):
+        X = sparse.csr_matrix(X)
+        distances, indices = [], []
+        for start in range(0, X.shape[0], self.batch_size):
+            d, i = _top_per_row(X[start:start + self.batch_size] @ self._matrix.T, n_neighbors)
+            distances.extend(d)
+            indices.extend(i)
+        return distances, indices
+
+
+class LSHIndex:
+    """
+    Random-hyperplane LSH over the TF-IDF rows.
+
+    Each of `tables` hash tables keys a row by the signs of `bits` Gaussian
+    random projections, so rows with a small angle between them tend to
+    share a bucket. A query collects the rows in its bucket in every table.
+    With probes=1 it also collects the buckets one bit-flip away. The
+    `max_candidates` rows that collide most often are then re-ranked by
+    exact cosine. More tables or probes raise recall. More bits or fewer
+    candidates lower latency. bits=None sizes buckets to about
+    `bucket_size` rows for the fitted catalog.
+    """
+
+    def __init__(self, tables=8, bits=None, probes=1, max_candidates=2000,
+                 bucket_size=64, seed=42, batch_size=10000):
+        if bits is not None and not 1 <= bits <= 63:
+            raise ValueError("bits must be between 1 and 63")
+        self.tables = tables
+        self.bits = bits
+        self.bucket_size = bucket_size
+        self.probes = probes
+        self.max_candidates = max_candidates
+        self.seed = seed
+        self.batch_size = batch_size
+        self._matrix = None
+        self._planes = None
+        self._weights = None
+        self._sorted_codes = None  # (tables, n) bucket codes, sorted per table
+        self._order = None         # (tables, n) row ids in bucket order
+
+    def _codes(self, X):
+        """(rows x tables) bucket code of each row."""
+        codes = np.empty((X.shape[0], self.tables), dtype=np.uint64)
+        for start in range(0, X.shape[0], self.batch_size):
+            proj = (X[start:start + self.batch_size] @ self._planes) > 0
+            proj = proj.reshape(proj.shape[0], self.tables, self.bits).astype(np.uint64)
+            codes[start:start + proj.shape[0]] = proj @ self._weights
+        return codes
+
+    # Tables written by save(), prefixed so they cannot clash with artifact files
+    TABLE_FILES = ("lsh_planes.npy", "lsh_order.npy", "lsh_sorted_codes.npy")
+
+    def get_params(self):
+        return {
+            "tables": self.tables, "bits": self.bits, "probes": self.probes,
+            "max_candidates": self.max_candidates, "bucket_size": self.bucket_size,
+            "seed": self.seed, "batch_size": self.batch_size,
+        }
+
+    def fit(self, matrix):
+        self._matrix = sparse.csr_matrix(matrix, copy=False)
+        n_rows, n_features = self._matrix.shape
+        if self.bits is None:
+            self.bits = int(np.clip(np.log2(max(n_rows, 1) / self.bucket_size), 1, 24))
+        self._weights = 1 << np.arange(self.bits, dtype=np.uint64)
+        rng = np.random.default_rng(self.seed)
+        # Dense planes: TF-IDF rows only have a handful of terms, so sparse
+        # planes would leave most projections at exactly zero
+        self._planes = rng.standard_normal((n_features, self.tables * self.bits), dtype=np.float32)
+        codes = self._codes(self._matrix).T
+        self._order = np.argsort(codes, axis=1, kind="stable")
+        self._sorted_codes = np.take_along_axis(codes, self._order, axis=1)
+        return self
+
+    def updated(self, matrix, changed=(), removed=None):
+        """
+        A new index over the patched `matrix` that hashes only the `changed`
+        rows (replaced or appended, numbered as in `matrix`) and drops row
+        `removed` of the old matrix. The planes are shared; this index is
+        left untouched, since snapshots still serving may use it.
+        """
+        order, sorted_codes = self._order, self._sorted_codes
+        if removed is not None:
+            keep = order != removed
+            order = order[keep].reshape(self.tables, -1)
+            sorted_codes = sorted_codes[keep].reshape(self.tables, -1)
+            order = np.where(order > removed, order - 1, order)
+        changed = np.asarray(changed, dtype=np.int64)
+        if len(changed):
+            keep = ~np.isin(order, changed)
+            order = order[keep].reshape(self.tables, -1)
+            sorted_codes = sorted_codes[keep].reshape(self.tables, -1)
+            codes = self._codes(sparse.csr_matrix(matrix)[changed])
+            tables_order, tables_codes = [], []
+            for t in range(self.tables):
+                new = np.argsort(codes[:, t], kind="stable")
+                at = np.searchsorted(sorted_codes[t], codes[new, t], side="right")
+                tables_order.append(np.insert(order[t], at, changed[new]))
+                tables_codes.append(np.insert(sorted_codes[t], at, codes[new, t]))
+            order, sorted_codes = np.stack(tables_order), np.stack(tables_codes)
+
+        index = LSHIndex(**self.get_params())
+        index._matrix = sparse.csr_matrix(matrix, copy=False)
+        index._planes, index._weights = self._planes, self._weights
+        index._order, index._sorted_codes = order, sorted_codes
+        return index
+
+    def save(self, directory):
+        planes, order, sorted_codes = self.TABLE_FILES
+        np.save(os.path.join(directory, planes), self._planes)
+        np.save(os.path.join(directory, order), self._order)
+        np.save(os.path.join(directory, sorted_codes), self._sorted_codes)
+
+    def load(self, directory, matrix):
+        """Attach memory-mapped tables saved for this exact matrix instead of re-fitting."""
+        planes, order, sorted_codes = (
+            np.load(os.path.join(directory, name), mmap_mode="r") for name in self.TABLE_FILES
+        )
+        if planes.shape != (matrix.shape[1], self.tables * self.bits) or order.shape[1] != matrix.shape[0]:
+            raise ValueError("saved LSH tables do not match the feature matrix")
+        self._matrix = sparse.csr_matrix(matrix, copy=False)
+        self._weights = 1 << np.arange(self.bits, dtype=np.uint64)
+        self._planes, self._order, self._sorted_codes = planes, order, sorted_codes
+        return self
+
+    def _candidates(self, codes):
+        hits = []
+        flips = np.zeros(1, dtype=np.uint64)
+        if self.probes:
+            flips = np.concatenate([flips, self._weights])
+        for t, code in enumerate(codes):
+            probes = code ^ flips
+            lo = np.searchsorted(self._sorted_codes[t], probes, side="left")
+            hi = np.searchsorted(self._sorted_codes[t], probes, side="right")
+            hits.extend(self._order[t, a:b] for a, b in zip(lo, hi) if b > a)
+        if not hits:
+            return np.empty(0, dtype=np.int64)
+        rows, counts = np.unique(np.concatenate(hits), return_counts=True)
+        if len(rows) > self.max_candidates:
+            rows = rows[np.argpartition(-counts, self.max_candidates - 1)[:self.max_candidates]]
+        return rows
+
+    def kneighbors(self, X, n_neighbors=5):
+        X = sparse.csr_matrix(X)
+        distances, indices = [], []
+        for i, codes in enumerate(self._codes(X)):
+            candidates = self._candidates(codes)
+            sims = self._matrix[candidates] @ X[i].toarray().ravel()
+            keep = sims > 0
+            candidates, sims = candidates[keep], sims[keep]
+            if len(sims) > n_neighbors:
+                part = np.argpartition(-sims, n_neighbors - 1)[:n_neighbors]
+                candidates, sims = candidates[part], sims[part]
+            order = np.lexsort((candidates, -sims))
+            distances.append(1.0 - sims[order])
+            indices.append(candidates[order])
+        return distances, indices
+
+
+ENGINES = {
+    "brute": BruteForceIndex,
+    "lsh": LSHIndex,
+}
+
+
+def engine_name(index):
+    """Registry name of a fitted engine, e.g. "lsh"."""
+    for name, cls in ENGINES.items():
+        if type(index) is cls:
+            return name
+    return None
+
+
+def build_index(matrix, engine=None, **options):
+    """Fit the configured engine (settings.RECOMMENDER_ENGINE) on a feature matrix."""
+    engine = engine or getattr(settings, "RECOMMENDER_ENGINE", "brute")
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown recommender engine {engine!r}; choose from {sorted(ENGINES)}")
+    if not options:
+        options = getattr(settings, "RECOMMENDER_ENGINE_OPTIONS", {}).get(engine, {})
+    return ENGINES[engine](**options).fit(matrix)
+
+
+def update_index(index, matrix, changed=(), removed=None):
+    """
+    The engine for a patched feature matrix: rows `changed` (numbered as in
+    `matrix`) were replaced or appended, and row `removed` of the old matrix
+    was deleted. Engines without updated() are fitted again.
+    """
+    if hasattr(index, "updated"):
+        return index.updated(matrix, changed, removed)
+    return ENGINES[engine_name(index)](**index.get_params()).fit(matrix)
+
+
+def load_index(engine, directory, matrix, params):
+    """
+    Rebuild a saved engine around `matrix` from its tables in `directory`.
+    Engines without saved tables are just fitted (fitting brute is free).
+    """
+    index = ENGINES[engine](**params)
+    if hasattr(index, "load"):
+        try:
+            return index.load(directory, matrix)
+        except (OSError, ValueError) as e:
+            print(f"Could not load saved {engine} tables ({e}); re-fitting.")
+    return index.fit(matrix)
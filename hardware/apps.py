@@ -1,6 +1,18 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class CoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'hardware'
+
+    def ready(self):
+        # Attach the prebuilt recommender (see `manage.py build_recommender`) so
+        # requests never pay for training. Without an artifact the recommender
+        # is trained in a background thread on first use.
+        from . import recommender, signals  # noqa: F401  (registers receivers)
+        recommender.load_artifact()
+
+        # Table rebuilds in later migrations drop the search triggers; put them back
+        from . import search
+        post_migrate.connect(search.ensure_index, sender=self)
@@ -0,0 +1,299 @@
+"""
+Search-box suggestions from an in-process prefix index.
+
+Suggestions are product names, category names and popular search
+queries, each with a weight (product views, products in the category,
+times searched). The index is a sorted array of keys, one per word
+start of each suggestion, so "dri" finds "Cordless Drill". A lookup is
+one bisect plus a short scan. The best entries for every prefix of up
+to HEAD_LENGTH characters are precomputed, because those prefixes can
+cover much of the catalog.
+
+The index is immutable, like the recommender's snapshots: edits build
+a new one and swap the module reference, so lookups never lock. The
+full index is built from the database in a background thread, on first
+use and every AUTOCOMPLETE_REBUILD_SECONDS. Between builds, product and
+category writes are applied incrementally through signals, but only in
+the worker that made them. So every AUTOCOMPLETE_FOLLOW_SECONDS a lookup
+also compares the shared catalog version (versions.CATALOG) with the one
+the index was built at, and rebuilds it when another worker has written.
+Lookups never touch the database; until the first build lands they
+return [].
+"""
+import heapq
+import re
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.db.models import Count
+
+from hardware import metrics, versions
+from hardware.models import Category, Product, SearchHistory
+
+HEAD_LENGTH = 3  # prefixes up to this long have their best entries precomputed
+HEAD_SIZE = 20  # entries kept per precomputed prefix (and most a lookup returns)
+
+_index = None
+_lock = threading.Lock()
+_build_thread = None
+_dirty = None  # entry ids edited while a full build is running
+_next_follow = 0.0  # monotonic time of the next catalog version check
+
+
+def normalize(text):
+    """Lower-cased words separated by single spaces."""
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+
+def index_keys(text):
+    """Every word-start suffix of the normalized text: "cordless drill" -> both words."""
+    words = normalize(text).split()
+    return [" ".join(words[i:]) for i in range(len(words))]
+
+
+class Suggestion:
+    """One entry: display text, kind ("product", "category" or "query"), link and weight."""
+
+    __slots__ = ("text", "kind", "url", "weight")
+
+    def __init__(self, text, kind, url, weight):
+        self.text, self.kind, self.url, self.weight = text, kind, url, weight
+
+    def as_dict(self):
+        return {"text": self.text, "kind": self.kind, "url": self.url}
+
+
+def product_suggestion(product, weight=1):
+    return Suggestion(product.name, "product", f"/productdetail/{product.pid}/", weight)
+
+
+def category_suggestion(category, weight=1):
+    return Suggestion(category.name, "category", f"/search/?{urlencode({'category': category.name})}", weight)
+
+
+def query_suggestion(query, weight):
+    return Suggestion(query, "query", f"/search/?{urlencode({'query': query})}", weight)
+
+
+# ------------------------------
+# PREFIX INDEX
+# ------------------------------
+class PrefixIndex:
+    """
+    Immutable prefix index over {entry_id: Suggestion}. entry_id is
+    ("product", pid), ("category", id) or ("query", normalized text).
+    catalog_version is the versions.CATALOG value it was built from.
+    """
+
+    def __init__(self, entries, keys=None, ids=None, heads=None, built_at=None, catalog_version=None):
+        self.entries = entries
+        self.catalog_version = catalog_version
+        if keys is None:
+            pairs = sorted((key, entry_id) for entry_id, s in entries.items() for key in index_keys(s.text))
+            keys, ids = [key for key, _ in pairs], [entry_id for _, entry_id in pairs]
+        self.keys, self.ids = keys, ids
+        self.built_at = time.monotonic() if built_at is None else built_at
+        if heads is None:
+            heads = {}
+            for prefix in {key[:n] for key in keys for n in range(1, HEAD_LENGTH + 1)}:
+                heads[prefix] = self._best(prefix, HEAD_SIZE)
+        self.heads = heads
+
+    def _range(self, prefix):
+        return bisect_left(self.keys, prefix), bisect_left(self.keys, prefix + "\U0010ffff")
+
+    def _best(self, prefix, limit):
+        lo, hi = self._range(prefix)
+        candidates = set(self.ids[lo:hi])
+        return tuple(heapq.nsmallest(
+            limit, candidates, key=lambda e: (-self.entries[e].weight, self.entries[e].text.lower()),
+        ))
+
+    def lookup(self, prefix, limit):
+        """Best suggestions whose text has a word starting with `prefix`, one per distinct text."""
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        ranked = self.heads.get(prefix, ()) if len(prefix) <= HEAD_LENGTH else self._best(prefix, HEAD_SIZE)
+        seen, result = set(), []
+        for entry_id in ranked:
+            suggestion = self.entries[entry_id]
+            text = suggestion.text.lower()
+            if text not in seen:
+                seen.add(text)
+                result.append(suggestion)
+                if len(result) == limit:
+                    break
+        return result
+
+    def replaced(self, entry_id, suggestion):
+        """A copy with `entry_id` set to `suggestion` (None removes it). Only touched keys are moved."""
+        entries = dict(self.entries)
+        keys, ids = list(self.keys), list(self.ids)
+        touched = set()
+        old = entries.pop(entry_id, None)
+        if old is not None:
+            for key in index_keys(old.text):
+                i = bisect_left(keys, key)
+                j = bisect_right(keys, key)
+                i += ids[i:j].index(entry_id)
+                del keys[i], ids[i]
+                touched.add(key)
+        if suggestion is not None:
+            entries[entry_id] = suggestion
+            for key in index_keys(suggestion.text):
+                i = bisect_right(keys, key)
+                while i > 0 and keys[i - 1] == key and ids[i - 1] > entry_id:
+                    i -= 1
+                keys.insert(i, key)
+                ids.insert(i, entry_id)
+                touched.add(key)
+
+        index = PrefixIndex(
+            entries, keys, ids, heads=dict(self.heads), built_at=self.built_at, catalog_version=self.catalog_version,
+        )
+        for prefix in {key[:n] for key in touched for n in range(1, HEAD_LENGTH + 1)}:
+            best = index._best(prefix, HEAD_SIZE)
+            if best:
+                index.heads[prefix] = best
+            else:
+                index.heads.pop(prefix, None)
+        return index
+
+
+# ------------------------------
+# BUILDING
+# ------------------------------
+def build_index():
+    """Full index from the database: every product and category, and the popular queries."""
+    catalog_version = versions.current(versions.CATALOG)  # before reading, so a write during the build is not missed
+    entries = {}
+    views = Product.objects.annotate(views=Count("productview")).only("pid", "name")
+    for product in views.iterator(chunk_size=2000):
+        if normalize(product.name):
+            entries[("product", product.pid)] = product_suggestion(product, 1 + product.views)
+    for category in Category.objects.annotate(products=Count("product")).only("id", "name"):
+        if normalize(category.name):
+            entries[("category", category.id)] = category_suggestion(category, 1 + category.products)
+
+    counts = {}  # queries differing only in case and spacing are counted (and shown) as one
+    for query, times in (
+        SearchHistory.objects.exclude(query__isnull=True).exclude(query="")
+        .values("query").annotate(times=Count("id")).values_list("query", "times")
+    ):
+        key = normalize(query)
+        if key:
+            counts[key] = counts.get(key, 0) + times
+    popular = sorted(
+        ((total, key) for key, total in counts.items() if total >= settings.AUTOCOMPLETE_MIN_QUERY_COUNT),
+        reverse=True,
+    )[:settings.AUTOCOMPLETE_MAX_QUERIES]
+    for total, key in popular:
+        entries[("query", key)] = query_suggestion(key, total)
+    return PrefixIndex(entries, catalog_version=catalog_version)
+
+
+def _entry_from_db(entry_id):
+    """Current suggestion for a product or category entry, or None if it is gone."""
+    kind, ident = entry_id
+    if kind == "product":
+        product = Product.objects.filter(pid=ident).only("pid", "name").first()
+        return product_suggestion(product) if product and normalize(product.name) else None
+    category = Category.objects.filter(id=ident).only("id", "name").first()
+    return category_suggestion(category) if category and normalize(category.name) else None
+
+
+def _rebuild():
+    global _index, _build_thread, _dirty
+    from django.db import connection
+    try:
+        index = build_index()
+        with _lock:
+            _index = index
+            dirty, _dirty = _dirty, None
+        for entry_id in dirty or ():
+            _apply(entry_id, _entry_from_db(entry_id))
+    finally:
+        with _lock:
+            _dirty = None
+            _build_thread = None
+        connection.close()
+
+
+def schedule_rebuild():
+    """Rebuild the index from the database in a background thread (at most one at a time)."""
+    global _build_thread, _dirty
+    with _lock:
+        if _build_thread is not None:
+            return
+        _dirty = set()
+        _build_thread = thread = threading.Thread(target=_rebuild, name="autocomplete-rebuild", daemon=True)
+    thread.start()
+
+
+# ------------------------------
+# INCREMENTAL UPDATES (called from signals)
+# ------------------------------
+def _apply(entry_id, suggestion):
+    global _index
+    with _lock:
+        if _index is None:
+            return
+        old = _index.entries.get(entry_id)
+        if suggestion is not None and old is not None:
+            if old.text == suggestion.text and old.url == suggestion.url:
+                return
+            suggestion.weight = old.weight  # popularity survives a rename
+        if old is None and suggestion is None:
+            return
+        _index = _index.replaced(entry_id, suggestion)
+        if _dirty is not None:
+            _dirty.add(entry_id)
+
+
+def update_product(product):
+    _apply(("product", product.pid), product_suggestion(product) if normalize(product.name) else None)
+
+
+def remove_product(pid):
+    _apply(("product", pid), None)
+
+
+def update_category(category):
+    _apply(("category", category.id), category_suggestion(category) if normalize(category.name) else None)
+
+
+def remove_category(category_id):
+    _apply(("category", category_id), None)
+
+
+# ------------------------------
+# LOOKUP
+# ------------------------------
+def _catalog_moved(index):
+    """
+    Whether any worker has written to the catalog since `index` was built,
+    checked at most every AUTOCOMPLETE_FOLLOW_SECONDS (one cache read).
+    """
+    global _next_follow
+    now = time.monotonic()
+    if now < _next_follow:
+        return False
+    _next_follow = now + settings.AUTOCOMPLETE_FOLLOW_SECONDS
+    return versions.current(versions.CATALOG) != index.catalog_version
+
+
+@metrics.timed("autocomplete")
+def suggest(prefix, limit=None):
+    """Up to `limit` suggestions for what has been typed so far. Never queries the database."""
+    limit = min(limit or settings.AUTOCOMPLETE_LIMIT, HEAD_SIZE)
+    index = _index
+    if (index is None or time.monotonic() - index.built_at > settings.AUTOCOMPLETE_REBUILD_SECONDS
+            or _catalog_moved(index)):
+        schedule_rebuild()
+    if index is None:
+        return []
+    return index.lookup(prefix, limit)
@@ -0,0 +1,252 @@
+"""
+Micro-benchmarks of the recommender on synthetic catalogs.
+
+generate_catalog() fills the (throwaway) database with products whose
+name/description/specification lengths follow the real catalog's
+shape, using a Zipf-distributed vocabulary. It also adds users with
+search, view and cart histories that favour popular products.
+run_size() then measures:
+
+    train      train_model() wall time, peak RSS, feature matrix size
+    engines    per neighbour-engine configuration: index build time and
+               memory, p50/p95/p99 latency of knn_similar_products() and
+               recommend_for_user(), recall of the neighbours against brute
+               force, and the per-stage breakdown from hardware.metrics
+
+Used by `manage.py benchmark_recommender`, which runs this inside a
+temporary test database and writes the results as JSON.
+"""
+import time
+import tracemalloc
+
+import numpy as np
+from django.conf import settings
+from django.core.management.color import no_style
+from django.db import connection
+
+from hardware import ann, metrics, recommender, training
+from hardware.models import (
+    Category, Product, ProductView, SearchHistory, SimilarProduct, cartOrder, cartOrderItem,
+)
+from userauths.models import User
+
+# Neighbour-engine configurations compared at every size: (label, engine, options)
+ENGINE_CONFIGS = (
+    ("brute", "brute", {}),
+    ("lsh", "lsh", None),  # None = settings.RECOMMENDER_ENGINE_OPTIONS["lsh"]
+    ("lsh-fast", "lsh", {"tables": 4, "probes": 0, "max_candidates": 500}),
+)
+
+CATEGORY_NAMES = (
+    "Power Tools", "Hand Tools", "Garden Tools", "Plumbing Tools",
+    "Electrical Tools", "Measuring Tools", "Agricultural Tools", "Bathroom",
+)
+TOOL_WORDS = (
+    "drill", "hammer", "saw", "wrench", "pliers", "spanner", "chisel", "trowel", "rake", "hoe",
+    "spade", "shears", "tape", "level", "caliper", "square", "pipe", "valve", "tap", "cable",
+    "switch", "socket", "grinder", "sander", "sprayer", "pump", "sickle", "mower", "cutter", "clamp",
+)
+# Words per field (min, max), roughly the spread of the real catalog
+NAME_WORDS = (2, 5)
+DESCRIPTION_WORDS = (20, 80)
+SPECIFICATION_WORDS = (5, 20)
+
+
+def _vocabulary(size, rng):
+    """Tool words plus `size` pronounceable filler words, most common first."""
+    consonants, vowels = list("bcdfghklmnprstvz"), list("aeiou")
+    words = set(TOOL_WORDS)
+    while len(words) < size:
+        n = rng.integers(2, 5)
+        words.add("".join(rng.choice(consonants) + rng.choice(vowels) for _ in range(n)))
+    words = sorted(words - set(TOOL_WORDS))
+    rng.shuffle(words)
+    return np.array(list(TOOL_WORDS) + words[:size - len(TOOL_WORDS)])
+
+
+def _texts(vocabulary, rng, count, lengths):
+    """`count` strings of Zipf-distributed words with lengths in the `lengths` range."""
+    sizes = rng.integers(lengths[0], lengths[1] + 1, size=count)
+    ranks = np.minimum(rng.zipf(1.3, size=int(sizes.sum())) - 1, len(vocabulary) - 1)
+    words = vocabulary[ranks]
+    bounds = np.concatenate([[0], np.cumsum(sizes)])
+    return [" ".join(words[bounds[i]:bounds[i + 1]]) for i in range(count)]
+
+
+def _popular(rng, n_products, size):
+    """Product positions drawn with a long tail, as real traffic is."""
+    return np.minimum(rng.zipf(1.2, size=size) - 1, n_products - 1)
+
+
+def clear_catalog():
+    """Empty every table the benchmark writes to (fast SQL flush, no cascades in Python)."""
+    models = (SimilarProduct, cartOrderItem, cartOrder, ProductView, SearchHistory, Product, Category, User)
+    tables = [model._meta.db_table for model in models]
+    connection.ops.execute_sql_flush(connection.ops.sql_flush(no_style(), tables))
+
+
+def generate_catalog(n_products, n_users=None, seed=0, batch_size=10000):
+    """
+    Insert a synthetic catalog and user histories. Returns a summary dict.
+    Signals are not fired (bulk_create), so nothing retrains meanwhile.
+    """
+    started = time.perf_counter()
+    rng = np.random.default_rng(seed)
+    vocabulary = _vocabulary(min(50000, max(2000, n_products // 5)), rng)
+    n_users = n_users or int(np.clip(n_products // 10, 50, 2000))
+
+    categories = Category.objects.bulk_create([
+        Category(cid=f"catbench{i:02d}", name=name) for i, name in enumerate(CATEGORY_NAMES)
+    ])
+    pids = [f"bench{i:09d}" for i in range(n_products)]
+    labels = ("", "", "Hot", "Sale", "New")
+    for start in range(0, n_products, batch_size):
+        count = min(batch_size, n_products - start)
+        names = _texts(vocabulary[:2000], rng, count, NAME_WORDS)
+        descriptions = _texts(vocabulary, rng, count, DESCRIPTION_WORDS)
+        specifications = _texts(vocabulary, rng, count, SPECIFICATION_WORDS)
+        category_ids = rng.integers(0, len(categories), size=count)
+        prices = rng.integers(100, 50000, size=count)
+        Product.objects.bulk_create([
+            Product(
+                pid=pids[start + i], name=names[i][:100], description=descriptions[i][:500],
+                specification=specifications[i][:500], label=labels[(start + i) % len(labels)],
+                category=categories[category_ids[i]], price=int(prices[i]),
+                image="user_directory_path/tool.webp", product_status="published",
+            )
+            for i in range(count)
+        ], batch_size=batch_size)
+
+    users = User.objects.bulk_create([
+        User(username=f"bench{i}", email=f"bench{i}@example.com", password="!")
+        for i in range(n_users)
+    ])
+    views, searches, orders, items = [], [], [], []
+    for user in users:
+        viewed = {pids[j] for j in _popular(rng, n_products, rng.geometric(1 / 8))}
+        views.extend(ProductView(user=user, product_id=pid) for pid in viewed)
+        for j in _popular(rng, n_products, rng.geometric(1 / 4)):
+            searches.append(SearchHistory(user=user, product_id=pids[j]))
+        for query in _texts(vocabulary[:500], rng, int(rng.geometric(1 / 4)), (1, 3)):
+            searches.append(SearchHistory(user=user, query=query))
+        if rng.random() < 0.5:
+            order = cartOrder(user=user, price=0, order_status=rng.choice(["processing", "completed"]))
+            orders.append(order)
+            for j in _popular(rng, n_products, rng.integers(1, 4)):
+                items.append(cartOrderItem(user=user, order=order, item_id=pids[j], price=100, invoice_no="BENCH"))
+    ProductView.objects.bulk_create(views, batch_size=batch_size)
+    SearchHistory.objects.bulk_create(searches, batch_size=batch_size)
+    cartOrder.objects.bulk_create(orders, batch_size=batch_size)
+    cartOrderItem.objects.bulk_create(items, batch_size=batch_size)
+
+    return {
+        "products": n_products,
+        "users": n_users,
+        "vocabulary": len(vocabulary),
+        "product_views": len(views),
+        "search_history": len(searches),
+        "cart_items": len(items),
+        "generate_seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+def latency_summary(seconds):
+    """p50/p95/p99/mean in milliseconds of a list of durations."""
+    ms = np.asarray(seconds, dtype=np.float64) * 1000
+    if not len(ms):
+        return {"n": 0}
+    p50, p95, p99 = np.percentile(ms, (50, 95, 99))
+    return {
+        "n": len(ms), "p50_ms": round(float(p50), 3), "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3), "mean_ms": round(float(ms.mean()), 3),
+    }
+
+
+def _matrix_stats(matrix):
+    n_bytes = matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+    return {
+        "rows": matrix.shape[0],
+        "terms": matrix.shape[1],
+        "nnz": int(matrix.nnz),
+        "density": float(matrix.nnz / max(matrix.shape[0] * matrix.shape[1], 1)),
+        "megabytes": round(n_bytes / 2 ** 20, 2),
+    }
+
+
+def _traced(fn):
+    """(result, seconds, peak MB of Python/numpy allocations) of fn()."""
+    tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        result = fn()
+        return result, time.perf_counter() - started, tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+
+
+def run_size(n_products, queries=200, top_n=8, engines=ENGINE_CONFIGS, trace_memory=False, seed=0):
+    """Generate a catalog of n_products and benchmark every engine configuration on it."""
+    clear_catalog()
+    result = {"size": n_products, "catalog": generate_catalog(n_products, seed=seed)}
+
+    started = time.perf_counter()
+    model = recommender.build_model()
+    train_seconds = time.perf_counter() - started
+    train = {
+        "seconds": round(train_seconds, 3),
+        "products_per_second": round(n_products / train_seconds, 1),
+        "peak_rss_mb": training.peak_memory_mb()[0],
+        "matrix": _matrix_stats(model.matrix),
+    }
+    if trace_memory:
+        # A second, traced run: tracemalloc slows allocation, so it is not timed
+        _, _, train["traced_peak_mb"] = _traced(recommender.build_model)
+    result["train"] = train
+
+    rng = np.random.default_rng(seed + 1)
+    sample_pids = [str(pid) for pid in rng.choice(model.pids, size=min(queries, len(model.pids)), replace=False)]
+    sample_products = list(Product.objects.filter(pid__in=sample_pids))
+    users = list(User.objects.order_by("?")[:queries])
+
+    result["engines"] = []
+    brute_neighbors = None
+    for label, engine, options in engines:
+        if options is None:
+            options = getattr(settings, "RECOMMENDER_ENGINE_OPTIONS", {}).get(engine, {})
+        index, build_seconds, build_peak = _traced(lambda: ann.build_index(model.matrix, engine, **options))
+        recommender.publish(recommender.make_snapshot(
+            model.vectorizer, model.matrix, model.pids,
+            version=f"{model.version}-{label}", pid_index=model.pid_index, knn_model=index,
+        ))
+        metrics.histogram().reset()
+
+        similar_times, neighbors = [], {}
+        for product in sample_products:
+            started = time.perf_counter()
+            neighbors[product.pid] = [p.pid for p in recommender.knn_similar_products(product, top_n=top_n)]
+            similar_times.append(time.perf_counter() - started)
+
+        recommend_times = []
+        for user in users:
+            started = time.perf_counter()
+            recommender.recommend_for_user(user, top_n=top_n, use_cache=False)
+            recommend_times.append(time.perf_counter() - started)
+
+        run = {
+            "label": label,
+            "engine": engine,
+            "options": index.get_params(),
+            "build_seconds": round(build_seconds, 3),
+            "build_peak_mb": round(build_peak, 2),
+            "knn_similar_products": latency_summary(similar_times),
+            "recommend_for_user": latency_summary(recommend_times),
+            "stages": metrics.histogram().snapshot()["stages"],
+        }
+        if engine == "brute" and brute_neighbors is None:
+            brute_neighbors = neighbors
+        elif brute_neighbors is not None:
+            found = sum(len(set(neighbors[pid]) & set(brute_neighbors[pid])) for pid in neighbors)
+            expected = sum(len(brute_neighbors[pid]) for pid in neighbors)
+            run["recall_vs_brute"] = round(found / expected, 4) if expected else None
+        result["engines"].append(run)
+    return result
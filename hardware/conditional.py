@@ -0,0 +1,55 @@
+"""
+Conditional GET (ETag / Last-Modified) for catalog pages.
+
+validated_by(*stamps) wraps a view in Django's condition(): the ETag is
+a hash of the version counters the page is built from (hardware.versions)
+and Last-Modified is when the newest of them last moved. Both are cache
+reads, so an unchanged page answers 304 before the view body runs,
+without a query or a template render.
+
+A page only gets validators when its HTML is the same for everyone who
+asks for it:
+    - no flash messages waiting to be shown (they are part of the page)
+    - personal=True pages (recommendations, view tracking) only for
+      anonymous visitors; logged-in users always get a fresh render
+The CSRF cookie is part of the ETag, so a page with a form is never
+revalidated against a token the browser no longer holds.
+"""
+import hashlib
+
+from django.conf import settings
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.views.decorators.http import condition
+
+from hardware import versions
+
+
+def _has_pending_messages(request):
+    if request.COOKIES.get(CookieStorage.cookie_name):
+        return True
+    # Messages too large for the cookie fall back to the session
+    return settings.SESSION_COOKIE_NAME in request.COOKIES and bool(request.session.get("_messages"))
+
+
+def _validated(request, personal):
+    if request.method not in ("GET", "HEAD") or _has_pending_messages(request):
+        return False
+    return not (personal and request.user.is_authenticated)
+
+
+def validated_by(*stamps, personal=False):
+    """Decorator: ETag/Last-Modified from the named version counters (see module docstring)."""
+
+    def etag(request, *args, **kwargs):
+        if not _validated(request, personal):
+            return None
+        parts = [f"{stamp}={versions.current(stamp)}" for stamp in stamps]
+        parts.append(request.COOKIES.get(settings.CSRF_COOKIE_NAME, ""))
+        return hashlib.md5("|".join(parts).encode()).hexdigest()
+
+    def last_modified(request, *args, **kwargs):
+        if not _validated(request, personal):
+            return None
+        return max(versions.changed_at(stamp) for stamp in stamps)
+
+    return condition(etag_func=etag, last_modified_func=last_modified)
@@ -0,0 +1,116 @@
+"""
+Vectorised KNN classification helpers for knn_evaluation_db.py.
+
+A product's category is predicted by a majority vote of its nearest
+training products. All test rows are queried in one kneighbors() call.
+The vote is a single bincount over (row, label) pairs, and one query
+with the largest k serves every smaller k in a grid, because the
+neighbours come back sorted.
+
+Only numpy and scikit-learn are used here, so grid tasks can run in
+worker processes without touching Django or the database.
+"""
+import time
+
+import numpy as np
+from sklearn.metrics import accuracy_score, f1_score, precision_score, recall_score
+from sklearn.neighbors import NearestNeighbors
+
+
+def encode_labels(labels):
+    """(classes, codes): sorted distinct labels and each label's index into them."""
+    classes, codes = np.unique(np.asarray(labels, dtype=str), return_inverse=True)
+    return classes, codes
+
+
+def majority_vote(neighbor_codes, n_classes):
+    """
+    Most common label code in every row of an (n_rows x k) array of
+    neighbours sorted nearest first. A tie goes to the tied label with the
+    nearest neighbour, so results are repeatable (the old set-order vote
+    was not).
+    """
+    n_rows, k = neighbor_codes.shape
+    rows = np.arange(n_rows)
+    flat = (rows[:, None] * n_classes + neighbor_codes).ravel()
+    counts = np.bincount(flat, minlength=n_rows * n_classes).reshape(n_rows, n_classes)
+    first = np.full((n_rows, n_classes), k)
+    for rank in range(k - 1, -1, -1):
+        first[rows, neighbor_codes[:, rank]] = rank
+    return (counts * (k + 1) - first).argmax(axis=1)
+
+
+def scores(y_true, y_pred):
+    """Weighted precision/recall/F1 (as in the original script) plus accuracy."""
+    return {
+        "precision": precision_score(y_true, y_pred, average="weighted", zero_division=0),
+        "recall": recall_score(y_true, y_pred, average="weighted", zero_division=0),
+        "f1": f1_score(y_true, y_pred, average="weighted", zero_division=0),
+        "accuracy": accuracy_score(y_true, y_pred),
+    }
+
+
+def evaluate_split(task):
+    """
+    One grid cell: every k for one (max_features, split).
+    task = (max_features, split, X, codes, train_idx, test_idx, ks, n_classes)
+    Returns one result dict per k.
+    """
+    max_features, split, X, codes, train_idx, test_idx, ks, n_classes = task
+    X_train, X_test = X[train_idx], X[test_idx]
+    y_train, y_test = codes[train_idx], codes[test_idx]
+    k_max = min(max(ks), X_train.shape[0])
+
+    knn = NearestNeighbors(metric="cosine", algorithm="brute").fit(X_train)
+    started = time.perf_counter()
+    indices = knn.kneighbors(X_test, n_neighbors=k_max, return_distance=False)
+    query_seconds = time.perf_counter() - started
+    neighbor_codes = y_train[indices]
+
+    results = []
+    for k in ks:
+        started = time.perf_counter()
+        y_pred = majority_vote(neighbor_codes[:, :min(k, k_max)], n_classes)
+        vote_seconds = time.perf_counter() - started
+        results.append({
+            "max_features": max_features,
+            "split": split,
+            "k": k,
+            "train": len(train_idx),
+            "test": len(test_idx),
+            **scores(y_test, y_pred),
+            "query_ms_per_row": 1000 * query_seconds / max(len(test_idx), 1),
+            "vote_ms": 1000 * vote_seconds,
+        })
+    return results
+
+
+def summarize(rows):
+    """Average the per-split rows of every (max_features, k) cell; best F1 first."""
+    cells = {}
+    for row in rows:
+        cells.setdefault((row["max_features"], row["k"]), []).append(row)
+    metrics = ("precision", "recall", "f1", "accuracy", "query_ms_per_row", "vote_ms")
+    table = []
+    for (max_features, k), group in cells.items():
+        summary = {"max_features": max_features, "k": k, "splits": len(group)}
+        for metric in metrics:
+            values = np.array([row[metric] for row in group], dtype=np.float64)
+            summary[metric] = float(values.mean())
+            if metric == "f1":
+                summary["f1_std"] = float(values.std())
+        table.append(summary)
+    table.sort(key=lambda r: (-r["f1"], r["query_ms_per_row"]))
+    return table
+
+
+def format_table(table):
+    header = f"{'max_feat':>8} {'k':>3} {'splits':>6} {'prec':>6} {'recall':>6} {'f1':>6} {'±f1':>6} " \
+             f"{'acc':>6} {'ms/query':>9} {'vote ms':>8}"
+    lines = [header, "-" * len(header)]
+    for r in table:
+        lines.append(
+            f"{str(r['max_features']):>8} {r['k']:>3} {r['splits']:>6} {r['precision']:6.3f} {r['recall']:6.3f} "
+            f"{r['f1']:6.3f} {r['f1_std']:6.3f} {r['accuracy']:6.3f} {r['query_ms_per_row']:9.4f} {r['vote_ms']:8.3f}"
+        )
+    return "\n".join(lines)
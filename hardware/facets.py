@@ -0,0 +1,161 @@
+"""
+Faceted filtering for the search and category pages.
+
+Facets: price bucket, label, in stock, featured and category. The
+filters selected in the query string (price=500-1000&label=Hot&cid=...)
+narrow the results; values of one facet are OR-ed, facets are AND-ed.
+
+Counts are computed the usual "drill-down" way: each value's count
+applies every selected filter except its own facet's, so picking "Hot"
+still shows how many "Sale" products there are. All of them come from
+one aggregate query with a conditional COUNT per value. Search and the
+category listing cache them with their pages (see search.cached_facets
+and listing.cached_counts).
+"""
+from decimal import Decimal
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.db.models import Count, Q
+
+from hardware.models import LABEL_CHOICES
+
+FACETS = ("price", "label", "in_stock", "featured", "cid")
+FACET_TITLES = {
+    "price": "Price", "label": "Label", "in_stock": "Availability", "featured": "Featured", "cid": "Category",
+}
+LABELS = tuple(value for value, _ in LABEL_CHOICES if value)
+
+
+def price_buckets():
+    """[(key, low, high)] from settings.FACET_PRICE_EDGES; the last bucket has no upper bound."""
+    edges = settings.FACET_PRICE_EDGES
+    return [
+        (f"{low}-{high if high is not None else ''}", low, high)
+        for low, high in zip(edges, list(edges[1:]) + [None])
+    ]
+
+
+def _bucket_q(low, high):
+    q = Q(price__gte=Decimal(low))
+    return q & Q(price__lt=Decimal(high)) if high is not None else q
+
+
+def parse_filters(params, categories=()):
+    """
+    {facet: tuple of selected values} from a QueryDict, keeping only
+    values that exist. `categories` are the Category rows cids are checked against.
+    """
+    valid = {
+        "price": {key for key, _, _ in price_buckets()},
+        "label": set(LABELS),
+        "in_stock": {"1"},
+        "featured": {"1"},
+        "cid": {category.cid for category in categories},
+    }
+    filters = {}
+    for facet in FACETS:
+        values = tuple(sorted(set(params.getlist(facet)) & valid[facet]))
+        if values:
+            filters[facet] = values
+    return filters
+
+
+def _value_q(facet, value, categories_by_cid):
+    if facet == "price":
+        for key, low, high in price_buckets():
+            if key == value:
+                return _bucket_q(low, high)
+    if facet == "label":
+        return Q(label=value)
+    if facet in ("in_stock", "featured"):
+        return Q(**{facet: True})
+    if facet == "cid":
+        return Q(category_id=categories_by_cid[value].id)
+    raise ValueError(f"Unknown facet value {facet}={value}")
+
+
+def filter_q(filters, categories=(), exclude=None):
+    """Q for the selected filters, leaving out the `exclude` facet."""
+    by_cid = {category.cid: category for category in categories}
+    q = Q()
+    for facet, values in filters.items():
+        if facet == exclude:
+            continue
+        either = Q()
+        for value in values:
+            either |= _value_q(facet, value, by_cid)
+        q &= either
+    return q
+
+
+def _options(facet, categories):
+    """(value, display label) of every value a facet can take."""
+    if facet == "price":
+        return [
+            (key, f"Rs {low}+" if high is None else f"Rs {low} - {high}") for key, low, high in price_buckets()
+        ]
+    if facet == "label":
+        return [(label, label) for label in LABELS]
+    if facet == "in_stock":
+        return [("1", "In stock")]
+    if facet == "featured":
+        return [("1", "Featured")]
+    return [(category.cid, category.name) for category in categories]
+
+
+def facet_counts(products, filters, categories=(), facets=FACETS):
+    """
+    {"total": n, facet: {value: count}} for the `products` queryset, in
+    one query. `products` is the unfiltered base (the search matches, or
+    the category), so every count can leave out its own facet's filter.
+    """
+    by_cid = {category.cid: category for category in categories}
+    aggregates, names = {}, {}
+    total_q = filter_q(filters, categories)
+    aggregates["total"] = Count("pk", filter=total_q) if total_q else Count("pk")
+    for facet in facets:
+        others = filter_q(filters, categories, exclude=facet)
+        for i, (value, _) in enumerate(_options(facet, categories)):
+            alias = f"{facet}_{i}"
+            names[alias] = (facet, value)
+            aggregates[alias] = Count("pk", filter=_value_q(facet, value, by_cid) & others)
+    row = products.order_by().aggregate(**aggregates)
+
+    counts = {"total": row["total"]}
+    for facet in facets:
+        counts[facet] = {}
+    for alias, (facet, value) in names.items():
+        counts[facet][value] = row[alias]
+    return counts
+
+
+def facet_groups(counts, filters, params, categories=()):
+    """
+    What the facet sidebar renders: [{"name", "title", "options": [{"value",
+    "label", "count", "selected", "url"}]}]. Each url toggles that value
+    and restarts paging; values with no products are left out unless selected.
+    """
+    base = [(key, value) for key in params for value in params.getlist(key) if key not in FACETS + ("after",)]
+    groups = []
+    for facet in FACETS:
+        if facet not in counts:
+            continue
+        options = []
+        for value, label in _options(facet, categories):
+            selected = value in filters.get(facet, ())
+            count = counts[facet].get(value, 0)
+            if not count and not selected:
+                continue
+            toggled = dict(filters)
+            chosen = set(filters.get(facet, ()))
+            chosen.symmetric_difference_update({value})
+            toggled[facet] = tuple(sorted(chosen))
+            query = base + [(f, v) for f in FACETS for v in toggled.get(f, ())]
+            options.append({
+                "value": value, "label": label, "count": count, "selected": selected,
+                "url": f"?{urlencode(query)}",
+            })
+        if options:
+            groups.append({"name": facet, "title": FACET_TITLES[facet], "options": options})
+    return groups
@@ -25,14 +25,16 @@ urlpatterns = [
     
     path("collection/", views.collectionpage, name="collectionpage"),
     
-    path("powertool/", views.powertools, name="powertools"),
-    path("handtool/", views.handTools, name="handTools"),
-    path("gardentool/", views.gardenTools, name="gardenTools"),
-    path("plumbingtool/", views.plumbingTools, name="plumbingTools"),
-    path("electricaltool/", views.electricalTools, name="electricalTools"),
-    path("measuringtool/", views.measuringTools, name="measuringTools"),
-    path("agriculturaltool/", views.agricultureTools, name="agriculturalTools"),
-    path("bathroom/", views.bathroomTools, name="bathroomTools"),
+    path("category/<str:cid>/", views.category_page, name="category"),
+    # Original category URLs, served by the same listing
+    path("powertool/", views.category_by_name, {"name": "Power Tools"}, name="powertools"),
+    path("handtool/", views.category_by_name, {"name": "Hand Tools"}, name="handTools"),
+    path("gardentool/", views.category_by_name, {"name": "Garden & Outdoor"}, name="gardenTools"),
+    path("plumbingtool/", views.category_by_name, {"name": "Plumbing Supplies"}, name="plumbingTools"),
+    path("electricaltool/", views.category_by_name, {"name": "Electrical Supplies"}, name="electricalTools"),
+    path("measuringtool/", views.category_by_name, {"name": "Measuring Tools"}, name="measuringTools"),
+    path("agriculturaltool/", views.category_by_name, {"name": "Agricultural Tools"}, name="agriculturalTools"),
+    path("bathroom/", views.category_by_name, {"name": "Bathroom utensils"}, name="bathroomTools"),
     
     path("productdetail/<str:pid>/", views.productDetailpage, name="productdetail"),
     
@@ -55,4 +57,7 @@ urlpatterns = [
    
     
     path("search/", views.searchs, name="searchs"),
+    path("autocomplete/", views.autocomplete_view, name="autocomplete"),
+
+    path("metrics/", views.metrics_view, name="metrics"),
 ]
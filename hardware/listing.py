@@ -0,0 +1,163 @@
+"""
+Category listing pages: one engine for every category, keyed by cid.
+
+A page is SORTS[sort] order over the category's products (narrowed by
+any facet filters), CATEGORY_PAGE_SIZE at a time. Paging is by keyset:
+the cursor holds the last row's sort key plus its pid, and the next page
+starts strictly after it, so deep pages cost what the first does. Only
+the columns the product card shows are fetched.
+
+The rendered listing (facets, sort links, cards, paging) is cached per
+(category, sort, filters, cursor) under the catalog version, and also
+the reviews version when sorting by rating. Per-user parts of the page,
+such as flash messages, are rendered around it.
+"""
+import hashlib
+import json
+from datetime import datetime
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Avg, FloatField, Q, Value
+from django.db.models.functions import Coalesce
+from django.http import QueryDict
+from django.template.loader import render_to_string
+
+from hardware import facets, versions
+from hardware.models import Product
+from hardware.search import decode_key, encode_cursor
+
+# Columns the product card renders, plus updated_at for its cache key
+CARD_FIELDS = ("pid", "name", "image", "price", "old_price", "label", "updated_at")
+
+SORTS = {
+    "newest": "Newest",
+    "price": "Price: low to high",
+    "rating": "Top rated",
+}
+DEFAULT_SORT = "newest"
+
+
+def _ordered(products, sort):
+    """(queryset in `sort` order, name of its sort-key column)."""
+    if sort == "price":
+        return products.order_by("price", "pid"), "price"
+    if sort == "rating":
+        rating = Coalesce(Avg("product_review__rating"), Value(0.0), output_field=FloatField())
+        return products.annotate(rating=rating).order_by("-rating", "pid"), "rating"
+    return products.order_by("-created_at", "-pid"), "created_at"
+
+
+def _after(products, sort, key):
+    """Rows strictly after the sort key `key` = [value, pid]."""
+    value, pid = key
+    if sort == "price":
+        return products.filter(Q(price__gt=value) | Q(price=value, pid__gt=pid))
+    if sort == "rating":
+        return products.filter(Q(rating__lt=value) | Q(rating=value, pid__gt=pid))
+    return products.filter(Q(created_at__lt=value) | Q(created_at=value, pid__lt=pid))
+
+
+def _cursor_value(product, column):
+    value = getattr(product, column)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value) if column == "price" else value  # Decimal as text, so it round-trips exactly
+
+
+def _parse_key(token, sort):
+    key = decode_key(token, 2)
+    if key is None:
+        return None
+    value, pid = key
+    try:
+        if sort == "newest":
+            value = datetime.fromisoformat(value)
+        elif sort == "rating":
+            value = float(value)
+        else:
+            value = str(value)
+    except (TypeError, ValueError):
+        return None
+    return [value, str(pid)]
+
+
+def listing_page(category, sort=DEFAULT_SORT, filters=None, after=None, size=None):
+    """One page of the category: (products, next_cursor)."""
+    size = size or settings.CATEGORY_PAGE_SIZE
+    products = Product.objects.filter(category=category)
+    if filters:
+        products = products.filter(facets.filter_q(filters))
+    products, column = _ordered(products, sort)
+    products = products.only(*CARD_FIELDS, *(("created_at",) if column == "created_at" else ()))
+    key = _parse_key(after, sort)
+    if key is not None:
+        products = _after(products, sort, key)
+    page = list(products[:size + 1])
+    next_cursor = None
+    if len(page) > size:
+        page = page[:size]
+        next_cursor = encode_cursor(_cursor_value(page[-1], column), page[-1].pid)
+    return page, next_cursor
+
+
+def _page_cache_key(category, sort, filters, after):
+    stamp = [versions.current(versions.CATALOG)]
+    if sort == "rating":
+        stamp.append(versions.current(versions.REVIEWS))
+    raw = json.dumps([category.cid, sort, sorted(filters.items()), after or "", settings.CATEGORY_PAGE_SIZE])
+    return f"listing:{'.'.join(map(str, stamp))}:{hashlib.md5(raw.encode()).hexdigest()}"
+
+
+def cached_counts(category, filters):
+    """
+    Facet counts over the category's products (the same base listing_page
+    pages through), cached under the catalog version for every sort and cursor.
+    """
+    raw = json.dumps([category.cid, sorted(filters.items())])
+    key = f"listing:{versions.current(versions.CATALOG)}:facets:{hashlib.md5(raw.encode()).hexdigest()}"
+    counts = cache.get(key)
+    if counts is None:
+        counts = facets.facet_counts(
+            Product.objects.filter(category=category), filters, facets=facets.FACETS[:-1],
+        )
+        cache.set(key, counts, settings.CATEGORY_PAGE_CACHE_TIMEOUT)
+    return counts
+
+
+def render_listing(category, params, categories=()):
+    """
+    The rendered listing for a request's query string (sort, facet filters,
+    after), from the cache when it has been rendered before.
+    """
+    sort = params.get("sort") if params.get("sort") in SORTS else DEFAULT_SORT
+    filters = facets.parse_filters(params, categories)
+    filters.pop("cid", None)  # the category is fixed
+    after = params.get("after") or None
+    key = _page_cache_key(category, sort, filters, after)
+    html = cache.get(key)
+    if html is not None:
+        return html
+
+    products, next_cursor = listing_page(category, sort, filters, after)
+    counts = cached_counts(category, filters)
+    # Links are built from the parsed parameters only, since the HTML is shared by every matching request
+    kept = [(facet, value) for facet in facets.FACETS for value in filters.get(facet, ())]
+    canonical = QueryDict(mutable=True)
+    canonical["sort"] = sort
+    context = {
+        "category": category,
+        "products": products,
+        "facet_groups": facets.facet_groups(counts, filters, canonical, categories),
+        "facet_total": counts["total"],
+        "sorts": [
+            {"key": k, "label": label, "selected": k == sort, "url": f"?{urlencode(kept + [('sort', k)])}"}
+            for k, label in SORTS.items()
+        ],
+        "next_page_url": f"?{urlencode(kept + [('sort', sort), ('after', next_cursor)])}" if next_cursor else None,
+        "first_page_url": f"?{urlencode(kept + [('sort', sort)])}" if after else None,
+    }
+    html = render_to_string("hardware/includes/category_listing.html", context)
+    cache.set(key, html, settings.CATEGORY_PAGE_CACHE_TIMEOUT)
+    return html
@@ -0,0 +1,113 @@
+import json
+import platform
+import subprocess
+import time
+
+import numpy as np
+import scipy
+import sklearn
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_databases, teardown_databases
+
+from hardware import benchmark
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark train_model, knn_similar_products and recommend_for_user on synthetic catalogs "
+        "in a temporary database, and write the results as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            type=int,
+            nargs="+",
+            default=[1000, 10000, 100000, 1000000],
+            help="Catalog sizes to generate (products).",
+        )
+        parser.add_argument(
+            "--engines",
+            nargs="+",
+            choices=[label for label, _, _ in benchmark.ENGINE_CONFIGS],
+            default=[label for label, _, _ in benchmark.ENGINE_CONFIGS],
+            help="Engine configurations to compare (see hardware.benchmark.ENGINE_CONFIGS).",
+        )
+        parser.add_argument(
+            "--queries",
+            type=int,
+            default=200,
+            help="Products and users sampled for the latency measurements.",
+        )
+        parser.add_argument(
+            "--trace-memory",
+            action="store_true",
+            help="Also run training under tracemalloc to report its Python/numpy peak.",
+        )
+        parser.add_argument(
+            "--seed",
+            type=int,
+            default=0,
+            help="Random seed of the synthetic catalog.",
+        )
+        parser.add_argument(
+            "--output",
+            default="benchmark_recommender.json",
+            help="JSON file to write.",
+        )
+
+    def handle(self, *args, **options):
+        engines = [config for config in benchmark.ENGINE_CONFIGS if config[0] in options["engines"]]
+        report = {
+            "commit": _git_commit(),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "scipy": scipy.__version__,
+            "sklearn": sklearn.__version__,
+            "machine": platform.machine(),
+            "queries": options["queries"],
+            "runs": [],
+        }
+
+        # Never touch the real catalog: everything happens in a throwaway test database
+        old_config = setup_databases(verbosity=0, interactive=False, aliases={"default"})
+        try:
+            for size in sorted(options["sizes"]):
+                self.stdout.write(f"Benchmarking {size} products...")
+                run = benchmark.run_size(
+                    size, queries=options["queries"], engines=engines,
+                    trace_memory=options["trace_memory"], seed=options["seed"],
+                )
+                report["runs"].append(run)
+                train = run["train"]
+                self.stdout.write(
+                    f"  train {train['seconds']}s, matrix {train['matrix']['megabytes']} MB "
+                    f"({train['matrix']['nnz']} non-zeros)"
+                )
+                for engine in run["engines"]:
+                    similar, recommend = engine["knn_similar_products"], engine["recommend_for_user"]
+                    recall = engine.get("recall_vs_brute")
+                    self.stdout.write(
+                        f"  {engine['label']:<9} build {engine['build_seconds']}s | similar p50 "
+                        f"{similar['p50_ms']} ms p99 {similar['p99_ms']} ms | recommend p50 "
+                        f"{recommend['p50_ms']} ms p99 {recommend['p99_ms']} ms"
+                        + (f" | recall {recall}" if recall is not None else "")
+                    )
+        except KeyboardInterrupt:
+            raise CommandError("Interrupted; no results written.")
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+        with open(options["output"], "w") as f:
+            json.dump(report, f, indent=2)
+        self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}."))
@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from hardware import recommender, training
+
+
+class Command(BaseCommand):
+    help = "Train the TF-IDF/KNN recommender offline and write a versioned artifact."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=None,
+            help="Processes used to tokenize and vectorize (defaults to the CPU count).",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=5000,
+            help="Products read from the database and sent to a worker at a time.",
+        )
+        parser.add_argument(
+            "--output",
+            help="Artifact directory (defaults to settings.RECOMMENDER_ARTIFACT_DIR).",
+        )
+        parser.add_argument(
+            "--no-activate",
+            action="store_true",
+            help="Write the build without pointing CURRENT at it.",
+        )
+        parser.add_argument(
+            "--skip-similar",
+            action="store_true",
+            help="Do not rebuild the SimilarProduct table from the new model.",
+        )
+
+    def handle(self, *args, **options):
+        synced_at = timezone.now()  # workers patch in edits made after this (recommender.follow_catalog)
+        result = training.train_parallel(workers=options["workers"], chunk_size=options["chunk_size"])
+        if result is None:
+            raise CommandError("No products to train on.")
+        vectorizer, matrix, pids, stats = result
+        recommender.install_model(vectorizer, matrix, pids, synced_at=synced_at)
+        self.stdout.write(
+            f"Trained on {stats['documents']} products ({stats['terms']} terms, {stats['nnz']} non-zeros) "
+            f"with {stats['workers']} workers in {stats['total_seconds']}s: "
+            f"{stats['docs_per_second']} docs/sec, peak memory {stats['peak_memory_mb']} MB "
+            f"(workers {stats['peak_worker_memory_mb']} MB)."
+        )
+
+        version = recommender.save_artifact(
+            directory=options["output"], activate=not options["no_activate"]
+        )
+        state = "written" if options["no_activate"] else "written and activated"
+        self.stdout.write(self.style.SUCCESS(f"Recommender artifact {version} {state}."))
+
+        if not options["skip_similar"]:
+            rows = recommender.build_similar_products()
+            self.stdout.write(self.style.SUCCESS(f"SimilarProduct table rebuilt ({rows} rows)."))
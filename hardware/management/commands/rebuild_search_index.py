@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from hardware import search
+
+
+class Command(BaseCommand):
+    help = "Recreate the FTS5 product search index and its triggers from the product table."
+
+    def handle(self, *args, **options):
+        if not search.index_available():
+            raise CommandError("No FTS5 search index on this database (run migrate on SQLite first).")
+        count = search.install_index()
+        self.stdout.write(self.style.SUCCESS(f"Search index rebuilt ({count} products)."))
@@ -0,0 +1,94 @@
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from hardware import recommender, replay
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay recommend_for_user against the recorded views and carts: "
+        "hit-rate@N and per-call latency on a read-only copy of the database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--top-n", type=int, default=8, help="Recommendations per call (the N in hit-rate@N).")
+        parser.add_argument("--per-user", type=int, default=5, help="Latest replay points per user.")
+        parser.add_argument(
+            "--min-history", type=int, default=1,
+            help="Interactions a user needs before a point is replayed (0 includes cold starts).",
+        )
+        parser.add_argument("--max-users", type=int, default=None, help="Replay at most this many users.")
+        parser.add_argument(
+            "--workers", type=int, default=None, help="Worker processes (defaults to the CPU count).",
+        )
+        parser.add_argument("--output", help="Also write the summary and settings as JSON to this file.")
+
+    def handle(self, *args, **options):
+        database = settings.DATABASES["default"]
+        if database["ENGINE"] != "django.db.backends.sqlite3":
+            raise CommandError("Replay needs the SQLite database (it copies db.sqlite3 to a read-only snapshot).")
+        top_n = options["top_n"]
+        workers = options["workers"] or os.cpu_count() or 1
+
+        source = str(database["NAME"])
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = replay.snapshot_database(source, tmp)
+            replay.use_snapshot(db_path)
+            self.stdout.write(f"Replaying against a read-only snapshot of {source}.")
+
+            points = replay.replay_points(options["per_user"], options["min_history"], options["max_users"])
+            n_points = sum(len(p) for p in points.values())
+            if not n_points:
+                raise CommandError("No views or cart items to replay.")
+
+            model = recommender.build_model()
+            if model is None:
+                raise CommandError("No products to train on.")
+            version = recommender.save_artifact(directory=os.path.join(tmp, "model"), activate=False, model=model)
+
+            self.stdout.write(f"{n_points} replay points for {len(points)} users on {workers} workers...")
+            started = time.perf_counter()
+            tasks = [(user_id, user_points, top_n) for user_id, user_points in points.items()]
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=replay._init_worker,
+                initargs=(db_path, os.path.join(tmp, "model"), version),
+            ) as pool:
+                results = [row for rows in pool.map(replay.replay_user, tasks, chunksize=8) for row in rows]
+            elapsed = time.perf_counter() - started
+
+        summary = replay.summarize(results, top_n)
+        for kind, block in summary.items():
+            if not block["calls"]:
+                continue
+            self.stdout.write(
+                f"  {kind:<6} {block['calls']:>6} calls  hit-rate@{top_n} {block[f'hit_rate@{top_n}']:.4f}  "
+                f"MRR {block['mrr']:.4f}  latency p50 {block['latency_p50_ms']} ms  "
+                f"p95 {block['latency_p95_ms']} ms  p99 {block['latency_p99_ms']} ms"
+            )
+        self.stdout.write(
+            self.style.SUCCESS(f"Replayed {len(results)} calls in {elapsed:.2f}s ({len(results) / elapsed:.1f} calls/sec).")
+        )
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump({
+                    "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "model_version": version,
+                    "top_n": top_n,
+                    "per_user": options["per_user"],
+                    "min_history": options["min_history"],
+                    "users": len(points),
+                    "workers": workers,
+                    "seconds": round(elapsed, 3),
+                    "summary": summary,
+                }, f, indent=2)
+            self.stdout.write(f"Summary written to {options['output']}.")
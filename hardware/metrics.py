@@ -0,0 +1,198 @@
+"""
+Stage timings and counters for the recommender.
+
+    with metrics.span("seeds.search_history"):
+        ...
+    metrics.incr("recommend.cache_hit")
+    metrics.observe("recommend.seeds_per_user", len(seeds))
+
+Every measurement goes to the sinks listed in settings.RECOMMENDER_METRICS_SINKS
+(dotted paths, instantiated once per process):
+
+    hardware.metrics.LogSink        one DEBUG line per measurement on the
+                                    "hardware.metrics" logger
+    hardware.metrics.HistogramSink  recent samples kept in memory, summarised
+                                    as p50/p95/p99 per stage; also renders the
+                                    Prometheus text served at /metrics/
+
+A sink only needs timing(stage, seconds), observe(name, value) and
+incr(name, amount).
+"""
+import functools
+import logging
+import re
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+import numpy as np
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger("hardware.metrics")
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+_sinks = None
+_sinks_lock = threading.Lock()
+
+
+# ------------------------------
+# SINKS
+# ------------------------------
+class LogSink:
+    """Write every measurement to the log; useful while profiling one page."""
+
+    def timing(self, stage, seconds):
+        logger.debug("stage %s took %.2f ms", stage, seconds * 1000)
+
+    def observe(self, name, value):
+        logger.debug("%s = %s", name, value)
+
+    def incr(self, name, amount=1):
+        logger.debug("%s += %s", name, amount)
+
+
+class _Series:
+    """Count and sum of everything observed, plus the most recent samples for quantiles."""
+
+    def __init__(self, samples):
+        self.count = 0
+        self.total = 0.0
+        self.recent = deque(maxlen=samples)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.recent.append(value)
+
+    def summary(self):
+        recent = np.fromiter(self.recent, dtype=np.float64)
+        quantiles = np.quantile(recent, QUANTILES) if len(recent) else [float("nan")] * len(QUANTILES)
+        return {
+            "count": self.count,
+            "sum": self.total,
+            **{f"p{int(q * 100)}": float(v) for q, v in zip(QUANTILES, quantiles)},
+        }
+
+
+class HistogramSink:
+    """
+    In-memory per-process stage histograms and counters. Quantiles are
+    computed over the last `samples` observations of each series, so they
+    follow current behaviour rather than the whole uptime.
+    """
+
+    def __init__(self, samples=None):
+        self.samples = samples or getattr(settings, "RECOMMENDER_METRICS_SAMPLES", 2048)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._timings = defaultdict(lambda: _Series(self.samples))
+            self._values = defaultdict(lambda: _Series(self.samples))
+            self._counters = defaultdict(float)
+
+    def timing(self, stage, seconds):
+        with self._lock:
+            self._timings[stage].add(seconds)
+
+    def observe(self, name, value):
+        with self._lock:
+            self._values[name].add(value)
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def snapshot(self):
+        """{"stages": {stage: summary}, "values": {name: summary}, "counters": {name: total}}"""
+        with self._lock:
+            return {
+                "stages": {stage: s.summary() for stage, s in self._timings.items()},
+                "values": {name: s.summary() for name, s in self._values.items()},
+                "counters": dict(self._counters),
+            }
+
+    def prometheus_text(self, prefix="toolhub"):
+        """Prometheus text exposition (version 0.0.4) of the snapshot."""
+        data = self.snapshot()
+        lines = []
+
+        def summary(metric, series):
+            """series: {label string (may be empty): summary}"""
+            lines.append(f"# TYPE {metric} summary")
+            for labels, s in sorted(series.items()):
+                sep = "," if labels else ""
+                for q in QUANTILES:
+                    lines.append(f'{metric}{{{labels}{sep}quantile="{q}"}} {s[f"p{int(q * 100)}"]:.6g}')
+                lines.append(f'{metric}_sum{{{labels}}} {s["sum"]:.6g}')
+                lines.append(f'{metric}_count{{{labels}}} {s["count"]}')
+
+        if data["stages"]:
+            summary(f"{prefix}_stage_seconds", {f'stage="{k}"': s for k, s in data["stages"].items()})
+        for name, s in sorted(data["values"].items()):
+            summary(f"{prefix}_{_metric_name(name)}", {"": s})
+        for name, total in sorted(data["counters"].items()):
+            metric = f"{prefix}_{_metric_name(name)}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {total:.6g}")
+        return "\n".join(lines) + "\n"
+
+
+def _metric_name(name):
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+# ------------------------------
+# RECORDING API
+# ------------------------------
+def sinks():
+    """The configured sink instances (created on first use)."""
+    global _sinks
+    if _sinks is None:
+        with _sinks_lock:
+            if _sinks is None:
+                paths = getattr(settings, "RECOMMENDER_METRICS_SINKS", ["hardware.metrics.HistogramSink"])
+                _sinks = [import_string(path)() for path in paths]
+    return _sinks
+
+
+def histogram():
+    """The first HistogramSink, or None if none is configured."""
+    return next((sink for sink in sinks() if isinstance(sink, HistogramSink)), None)
+
+
+@contextmanager
+def span(stage):
+    """Time the block and report it as `stage`, also when it raises."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        for sink in sinks():
+            sink.timing(stage, elapsed)
+
+
+def timed(stage):
+    """Decorator form of span()."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def observe(name, value):
+    for sink in sinks():
+        sink.observe(name, value)
+
+
+def incr(name, amount=1):
+    for sink in sinks():
+        sink.incr(name, amount)
@@ -0,0 +1,23 @@
+from django.db import migrations
+
+
+def install(apps, schema_editor):
+    from hardware import search
+    search.install_index(schema_editor.connection)
+
+
+def uninstall(apps, schema_editor):
+    from hardware import search
+    search.uninstall_index(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+    """FTS5 product search index and its sync triggers (SQLite only; see hardware.search)."""
+
+    dependencies = [
+        ('hardware', '0008_similarproduct'),
+    ]
+
+    operations = [
+        migrations.RunPython(install, uninstall),
+    ]
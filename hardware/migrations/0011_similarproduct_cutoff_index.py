@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hardware', '0010_product_updated_at_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='similarproduct',
+            index=models.Index(fields=['rank', 'score'], name='similar_cutoff_idx'),
+        ),
+    ]
@@ -110,6 +110,9 @@ class Product(models.Model):
     
     class Meta:
         verbose_name_plural = "Products"
+        indexes = [
+            models.Index(fields=["updated_at"], name="product_updated_at_idx"),  # recommender catalog sync
+        ]
         
     def product_image(self):
         return mark_safe(f'<img src="{self.image.url}" width="50" height="50" />') 
@@ -240,4 +243,18 @@ class SearchHistory(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     product = models.ForeignKey(Product, on_delete=models.SET_NULL, null = True)
     timestamp = models.DateTimeField(auto_now_add=True)
-    query = models.CharField(max_length=255, null=True, blank=True)
\ No newline at end of file
+    query = models.CharField(max_length=255, null=True, blank=True)
+
+class SimilarProduct(models.Model):
+    """Precomputed top-K neighbours of a product, rebuilt by the recommender."""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='similar_entries')
+    neighbor = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='neighbor_of')
+    score = models.FloatField()
+    rank = models.PositiveSmallIntegerField()
+
+    class Meta:
+        verbose_name_plural = "Similar Products"
+        ordering = ['product', 'rank']
+        unique_together = ['product', 'rank']
+        # Last-place (cut-off) scores, read when an edited product may enter other lists
+        indexes = [models.Index(fields=['rank', 'score'], name='similar_cutoff_idx')]
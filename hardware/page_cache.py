@@ -0,0 +1,74 @@
+"""
+Whole-response cache for pages that are the same for every logged-out visitor.
+
+cached_page(*stamps) stores the response of an anonymous GET under the
+version counters it was built from (hardware.versions) plus the path and
+the sorted query string; a write bumps a counter and every page built
+from it is rebuilt on its next request, in whichever worker serves it
+(counters and pages both live in the shared default cache). A hit is
+cache reads only: no query, no template render, no session or user lookup.
+
+A request is only served from (or stored in) the cache when nothing
+about the visitor can change the page:
+    - no session cookie: logged-in users, and anonymous visitors with a
+      session (flash messages that did not fit the cookie), always get
+      a fresh render
+    - no flash messages waiting in the messages cookie
+Responses that set a cookie or used the CSRF token (a form on the page)
+are never stored, since both are per visitor.
+"""
+import hashlib
+import json
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+
+from hardware import metrics, versions
+from hardware.conditional import _has_pending_messages
+
+
+def _cacheable(request):
+    if request.method not in ("GET", "HEAD") or settings.SESSION_COOKIE_NAME in request.COOKIES:
+        return False
+    return not _has_pending_messages(request)
+
+
+def _storable(request, response):
+    return (
+        request.method == "GET"
+        and response.status_code == 200
+        and not response.streaming
+        and not response.cookies
+        and not request.META.get("CSRF_COOKIE_NEEDS_UPDATE")
+    )
+
+
+def page_cache_key(request, stamps):
+    version = ".".join(str(versions.current(stamp)) for stamp in stamps)
+    raw = json.dumps([request.path, sorted(request.GET.lists())])
+    return f"page:{version}:{hashlib.md5(raw.encode()).hexdigest()}"
+
+
+def cached_page(*stamps, timeout=None):
+    """Decorator: cache anonymous responses under the named version counters (see module docstring)."""
+
+    def decorator(view):
+        @wraps(view)
+        def wrapped(request, *args, **kwargs):
+            if not _cacheable(request):
+                return view(request, *args, **kwargs)
+            key = page_cache_key(request, stamps)
+            response = cache.get(key)
+            if response is not None:
+                metrics.incr("page_cache.hit")
+                return response
+            metrics.incr("page_cache.miss")
+            response = view(request, *args, **kwargs)
+            if _storable(request, response):
+                cache.set(key, response, timeout or settings.PAGE_CACHE_TIMEOUT)
+            return response
+
+        return wrapped
+
+    return decorator
@@ -1,98 +1,966 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta
+
 import pandas as pd
 import numpy as np
+from scipy import sparse
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.neighbors import NearestNeighbors
 from userauths.models import User
+from hardware import ann, metrics, versions
 from hardware.models import (
     Product, SearchHistory, OrderItem, cartOrderItem,
-    ProductView
+    ProductView, SimilarProduct
 )
 
 # ------------------------------
-# Globals to hold trained model
+# Live model: one immutable ModelSnapshot, replaced by reference
 # ------------------------------
-_knn_model = None
-_feature_matrix = None
-_product_ids = None
-_vectorizer = None
+_snapshot = None
+_update_lock = threading.Lock()  # serialises writers; readers never take it
+_refit_thread = None
+_dirty_pids = None  # pids patched while a refit runs, replayed on top of its result
+_seen_current = None  # CURRENT pointer as of the last artifact this process loaded or published
+_synced = (None, None)  # (base version, time) of the last catalog sync (see follow_catalog)
+_next_follow = 0.0  # monotonic time of the next follow_catalog check
+_pinned = False  # keep the loaded model, never follow CURRENT or the catalog (see pin_model)
+_refit_lock = None  # held from the drift check that scheduled a refit until the refit ends
+
+# Edits committed this long before a sync started are looked at again, so
+# one whose transaction was still open during the previous sync is not missed
+SYNC_OVERLAP = timedelta(minutes=1)
+REFIT_LOCK_FILE = "refit.lock"  # in RECOMMENDER_ARTIFACT_DIR; one drift refit at a time across workers
+REFIT_LOCK_KEY = "recommender:refit"  # the same, in the cache, where there is no fcntl
+REFIT_LOCK_SECONDS = 10 * 60
+
+# Files that make up one persisted model build (see save_artifact)
+ARTIFACT_FORMAT = 2
+ARTIFACT_FILES = (
+    "meta.json", "vocabulary.json", "idf.npy",
+    "data.npy", "indices.npy", "indptr.npy",
+    "pids.npy", "pids_sorted.npy", "pids_rows.npy",
+)
+
+
+class PidIndex:
+    """
+    pid -> row lookups by binary search over a sorted pid array.
+
+    Unlike a dict, both arrays can be memory-mapped from the artifact, so
+    every worker shares the same pages instead of holding its own copy.
+    """
+
+    def __init__(self, sorted_pids, rows):
+        self.sorted_pids = sorted_pids
+        self.rows = rows
+
+    @classmethod
+    def build(cls, pids):
+        order = np.argsort(pids, kind="stable")
+        return cls(pids[order], order)
+
+    def get(self, pid, default=None):
+        i = np.searchsorted(self.sorted_pids, pid)
+        if i < len(self.sorted_pids) and self.sorted_pids[i] == pid:
+            return int(self.rows[i])
+        return default
+
+    def __contains__(self, pid):
+        return self.get(pid) is not None
+
+    def __getitem__(self, pid):
+        row = self.get(pid)
+        if row is None:
+            raise KeyError(pid)
+        return row
+
+    def __len__(self):
+        return len(self.sorted_pids)
+
+
+class ModelSnapshot:
+    """
+    One complete build of the model: vectorizer, feature matrix, pid table
+    and neighbour index, plus the incremental patches applied on top of it.
+
+    A snapshot is never modified once published. Retrains and patches
+    build a new one and publish it with a single assignment to `_snapshot`.
+    A request reads current_model() once and uses only that object, so it
+    always sees parts that belong together.
+    """
+
+    def __init__(self, vectorizer, matrix, pids, pid_index, knn_model, version,
+                 patch_count=0, unseen_terms=frozenset(), synced_at=None, patched_docs=None):
+        self.vectorizer = vectorizer
+        self.matrix = matrix
+        self.pids = pids  # numpy array of pids, row order
+        self.pid_index = pid_index  # PidIndex: pid -> row in matrix
+        self.knn_model = knn_model
+        self.version = version
+        self.patch_count = patch_count  # incremental updates since the last full fit
+        self.unseen_terms = unseen_terms
+        self.synced_at = synced_at  # catalog state the full fit was read at (None: unknown)
+        self.patched_docs = patched_docs or {}  # pid -> document text of every row patched since the fit
+        self._query_cache = OrderedDict()
+        self._query_lock = threading.Lock()
+
+    def patched(self, matrix, pids, pid_index=None, unseen_terms=None, changed_rows=(), removed_row=None,
+                docs=None):
+        """
+        A new snapshot with a patched matrix/pid array. The patched arrays
+        are private to this process; the shared mmapped artifact is left
+        untouched. Only the changed rows are re-indexed by the neighbour
+        engine (ann.update_index).
+
+        `docs` maps the pids patched in to their document text. The version
+        is the base version plus a digest of every patched document, so two
+        workers that applied the same edits (one from the save signal, one
+        through follow_catalog, in however many steps) agree on it, and share
+        cached recommendations. Removals leave the version as it is: the
+        other workers only drop a deleted product at the next build, and
+        skip it as a dead pid until then.
+        """
+        patched_docs = {**self.patched_docs, **(docs or {})}
+        version = self.base_version
+        if patched_docs:
+            digest = hashlib.sha1(json.dumps(sorted(patched_docs.items())).encode("utf-8")).hexdigest()
+            version = f"{version}+{digest[:10]}"
+        return ModelSnapshot(
+            self.vectorizer, matrix, pids, pid_index or PidIndex.build(pids),
+            ann.update_index(self.knn_model, matrix, changed_rows, removed_row),
+            version,
+            patch_count=self.patch_count + 1,
+            unseen_terms=self.unseen_terms if unseen_terms is None else unseen_terms,
+            synced_at=self.synced_at,
+            patched_docs=patched_docs,
+        )
+
+    def with_unseen_terms(self, unseen_terms):
+        """This snapshot with a larger set of unseen terms (rows, index and version unchanged)."""
+        return ModelSnapshot(
+            self.vectorizer, self.matrix, self.pids, self.pid_index, self.knn_model, self.version,
+            patch_count=self.patch_count, unseen_terms=unseen_terms, synced_at=self.synced_at,
+            patched_docs=self.patched_docs,
+        )
+
+    @property
+    def base_version(self):
+        """Version of the full fit this snapshot was patched from."""
+        return self.version.split('+')[0]
+
+    def query_neighbors(self, query):
+        """
+        Top-5 (pid, similarity) for a normalised text query. Popular queries
+        are shared by many users, so the last RECOMMENDER_QUERY_CACHE_SIZE
+        results are kept on the snapshot and go away with it.
+        """
+        with self._query_lock:
+            if query in self._query_cache:
+                self._query_cache.move_to_end(query)
+                metrics.incr("seeds.query_cache_hit")
+                return self._query_cache[query]
+
+        metrics.incr("seeds.query_cache_miss")
+        with metrics.span("seeds.vectorize_query"):
+            query_vec = self.vectorizer.transform([query])
+        metrics.incr("knn.calls")
+        with metrics.span("knn.kneighbors"):
+            distances, indices = self.knn_model.kneighbors(query_vec, n_neighbors=min(5, len(self.pids)))
+        result = tuple((str(self.pids[i]), float(1 - d)) for i, d in zip(indices[0], distances[0]))
+
+        with self._query_lock:
+            self._query_cache[query] = result
+            if len(self._query_cache) > settings.RECOMMENDER_QUERY_CACHE_SIZE:
+                self._query_cache.popitem(last=False)
+        return result
+
+
+def current_model():
+    """The snapshot serving requests right now, or None if nothing is loaded."""
+    return _snapshot
+
+
+def ensure_model():
+    """
+    Like current_model(), but with no model it also starts a background
+    build. Requests call this and fall back while it returns None; they
+    never wait for training.
+    It also keeps this worker on the same model as the others (see follow_catalog).
+    """
+    follow_catalog()
+    model = _snapshot
+    if model is None:
+        schedule_refit()
+    return model
+
+
+# Product fields that make up its document, in order (see product_document)
+DOCUMENT_FIELDS = ("name", "description", "specification", "label", "category_id")
+
+
+def product_document(name, description, specification, label, category_id):
+    """Text used to vectorize a product (training and incremental updates)."""
+    return f"{name} {description} {specification} {label} {category_id}"
+
+
+def _product_text(p):
+    return product_document(*(getattr(p, field) for field in DOCUMENT_FIELDS))
 
 
 # ------------------------------
 # TRAINING STEP
 # ------------------------------
-def train_model(k_neighbors=3):
+def build_model():
     """
     Build TF-IDF feature matrix for all products and train a KNN model.
-    Falls back to popular products if k_neighbors < 1.
+    Returns an unpublished ModelSnapshot, or None if there are no products.
     """
-    global _knn_model, _feature_matrix, _product_ids, _vectorizer
+    with metrics.span("train_model"):
+        products = Product.objects.all()
+        if not products.exists():
+            print("No products found for training.")
+            return None
+
+        docs, pids = [], []
+        synced_at = timezone.now()
+        with metrics.span("train.fetch_products"):
+            for p in products:
+                docs.append(_product_text(p))
+                pids.append(p.pid)
+
+        vectorizer = TfidfVectorizer(stop_words='english')
+        with metrics.span("train.vectorize"):
+            matrix = vectorizer.fit_transform(docs)
+        with metrics.span("train.build_index"):
+            model = make_snapshot(vectorizer, matrix, pids, synced_at=synced_at)
+    print(f"KNN model trained successfully on {len(pids)} products.")
+    return model
 
-    products = Product.objects.all()
-    if not products.exists():
-        print("No products found for training.")
-        return None
 
+def train_model(k_neighbors=3):
+    """
+    Train and publish a model in the calling thread (management commands,
+    tests). Request paths use ensure_model() instead.
+    Falls back to popular products if k_neighbors < 1.
+    """
     # fallback for very small datasets
     if k_neighbors < 1:
         print("k_neighbors < 1, falling back to popular products only.")
-        popular_products = products.order_by('-popularity')[:8]  # assuming 'popularity' field exists
-        _product_ids = [p.pid for p in popular_products]
-        _feature_matrix = None
-        _knn_model = None
-        return _product_ids
+        popular_products = Product.objects.order_by('-popularity')[:8]  # assuming 'popularity' field exists
+        return [p.pid for p in popular_products]
+
+    model = build_model()
+    if model is not None:
+        publish(model)
+    return model
+
 
-    docs, pids = [], []
-    for p in products:
-        text = f"{p.name} {p.description} {p.specification} {p.label} {p.category_id}"
-        docs.append(text)
-        pids.append(p.pid)
+def make_snapshot(vectorizer, matrix, pids, version=None, pid_index=None, knn_model=None, synced_at=None,
+                  unseen_terms=frozenset()):
+    """
+    Bundle a fitted vectorizer, its feature matrix and the matching pids into
+    a snapshot. `synced_at` is when the products were read from the database.
+    """
+    pids = np.asarray(pids, dtype=str) if not isinstance(pids, np.ndarray) else pids
+    return ModelSnapshot(
+        vectorizer, matrix, pids,
+        pid_index or PidIndex.build(pids),
+        knn_model or ann.build_index(matrix),
+        version or _build_version(matrix, pids),
+        unseen_terms=frozenset(unseen_terms),
+        synced_at=synced_at,
+    )
 
-    _vectorizer = TfidfVectorizer(stop_words='english')
-    _feature_matrix = _vectorizer.fit_transform(docs)
-    _product_ids = pids
 
-    _knn_model = NearestNeighbors(metric='cosine', algorithm='brute')
-    _knn_model.fit(_feature_matrix)
+def publish(model):
+    """Make `model` the live snapshot. Requests already running keep the one they read."""
+    global _snapshot
+    with _update_lock:
+        _snapshot = model
+    return model.version
 
-    print(f"KNN model trained successfully on {len(products)} products.")
-    return _knn_model
 
+def install_model(vectorizer, matrix, pids, version=None, pid_index=None, knn_model=None, synced_at=None,
+                  unseen_terms=frozenset()):
+    """Make a fitted vectorizer, its feature matrix and the matching pids the live model."""
+    return publish(make_snapshot(vectorizer, matrix, pids, version, pid_index, knn_model, synced_at, unseen_terms))
+
+
+# ------------------------------
+# PERSISTED MODEL ARTIFACTS
+# ------------------------------
+def _artifact_root(directory=None):
+    return directory or getattr(
+        settings, "RECOMMENDER_ARTIFACT_DIR",
+        os.path.join(settings.BASE_DIR, "recommender_artifacts"),
+    )
+
+
+def _build_version(matrix, pids):
+    """Timestamp plus a content hash, so two builds of the same catalog compare equal by hash."""
+    digest = hashlib.sha1()
+    digest.update(json.dumps([str(pid) for pid in pids]).encode("utf-8"))
+    digest.update(np.ascontiguousarray(matrix.indptr).tobytes())
+    digest.update(np.ascontiguousarray(matrix.indices).tobytes())
+    digest.update(np.ascontiguousarray(matrix.data).tobytes())
+    return f"{time.strftime('%Y%m%d%H%M%S')}-{digest.hexdigest()[:10]}"
+
+
+def save_artifact(directory=None, activate=True, model=None):
+    """
+    Write the trained model to <directory>/<version>/ and, if activate is set,
+    point <directory>/CURRENT at it. The sparse matrix, the pid table and
+    the neighbour engine's tables are stored as plain .npy arrays. Workers
+    memory-map them instead of unpickling, so every process on a node
+    shares one copy through the page cache.
+    Returns the version string.
+    """
+    global _seen_current
+    model = model or current_model()
+    if model is None:
+        raise RuntimeError("No trained model to save; call train_model() first.")
+
+    root = _artifact_root(directory)
+    version = model.version
+    target = os.path.join(root, version)
+    tmp = os.path.join(root, f".{version}.tmp")
+    os.makedirs(root, exist_ok=True)
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    matrix = model.matrix.tocsr()
+    np.save(os.path.join(tmp, "data.npy"), matrix.data)
+    np.save(os.path.join(tmp, "indices.npy"), matrix.indices)
+    np.save(os.path.join(tmp, "indptr.npy"), matrix.indptr)
+    np.save(os.path.join(tmp, "idf.npy"), model.vectorizer.idf_)
+    with open(os.path.join(tmp, "vocabulary.json"), "w") as f:
+        json.dump({term: int(i) for term, i in model.vectorizer.vocabulary_.items()}, f)
+    np.save(os.path.join(tmp, "pids.npy"), model.pids)
+    np.save(os.path.join(tmp, "pids_sorted.npy"), model.pid_index.sorted_pids)
+    np.save(os.path.join(tmp, "pids_rows.npy"), model.pid_index.rows)
+    knn_model = model.knn_model
+    engine = ann.engine_name(knn_model)
+    if hasattr(knn_model, "save"):
+        knn_model.save(tmp)
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump({
+            "format": ARTIFACT_FORMAT,
+            "version": version,
+            "shape": list(matrix.shape),
+            "nnz": int(matrix.nnz),
+            "stop_words": "english",
+            "engine": engine,
+            "engine_params": knn_model.get_params() if hasattr(knn_model, "get_params") else {},
+            "synced_at": model.synced_at.isoformat() if model.synced_at else None,
+            "unseen_terms": sorted(model.unseen_terms),  # drift carried over by republished patches
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }, f)
+
+    # Publish the directory in one rename so readers never see a half-written build
+    shutil.rmtree(target, ignore_errors=True)
+    os.rename(tmp, target)
+    if activate:
+        pointer_tmp = os.path.join(root, ".CURRENT.tmp")
+        with open(pointer_tmp, "w") as f:
+            f.write(version)
+        os.replace(pointer_tmp, os.path.join(root, "CURRENT"))
+        if directory is None:
+            _seen_current = version
+    return version
+
+
+def current_artifact_version(directory=None):
+    """Version the workers should serve: the pinned setting, else the CURRENT pointer."""
+    pinned = getattr(settings, "RECOMMENDER_MODEL_VERSION", None)
+    if pinned:
+        return pinned
+    try:
+        with open(os.path.join(_artifact_root(directory), "CURRENT")) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def load_artifact(version=None, directory=None):
+    """
+    Load a persisted build and publish it as the live snapshot. Arrays are memory-mapped
+    read-only and used in place (no copies), so this costs a few file opens
+    rather than a TF-IDF fit, and RSS per worker does not grow with the
+    catalog. Starting gunicorn with --preload maps them once before forking.
+    Incremental updates (update_products) give a worker a private copy of
+    the matrix; after RECOMMENDER_REPUBLISH_PATCHES of them one worker
+    writes the patched model as a new build, and every worker maps that.
+    Returns the loaded version, or None if there is nothing to load.
+    """
+    global _seen_current
+    current = current_artifact_version(directory)
+    version = version or current
+    if not version:
+        return None
+    if directory is None:
+        _seen_current = current
+    model = _read_artifact(version, directory)
+    return publish(model) if model is not None else None
+
+
+def _read_artifact(version, directory=None):
+    """The memory-mapped snapshot of a persisted build, unpublished; None if it cannot be read."""
+    path = os.path.join(_artifact_root(directory), version)
+    if not all(os.path.exists(os.path.join(path, name)) for name in ARTIFACT_FILES):
+        print(f"Recommender artifact {version} is missing or incomplete at {path}.")
+        return None
+
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    if meta.get("format") != ARTIFACT_FORMAT:
+        print(f"Recommender artifact {version} has an old format; rebuild it with build_recommender.")
+        return None
+    with open(os.path.join(path, "vocabulary.json")) as f:
+        vocabulary = json.load(f)
+
+    def mapped(name):
+        return np.load(os.path.join(path, name), mmap_mode="r")
+
+    matrix = sparse.csr_matrix(
+        (mapped("data.npy"), mapped("indices.npy"), mapped("indptr.npy")),
+        shape=tuple(meta["shape"]),
+        copy=False,
+    )
+    vectorizer = TfidfVectorizer(stop_words=meta.get("stop_words"), vocabulary=vocabulary)
+    vectorizer.idf_ = np.load(os.path.join(path, "idf.npy"))
+
+    knn_model = None
+    if meta.get("engine") == getattr(settings, "RECOMMENDER_ENGINE", "brute"):
+        knn_model = ann.load_index(meta["engine"], path, matrix, meta.get("engine_params", {}))
+
+    synced_at = meta.get("synced_at")
+    return make_snapshot(
+        vectorizer, matrix, mapped("pids.npy"),
+        version=meta["version"],
+        pid_index=PidIndex(mapped("pids_sorted.npy"), mapped("pids_rows.npy")),
+        knn_model=knn_model,
+        synced_at=datetime.fromisoformat(synced_at) if synced_at else None,
+        unseen_terms=meta.get("unseen_terms", ()),
+    )
+
+
+# ------------------------------
+# INCREMENTAL UPDATES (Product save/delete)
+# ------------------------------
+def vocabulary_drift(model=None):
+    """Share of the fitted vocabulary that edited products have introduced as unseen terms."""
+    model = model or current_model()
+    if model is None or not model.vectorizer.vocabulary_:
+        return 0.0
+    return len(model.unseen_terms) / len(model.vectorizer.vocabulary_)
+
+
+def update_products(products, only_changed=False):
+    """
+    Re-vectorize created or edited products with the fitted vectorizer and
+    patch their rows, all in one new snapshot, in place of a full retrain.
+    With only_changed, products whose row would not change are skipped
+    (catalog syncs look at some products twice). Terms the vectorizer has
+    never seen are dropped by transform(), but counted either way; once
+    they add up past RECOMMENDER_REFIT_DRIFT a background refit is
+    scheduled. Returns the number of rows patched.
+    """
+    global _snapshot
+    with _update_lock:
+        model = _snapshot
+        if model is None:
+            return 0
+        products = list({product.pid: product for product in products}.values())
+        if not products:
+            return 0
+        vectorizer = model.vectorizer
+        vocabulary = vectorizer.vocabulary_
+        analyzer = vectorizer.build_analyzer()
+        docs = [_product_text(product) for product in products]
+        rows = vectorizer.transform(docs).astype(model.matrix.dtype).tocsr()
+
+        matrix = model.matrix
+        replaced, added, unseen = {}, [], set(model.unseen_terms)
+        for k, (product, doc) in enumerate(zip(products, docs)):
+            i = model.pid_index.get(product.pid)
+            unseen.update(t for t in analyzer(doc) if t not in vocabulary)
+            if only_changed and i is not None and (rows[k] != matrix[i]).nnz == 0:
+                continue
+            if i is None:
+                added.append(k)
+            else:
+                replaced[i] = k
+
+        if replaced or added:
+            # vstack builds new arrays, so a memory-mapped artifact is never written to
+            parts, start = [], 0
+            for i in sorted(replaced):
+                parts += [matrix[start:i], rows[replaced[i]]]
+                start = i + 1
+            parts += [matrix[start:]] + [rows[k] for k in added]
+            pids = np.append(model.pids, [products[k].pid for k in added]) if added else model.pids
+            _snapshot = model.patched(
+                sparse.vstack(parts, format='csr'), pids, None if added else model.pid_index,
+                unseen_terms=frozenset(unseen),
+                changed_rows=sorted(replaced) + list(range(matrix.shape[0], matrix.shape[0] + len(added))),
+                docs={products[k].pid: docs[k] for k in [*replaced.values(), *added]},
+            )
+            if _dirty_pids is not None:
+                _dirty_pids.update(product.pid for product in products)
+        elif len(unseen) > len(model.unseen_terms):
+            # Only terms the vectorizer drops: same rows and version, more drift
+            _snapshot = model.with_unseen_terms(frozenset(unseen))
+        else:
+            return 0
+
+    # Every worker sees the same edits (see follow_catalog), so only one of them
+    # refits, or republishes the patches so that every worker maps them again
+    build = None
+    if vocabulary_drift() > settings.RECOMMENDER_REFIT_DRIFT:
+        build = build_model
+    elif _snapshot.patch_count >= settings.RECOMMENDER_REPUBLISH_PATCHES:
+        build = None if settings.RECOMMENDER_MODEL_VERSION else _republished  # pinned builds stay put
+    if build is not None and _take_refit_lock() and not schedule_refit(build):
+        _release_refit_lock()
+    return len(replaced) + len(added)
+
+
+def _republished():
+    """
+    The live snapshot's patches folded into a build of their own: a new
+    base version, no patches, and synced_at set to the last catalog sync,
+    so other workers re-check anything edited after it.
+    """
+    model = current_model()
+    if model is None:
+        return None
+    since = _synced[1] if _synced[0] == model.base_version else model.synced_at
+    return make_snapshot(
+        model.vectorizer, model.matrix, model.pids,
+        pid_index=model.pid_index, knn_model=model.knn_model,
+        synced_at=since, unseen_terms=model.unseen_terms,
+    )
+
+
+def _take_refit_lock():
+    """
+    Take the cross-process refit lock without waiting; False if another
+    worker (or a refit already running here) holds it. It is an flock() on
+    a file in the artifact directory the workers share, which the OS drops
+    if the process dies. Without fcntl it falls back to cache.add(), which
+    is only atomic on Redis (see settings.CACHES).
+    """
+    global _refit_lock
+    if fcntl is None:
+        if not cache.add(REFIT_LOCK_KEY, os.getpid(), REFIT_LOCK_SECONDS):
+            return False
+        _refit_lock = REFIT_LOCK_KEY
+        return True
+    os.makedirs(settings.RECOMMENDER_ARTIFACT_DIR, exist_ok=True)
+    handle = open(os.path.join(settings.RECOMMENDER_ARTIFACT_DIR, REFIT_LOCK_FILE), "a")
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        handle.close()
+        return False
+    _refit_lock = handle
+    return True
+
+
+def _release_refit_lock():
+    global _refit_lock
+    lock, _refit_lock = _refit_lock, None
+    if lock == REFIT_LOCK_KEY:
+        cache.delete(REFIT_LOCK_KEY)
+    elif lock is not None:
+        lock.close()  # closing the file drops the flock
+
+
+def update_product(product):
+    """
+    Patch one created or edited product's row (see update_products), unless
+    the edit left its text alone (a price or stock change): the other
+    workers skip those rows in follow_catalog too, so versions stay equal.
+    Returns the number of rows patched.
+    """
+    return update_products([product], only_changed=True)
+
+
+def remove_product(pid):
+    """Drop a deleted product's row so it can no longer be returned as a neighbour."""
+    global _snapshot
+    with _update_lock:
+        model = _snapshot
+        if model is None:
+            return
+        i = model.pid_index.get(pid)
+        if i is None:
+            return
+        matrix = model.matrix
+        _snapshot = model.patched(
+            sparse.vstack([matrix[:i], matrix[i + 1:]], format='csr'),
+            np.delete(model.pids, i),
+            removed_row=i,
+        )
+        if _dirty_pids is not None:
+            _dirty_pids.add(pid)
+
+
+def _replay(pids):
+    """Re-apply product edits that raced with a refit on top of its snapshot."""
+    existing = Product.objects.in_bulk(list(pids))
+    for pid in pids:
+        if pid in existing:
+            update_product(existing[pid])
+        else:
+            remove_product(pid)
+
+
+def _refit(build=None):
+    """
+    Build a new model off to the side while the old snapshot keeps serving,
+    write it as the CURRENT artifact, then publish its memory-mapped copy
+    with one reference swap. Edits made during the build are replayed on
+    top, so the swap does not lose any of them. `build` makes the new model:
+    a full fit from the database (build_model) by default, or _republished.
+    The SimilarProduct table is not rebuilt here: it is patched per edit,
+    and rebuilt offline by `build_recommender`.
+    """
+    global _snapshot, _refit_thread, _dirty_pids
+    from django.db import connection
+    try:
+        model = (build or build_model)()
+        if model is not None:
+            # Other workers pick the build up from CURRENT (see follow_catalog)
+            version = save_artifact(model=model)
+            model = _read_artifact(version) or model
+            # Swap and stop recording in one step, so no edit falls in between
+            with _update_lock:
+                _snapshot = model
+                dirty, _dirty_pids = _dirty_pids, None
+            if dirty:
+                _replay(dirty)
+    finally:
+        with _update_lock:
+            _dirty_pids = None
+            _refit_thread = None
+        _release_refit_lock()
+        connection.close()
+
+
+def schedule_refit(build=None):
+    """
+    Retrain from the database (or rebuild with `build`, see _refit) in a
+    background thread, at most one at a time. Returns False if one was
+    already running.
+    """
+    global _refit_thread, _dirty_pids
+    with _update_lock:
+        if _refit_thread is not None:
+            return False
+        _dirty_pids = set()
+        _refit_thread = thread = threading.Thread(
+            target=_refit, args=(build,), name="recommender-refit", daemon=True
+        )
+    thread.start()
+    return True
+
+
+def pin_model():
+    """
+    Keep this process on the model it has now: follow_catalog() no longer
+    loads a new CURRENT or patches in catalog edits. For offline runs
+    (replay workers) that must score every call with the same build.
+    """
+    global _pinned
+    _pinned = True
+
+
+def follow_catalog(force=False):
+    """
+    Keep this worker on the same model as every other one, at most once
+    every RECOMMENDER_FOLLOW_SECONDS (or now, with force):
+        - when the CURRENT pointer has moved (another worker's refit, or
+          build_recommender), load that build
+        - patch in products saved since the model last synced, whichever
+          worker saved them (rows that did not change are skipped)
+    Deleted products leave the model with the next build; until then the
+    similar-product and recommendation queries skip them as dead pids.
+    """
+    global _next_follow, _seen_current, _synced
+    now = time.monotonic()
+    if _pinned or (not force and now < _next_follow):
+        return
+    _next_follow = now + settings.RECOMMENDER_FOLLOW_SECONDS
+
+    current = current_artifact_version()
+    if current and current != _seen_current:
+        model = _snapshot
+        if model is None or model.base_version != current:
+            load_artifact(current)
+        _seen_current = current
+
+    model = _snapshot
+    if model is None:
+        return
+    since = _synced[1] if _synced[0] == model.base_version else model.synced_at
+    if since is None:
+        return
+    started = timezone.now()
+    with metrics.span("recommender.follow_catalog"):
+        changed = Product.objects.filter(updated_at__gt=since - SYNC_OVERLAP).only("pid", *DOCUMENT_FIELDS)
+        patched = update_products(changed, only_changed=True)
+    metrics.incr("recommender.synced_rows", patched)
+    _synced = (model.base_version, started)
+
+
+# ------------------------------
+# MATERIALIZED SIMILAR-PRODUCT TABLE
+# ------------------------------
+def _row_sims(model, vec):
+    """Cosine similarity of one TF-IDF row against every catalog row (rows are L2-normalised)."""
+    return np.asarray((model.matrix @ vec.T).todense()).ravel()
+
+
+def _live_top_k(pairs, k, exclude=()):
+    """Best k (pid, score) pairs whose products still exist, best first."""
+    pairs = sorted(
+        ((pid, score) for pid, score in pairs if score > 0 and pid not in exclude),
+        key=lambda x: (-x[1], x[0]),
+    )
+    result = []
+    for start in range(0, len(pairs), 2 * k):
+        chunk = pairs[start:start + 2 * k]
+        live = set(Product.objects.filter(pid__in=[pid for pid, _ in chunk]).values_list('pid', flat=True))
+        result.extend(pair for pair in chunk if pair[0] in live)
+        if len(result) >= k:
+            break
+    return result[:k]
+
+
+def _write_similar_rows(rows_by_pid):
+    """Replace the neighbour lists of the given products."""
+    with transaction.atomic():
+        SimilarProduct.objects.filter(product_id__in=list(rows_by_pid)).delete()
+        SimilarProduct.objects.bulk_create([
+            SimilarProduct(product_id=pid, neighbor_id=neighbor, score=score, rank=rank)
+            for pid, neighbors in rows_by_pid.items()
+            for rank, (neighbor, score) in enumerate(neighbors)
+        ], batch_size=1000)
+    versions.bump(versions.SIMILAR)
+
+
+def build_similar_products(top_k=None, chunk_size=1000, model=None):
+    """
+    Rebuild the whole SimilarProduct table from `model` (default: the live
+    one, trained here if there is none; this is an offline job).
+    Products are queried against the neighbour engine in blocks (for the
+    brute engine one sparse product per block) instead of one
+    kneighbors() call per product. Each block's lists are replaced in a
+    transaction of their own, so site writes wait for one block at a time,
+    never for the whole table. Returns the number of rows written.
+    """
+    model = model or current_model() or train_model()
+    if model is None:
+        return 0
+
+    top_k = top_k or settings.SIMILAR_PRODUCTS_TOP_K
+    matrix = model.matrix.tocsr()
+    pids = model.pids
+    live = set(Product.objects.values_list('pid', flat=True))
+    keep = np.array([pid in live for pid in pids], dtype=bool)
+    # Ask for enough neighbours to survive dropping the product itself and dead rows
+    n_neighbors = top_k + 1 + int((~keep).sum())
+
+    written = 0
+    for start in range(0, matrix.shape[0], chunk_size):
+        distances, indices = model.knn_model.kneighbors(
+            matrix[start:start + chunk_size], n_neighbors=n_neighbors
+        )
+        batch = []
+        for offset, (dist, idx) in enumerate(zip(distances, indices)):
+            i = start + offset
+            if not keep[i]:
+                continue
+            mask = (idx != i) & keep[idx]
+            for rank, (j, d) in enumerate(zip(idx[mask][:top_k], dist[mask][:top_k])):
+                batch.append(SimilarProduct(
+                    product_id=pids[i], neighbor_id=pids[j],
+                    score=float(1 - d), rank=rank,
+                ))
+        with transaction.atomic():
+            SimilarProduct.objects.filter(product_id__in=list(pids[start:start + chunk_size])).delete()
+            SimilarProduct.objects.bulk_create(batch, batch_size=1000)
+        written += len(batch)
+    versions.bump(versions.SIMILAR)
+    return written
+
+
+def _rescored_row(model, pid, top_k, override=None, exclude=()):
+    """Recompute one product's neighbour list from its model row."""
+    i = model.pid_index.get(pid)
+    if i is None:
+        return None
+    sims = _row_sims(model, model.matrix[i])
+    sims[i] = 0.0
+    pairs = {model.pids[j]: float(sims[j]) for j in np.flatnonzero(sims > 0)}
+    pairs.update(override or {})
+    pairs.pop(pid, None)
+    return _live_top_k(pairs.items(), top_k, exclude=exclude)
+
+
+def refresh_similar_products(product, top_k=None):
+    """
+    Patch the SimilarProduct table after `product` was created or edited:
+    its own list is recomputed, and it is inserted into (or rescored out of)
+    other lists. Only lists it beats the last-place (k-th) score of, lists
+    not yet full, and lists that held it before are read and rewritten;
+    the rest of the catalog is left alone, however many terms it shares.
+    """
+    model = current_model()
+    if model is None:
+        return
+
+    top_k = top_k or settings.SIMILAR_PRODUCTS_TOP_K
+    pid = product.pid
+    sims = _row_sims(model, model.vectorizer.transform([_product_text(product)]))
+    own = model.pid_index.get(pid)
+    if own is not None:
+        sims[own] = 0.0  # the model's copy of this product may be stale
+    cols = np.flatnonzero(sims > 0)
+    touched = {model.pids[i]: float(sims[i]) for i in cols}
+
+    updates = {pid: _live_top_k(touched.items(), top_k)}
+
+    def rank(pair):  # best score first, then pid, as in _live_top_k
+        return -pair[1], pair[0]
+
+    # Lists it may enter: full ones whose cut-off it now beats, and short ones.
+    # Lists it may leave: the ones that held it before the edit.
+    candidates = set(SimilarProduct.objects.filter(neighbor_id=pid).values_list('product_id', flat=True))
+    if touched:
+        cutoffs = SimilarProduct.objects.filter(rank=top_k - 1, score__lte=max(touched.values()))
+        for owner, score in cutoffs.values_list('product_id', 'score'):
+            if touched.get(owner, 0.0) >= score:  # ties are settled below, with the whole list
+                candidates.add(owner)
+        full = SimilarProduct.objects.filter(rank=top_k - 1).values('product_id')
+        short = Product.objects.exclude(pid__in=full).values_list('pid', flat=True)
+        candidates.update(owner for owner in short if owner in touched)
+    candidates.discard(pid)
+
+    current = defaultdict(list)
+    for owner, neighbor, score in SimilarProduct.objects.filter(
+        product_id__in=list(candidates)
+    ).values_list('product_id', 'neighbor_id', 'score'):
+        current[owner].append((neighbor, score))
+    live = set(Product.objects.filter(pid__in=list(candidates)).values_list('pid', flat=True))
+
+    for other in live:
+        entries = current.get(other, [])
+        entry = (pid, touched.get(other, 0.0))
+        others = [(n, s) for n, s in entries if n != pid]
+        was_listed = len(others) != len(entries)
+        if was_listed and len(entries) >= top_k and (entry[1] <= 0 or rank(entry) > max(map(rank, entries))):
+            # It dropped below the old cut-off, so the replacement is not in the table
+            row = _rescored_row(model, other, top_k, override={pid: entry[1]})
+            if row is not None:
+                updates[other] = row
+        elif entry[1] > 0 and (len(others) < top_k or rank(entry) < max(map(rank, others))):
+            updates[other] = sorted(others + [entry], key=rank)[:top_k]
+        elif was_listed:
+            updates[other] = others
+
+    _write_similar_rows(updates)
+
+
+def refill_similar_products(pids, removed_pid, top_k=None):
+    """Recompute the lists that referenced a deleted product."""
+    model = current_model()
+    if model is None:
+        return
+    top_k = top_k or settings.SIMILAR_PRODUCTS_TOP_K
+    updates = {}
+    for pid in pids:
+        row = _rescored_row(model, pid, top_k, exclude={removed_pid})
+        if row is not None:
+            updates[pid] = row
+    if updates:
+        _write_similar_rows(updates)
+
+
+def similar_products_for(product, top_n=4):
+    """Neighbours from the SimilarProduct table, falling back to a live KNN query."""
+    similar = list(
+        Product.objects.filter(
+            neighbor_of__product=product, neighbor_of__rank__lt=top_n
+        ).order_by('neighbor_of__rank')
+    )
+    if similar:
+        return similar
+    return knn_similar_products(product, top_n=top_n)
 
 
 # ------------------------------
 # USER SEEDS (history, cart, orders, views) with weights
 # ------------------------------
-def _user_seeds(user):
+def normalize_query(query):
+    """Case- and whitespace-insensitive form of a search query."""
+    return " ".join(query.lower().split())
+
+
+def _user_seeds(user, model=None, as_of=None):
+    """
+    (pid, weight) seeds for a user. Uses one query per source (search
+    history, cart/orders, views) however long the history is; products are
+    only fetched later, for the final recommendations. Text searches only
+    seed once a model is loaded.
+    With `as_of`, only interactions from before that time count (replay).
+    """
+    model = model or current_model()
+    searches = SearchHistory.objects.filter(user=user)
+    carts = cartOrderItem.objects.filter(
+        user=user, order__order_status__in=("processing", "completed"), item__isnull=False
+    )
+    views = ProductView.objects.filter(user=user)
+    if as_of is not None:
+        searches = searches.filter(timestamp__lt=as_of)
+        carts = carts.filter(order__order_date__lt=as_of)
+        views = views.filter(viewed_at__lt=as_of)
+
     seeds = []
     # From search history (weight 1.0)
-    for sh in SearchHistory.objects.filter(user=user):
-        if sh.product:  # product search
-            seeds.append((sh.product.pid, 1.0))
-        elif sh.query:  # text-based search → find similar products
-            # Vectorize query and find nearest neighbors
-            if _knn_model is None or _feature_matrix is None:
-                train_model()
-            query_vec = _vectorizer.transform([sh.query])
-            distances, indices = _knn_model.kneighbors(query_vec, n_neighbors=5)
-            for i, d in zip(indices[0], distances[0]):
-                pid = _product_ids[i]
-                seeds.append((pid, 0.8 * (1 - d)))  # smaller weight than exact product
-                
-    # Active cart (weight 2.0)
-    for pid in cartOrderItem.objects.filter(
-        user=user, order__order_status="processing"
-    ).values_list('item__pid', flat=True):
-        seeds.append((pid, 2.0))
-        
-    # Completed orders (weight 2.0)
-    for pid in cartOrderItem.objects.filter(
-        user=user, order__order_status="completed"
-    ).values_list('item__pid', flat=True):
-        
-        seeds.append((pid, 2.0))
+    with metrics.span("seeds.search_history"):
+        history = list(searches.values_list('product_id', 'query'))
+    for product_id, query in history:
+        if product_id:  # product search
+            seeds.append((product_id, 1.0))
+        elif query and model is not None:  # text-based search → find similar products
+            # Vectorize query and find nearest neighbors (cached per query text)
+            for pid, similarity in model.query_neighbors(normalize_query(query)):
+                seeds.append((pid, 0.8 * similarity))  # smaller weight than exact product
+
+    # Active cart and completed orders (weight 2.0)
+    with metrics.span("seeds.cart_orders"):
+        seeds.extend((pid, 2.0) for pid in carts.values_list('item_id', flat=True))
+
     # Recently viewed (weight 1.5)
-    for pid in ProductView.objects.filter(user=user).values_list('product__pid', flat=True):
-        seeds.append((pid, 1.5))
+    with metrics.span("seeds.product_views"):
+        seeds.extend((pid, 1.5) for pid in views.values_list('product_id', flat=True))
+
     # Remove duplicates, keep max weight per product
     seed_dict = {}
     for pid, w in seeds:
@@ -100,39 +968,30 @@ def _user_seeds(user):
             seed_dict[pid] = max(seed_dict[pid], w)
         else:
             seed_dict[pid] = w
-    # Return list of tuples (Product, weight)
-    seed_list = []
-    for pid, weight in seed_dict.items():
-        try:
-            product = Product.objects.get(pid=pid)
-            seed_list.append((product, weight))
-        except Product.DoesNotExist:
-            continue
-    return seed_list
-
-
-
-
+    metrics.observe("recommend.seeds_per_user", len(seed_dict))
+    return list(seed_dict.items())
 
 
 # ------------------------------
 # Similar product recommender
 # ------------------------------
+@metrics.timed("knn_similar_products")
 def knn_similar_products(product, top_n=4):
-    global _knn_model, _feature_matrix, _product_ids, _vectorizer
-
-    if _knn_model is None or _feature_matrix is None:
-        train_model()
+    model = ensure_model()
+    if model is None:
+        return Product.objects.none()
 
-    if product.pid not in _product_ids:
+    idx = model.pid_index.get(product.pid)
+    if idx is None:
         return Product.objects.none()
 
-    idx = _product_ids.index(product.pid)
-    query_vec = _feature_matrix[idx]
+    query_vec = model.matrix[idx]
 
-    distances, indices = _knn_model.kneighbors(query_vec, n_neighbors=top_n + 1)
-    similar_indices = indices[0][1:]
-    similar_pids = [_product_ids[i] for i in similar_indices]
+    metrics.incr("knn.calls")
+    with metrics.span("knn.kneighbors"):
+        distances, indices = model.knn_model.kneighbors(query_vec, n_neighbors=top_n + 1)
+    similar_indices = [i for i in indices[0] if i != idx][:top_n]
+    similar_pids = [model.pids[i] for i in similar_indices]
 
     return Product.objects.filter(pid__in=similar_pids)
 
@@ -140,49 +999,134 @@ def knn_similar_products(product, top_n=4):
 # ------------------------------
 # Hybrid recommender for user with weighted seeds
 # ------------------------------
-def recommend_for_user(user, top_n=8):
+def _score_seeds(model, seeds, top_n, exclude_pids):
+    """
+    Rank catalog products for a set of (row, weight) seeds in one pass.
+
+    Same semantics as one kneighbors() call per seed: each seed contributes
+    its top_n nearest products (itself excluded) scored weight * cosine
+    similarity, cart items are dropped afterwards, and the best top_n
+    entries win. All seed rows go to the neighbour engine in a single
+    batched query (one sparse product for the brute engine) and the final
+    cut uses argpartition.
+    """
+    if not seeds:
+        return []
+    rows = np.array([row for row, _ in seeds])
+    weights = np.array([weight for _, weight in seeds], dtype=np.float64)
+
+    metrics.incr("knn.calls")
+    with metrics.span("knn.kneighbors"):
+        distances, indices = model.knn_model.kneighbors(model.matrix[rows], n_neighbors=top_n + 1)
+    cols, scores = [], []
+    for row, weight, dist, idx in zip(rows, weights, distances, indices):
+        keep = idx != row
+        cols.append(idx[keep][:top_n])
+        scores.append(weight * (1.0 - dist[keep][:top_n]))
+    cols, scores = np.concatenate(cols), np.concatenate(scores)
+    metrics.incr("recommend.candidates_scored", len(cols))
+
+    # Cart items are excluded after neighbour selection, as before
+    if exclude_pids:
+        pid_index = model.pid_index
+        excluded = np.zeros(model.matrix.shape[0], dtype=bool)
+        excluded[[pid_index[pid] for pid in exclude_pids if pid in pid_index]] = True
+        keep = ~excluded[cols]
+        cols, scores = cols[keep], scores[keep]
+
+    if len(scores) > top_n:
+        part = np.argpartition(-scores, top_n - 1)[:top_n]
+        cols, scores = cols[part], scores[part]
+    top_pids = []
+    for i in np.argsort(-scores, kind='stable'):
+        pid = str(model.pids[cols[i]])
+        if pid not in top_pids:
+            top_pids.append(pid)
+    return top_pids
+
+
+def recommendation_cache_key(user_id):
+    return f"recs:{user_id}"
+
+
+def invalidate_recommendations(user_id):
+    """Forget a user's cached ranking; called when one of their seed signals changes."""
+    cache.delete(recommendation_cache_key(user_id))
+
+
+def _recommend_pids(user, top_n, model, as_of=None):
+    in_cart = cartOrderItem.objects.filter(user=user, order__order_status='processing')
+    catalog = Product.objects.all()
+    if as_of is not None:
+        # Replay: only what existed and was in the cart at that time
+        in_cart = in_cart.filter(order__order_date__lt=as_of)
+        catalog = catalog.filter(created_at__lt=as_of)
+
+    # Exclude items already in cart
+    with metrics.span("recommend.cart_exclusion"):
+        exclude_pids = set(in_cart.values_list('item__pid', flat=True))
+    # Collect seeds (pid, weight)
+    with metrics.span("recommend.user_seeds"):
+        seed_pids = _user_seeds(user, model, as_of=as_of)
+    if not seed_pids:
+        # Fallback for cold-start users
+        return list(
+            catalog.exclude(pid__in=exclude_pids)
+            .order_by("-created_at").values_list('pid', flat=True)[:top_n]
+        )
+
+    top_pids = []
+    if model is not None:
+        pid_index = model.pid_index
+        seeds = [(pid_index[pid], weight) for pid, weight in seed_pids if pid in pid_index]
+        with metrics.span("recommend.score_seeds"):
+            top_pids = _score_seeds(model, seeds, top_n, exclude_pids)
+
+    if len(top_pids) < top_n:
+        with metrics.span("recommend.newest_filler"):
+            top_pids.extend(
+                catalog.exclude(pid__in=exclude_pids | set(top_pids))
+                .order_by('-created_at').values_list('pid', flat=True)[:top_n - len(top_pids)]
+            )
+    return top_pids
+
+
+@metrics.timed("recommend_for_user")
+def recommend_for_user(user, top_n=8, use_cache=True, as_of=None):
+    """
+    Ranked recommendations for a user. The ranked pid list is cached per
+    user until one of their seeds changes (see hardware.signals), the model
+    version changes, or RECOMMENDATION_CACHE_TIMEOUT passes, so a repeat
+    visit costs one cache lookup and one product fetch. While no model is
+    loaded yet the newest products are served instead.
+
+    `as_of` rebuilds the user's state at a past time: only earlier history,
+    carts and products are used, and the cache is bypassed (see
+    hardware.replay).
+    """
     if not user.is_authenticated:
         # Guest user fallback
         return Product.objects.all().order_by("-created_at")[:top_n]
 
-    # Exclude items already in cart
-    exclude_pids = set(
-        cartOrderItem.objects.filter(user=user, order__order_status='processing')
-        .values_list('item__pid', flat=True)
-    )
-    # Collect seeds (Product, weight)
-    seed_products = _user_seeds(user)
-    if not seed_products:
-        # Fallback for cold-start users
-        return Product.objects.exclude(pid__in=exclude_pids).order_by("-created_at")[:top_n]
-
-    if _knn_model is None or _feature_matrix is None:
-        train_model()
-    scored = []
-    for seed, weight in seed_products:
-        if seed.pid not in _product_ids:
-            continue
-        idx = _product_ids.index(seed.pid)
-        query_vec = _feature_matrix[idx]
-
-        distances, indices = _knn_model.kneighbors(query_vec, n_neighbors=top_n + 1)
-        for i, d in zip(indices[0][1:], distances[0][1:]):
-            pid = _product_ids[i]
-            if pid not in exclude_pids:
-                # Multiply similarity by seed weight
-                scored.append((weight * (1 - d), pid))
-    # Rank by weighted similarity
-    scored.sort(key=lambda x: -x[0])
-    top_pids = [pid for _, pid in scored[:top_n]]
-    # Convert queryset to list
-    recommended = list(Product.objects.filter(pid__in=top_pids))
-    
-    
-    if len(recommended) < top_n:
-        extra = top_n - len(recommended)
-        extra_qs = Product.objects.exclude(
-            pid__in=exclude_pids | {p.pid for p in recommended}
-        ).order_by('-created_at')[:extra]
-        recommended.extend(extra_qs)
-
-    return recommended
+    model = ensure_model()
+    version = model.version if model is not None else None
+    use_cache = use_cache and as_of is None
+    key = recommendation_cache_key(user.pk)
+    cached = cache.get(key) if use_cache else None
+    if cached and cached["version"] == version and cached["top_n"] == top_n:
+        metrics.incr("recommend.cache_hit")
+        top_pids = cached["pids"]
+    else:
+        metrics.incr("recommend.cache_miss")
+        top_pids = _recommend_pids(user, top_n, model, as_of=as_of)
+        if use_cache and model is not None:
+            cache.set(
+                key,
+                {"version": version, "top_n": top_n, "pids": top_pids},
+                settings.RECOMMENDATION_CACHE_TIMEOUT,
+            )
+
+    # Fetch in one query and keep the ranked order
+    with metrics.span("recommend.fetch_products"):
+        by_pid = Product.objects.in_bulk(top_pids)
+    return [by_pid[pid] for pid in top_pids if pid in by_pid]
@@ -0,0 +1,138 @@
+"""
+Offline replay of recommend_for_user against the real interaction logs.
+
+Every ProductView (viewed_at) and carted cartOrderItem (its order's
+order_date) is a replay point: the user's state is rebuilt as of just
+before that moment with recommend_for_user(..., as_of=T), and the call
+is a hit if the product they viewed or carted next is in the top N.
+Besides hit-rate@N and MRR, the end-to-end latency of every call
+(seeds, scoring and product fetch) is recorded.
+
+The run works on a read-only copy of the database, taken with SQLite's
+online backup so the live site can keep writing. The model is trained
+once on that copy and saved as an artifact. Users are then split across
+spawned worker processes, which memory-map the artifact and open the
+copy with mode=ro. Workers are pinned to that build (recommender.pin_model),
+so a refit published on the live site mid-run does not reach them.
+
+The model is trained on the catalog at snapshot time, so product text
+from after T is visible; history, carts and fallback products are
+restricted to before T.
+"""
+import os
+import sqlite3
+import stat
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+import numpy as np
+
+
+def snapshot_database(source, directory):
+    """Consistent copy of the SQLite file `source` in `directory`, made read-only. Returns its path."""
+    target = os.path.join(directory, "replay.sqlite3")
+    src = sqlite3.connect(f"file:{source}?mode=ro", uri=True)
+    dst = sqlite3.connect(target)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+    os.chmod(target, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+    return target
+
+
+def use_snapshot(path):
+    """Point the default database alias at `path`, opened read-only."""
+    from django.db import connections
+
+    connection = connections["default"]
+    connection.close()
+    connection.settings_dict["NAME"] = f"file:{path}?mode=ro"
+
+
+def replay_points(per_user=5, min_history=1, max_users=None):
+    """
+    {user_id: [(T, pid, kind), ...]}: each user's last `per_user` views and
+    cart additions that had at least `min_history` earlier interactions.
+    """
+    from hardware.models import ProductView, SearchHistory, cartOrderItem
+
+    events = defaultdict(list)  # user -> [(time, pid or None, kind)]
+    for user_id, pid, at in ProductView.objects.values_list("user_id", "product_id", "viewed_at"):
+        events[user_id].append((at, pid, "view"))
+    for user_id, pid, at in cartOrderItem.objects.filter(
+        item__isnull=False, order__isnull=False, user__isnull=False
+    ).values_list("user_id", "item_id", "order__order_date"):
+        events[user_id].append((at, pid, "cart"))
+    for user_id, at in SearchHistory.objects.values_list("user_id", "timestamp"):
+        events[user_id].append((at, None, "search"))  # history only, never a target
+
+    points = {}
+    for user_id in sorted(events):
+        timeline = sorted(events[user_id], key=lambda e: e[0])
+        times = [at for at, _, _ in timeline]
+        targets = [
+            (at, pid, kind) for at, pid, kind in timeline
+            if pid is not None and bisect_left(times, at) >= min_history
+        ]
+        if targets:
+            points[user_id] = targets[-per_user:]
+        if max_users and len(points) >= max_users:
+            break
+    return points
+
+
+# ------------------------------
+# WORKERS (spawned; Django is set up in _init_worker)
+# ------------------------------
+def _init_worker(db_path, artifact_dir, version):
+    import django
+    django.setup()
+    use_snapshot(db_path)
+    from hardware import recommender
+    if recommender.load_artifact(version=version, directory=artifact_dir) != version:
+        raise RuntimeError(f"Could not load replay model {version} from {artifact_dir}.")
+    recommender.pin_model()  # a refit on the live site moves CURRENT, not this run's model
+
+
+def replay_user(task):
+    """Replay one user's points. Returns [(kind, rank or None, latency seconds), ...]."""
+    from hardware import recommender
+    from userauths.models import User
+
+    user_id, points, top_n = task
+    user = User.objects.get(pk=user_id)
+    results = []
+    for at, pid, kind in points:
+        started = time.perf_counter()
+        products = recommender.recommend_for_user(user, top_n=top_n, as_of=at)
+        elapsed = time.perf_counter() - started
+        ranked = [p.pid for p in products]
+        results.append((kind, ranked.index(pid) + 1 if pid in ranked else None, elapsed))
+    return results
+
+
+def summarize(results, top_n):
+    """Hit-rate@N, MRR and latency percentiles, overall and per target kind."""
+    def block(rows):
+        if not rows:
+            return {"calls": 0}
+        ranks = [rank for _, rank, _ in rows]
+        ms = np.array([latency for _, _, latency in rows]) * 1000
+        p50, p95, p99 = np.percentile(ms, (50, 95, 99))
+        return {
+            "calls": len(rows),
+            f"hit_rate@{top_n}": round(sum(r is not None for r in ranks) / len(rows), 4),
+            "mrr": round(sum(1 / r for r in ranks if r) / len(rows), 4),
+            "latency_p50_ms": round(float(p50), 3),
+            "latency_p95_ms": round(float(p95), 3),
+            "latency_p99_ms": round(float(p99), 3),
+            "latency_mean_ms": round(float(ms.mean()), 3),
+        }
+
+    summary = {"all": block(results)}
+    for kind in sorted({kind for kind, _, _ in results}):
+        summary[kind] = block([row for row in results if row[0] == kind])
+    return summary
@@ -0,0 +1,398 @@
+"""
+Full-text product search on SQLite FTS5.
+
+hardware_product_fts holds one row per product (rowid = the product's
+rowid) with its name, description, specification and category name,
+tokenized with the porter stemmer. Triggers on hardware_product and
+hardware_category keep it in sync, whatever path the write takes (ORM,
+bulk_create, admin, raw SQL). Matches are ranked by bm25, with name
+hits weighted above category hits, and those above description and
+specification hits.
+
+SQLite drops a table's triggers when a migration rebuilds the table, and
+VACUUM may renumber rowids. So ensure_index() runs after every migrate:
+it reinstalls anything missing and rebuilds the index if it has drifted.
+On other database vendors there is no index, and search falls back to
+LIKE on the same fields.
+
+Results are paged with keyset cursors: every row has a (score, pid) sort
+key, and the next page starts strictly after the last key shown. So page
+50 costs what page 1 does (no OFFSET to skip over), and a product added
+or removed ahead of the cursor does not push the rest along by one.
+Ranked pages are not a snapshot, though: bm25 scores depend on corpus
+statistics (term rarity, average field length), so a catalog write
+between requests can move a result across the cursor, onto two pages or
+onto none. Browsing (no query) sorts by pid alone and is stable.
+
+Pages are cached (ranked pids, next cursor and the recommendation strip)
+under the normalized (query, category, cursor) and the catalog version.
+Every Product or Category write bumps the version, so a cached page
+never outlives the catalog it was computed from. A hot query then costs
+one product fetch.
+"""
+import base64
+import binascii
+import hashlib
+import json
+import re
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection as default_connection
+from django.db.models import Q
+
+from django.db.models.expressions import RawSQL
+
+from hardware import facets, metrics, versions
+from hardware.models import Category, Product
+
+FTS_TABLE = "hardware_product_fts"
+
+# bm25 column weights, in table column order (pid is UNINDEXED)
+WEIGHTS = {"pid": 0.0, "name": 10.0, "description": 1.0, "specification": 1.0, "category": 3.0}
+
+_DOCUMENT = """
+    SELECT p.rowid, p.pid, p.name, p.description, p.specification, c.name
+    FROM hardware_product p LEFT JOIN hardware_category c ON c.id = p.category_id
+"""
+
+TRIGGERS = {
+    "hardware_product_fts_insert": f"""
+        CREATE TRIGGER hardware_product_fts_insert AFTER INSERT ON hardware_product BEGIN
+            INSERT INTO {FTS_TABLE} (rowid, pid, name, description, specification, category)
+            VALUES (new.rowid, new.pid, new.name, new.description, new.specification,
+                    (SELECT name FROM hardware_category WHERE id = new.category_id));
+        END
+    """,
+    "hardware_product_fts_update": f"""
+        CREATE TRIGGER hardware_product_fts_update
+        AFTER UPDATE OF pid, name, description, specification, category_id ON hardware_product BEGIN
+            DELETE FROM {FTS_TABLE} WHERE rowid = old.rowid;
+            INSERT INTO {FTS_TABLE} (rowid, pid, name, description, specification, category)
+            VALUES (new.rowid, new.pid, new.name, new.description, new.specification,
+                    (SELECT name FROM hardware_category WHERE id = new.category_id));
+        END
+    """,
+    "hardware_product_fts_delete": f"""
+        CREATE TRIGGER hardware_product_fts_delete AFTER DELETE ON hardware_product BEGIN
+            DELETE FROM {FTS_TABLE} WHERE rowid = old.rowid;
+        END
+    """,
+    "hardware_category_fts_rename": f"""
+        CREATE TRIGGER hardware_category_fts_rename AFTER UPDATE OF name ON hardware_category BEGIN
+            UPDATE {FTS_TABLE} SET category = new.name
+            WHERE rowid IN (SELECT rowid FROM hardware_product WHERE category_id = new.id);
+        END
+    """,
+}
+
+
+# ------------------------------
+# INDEX MAINTENANCE
+# ------------------------------
+def _existing(cursor, kind):
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = %s", [kind])
+    return {row[0] for row in cursor.fetchall()}
+
+
+def rebuild_index(connection=None):
+    """Refill the index from hardware_product. Returns the number of rows indexed."""
+    connection = connection or default_connection
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE}")
+        cursor.execute(
+            f"INSERT INTO {FTS_TABLE} (rowid, pid, name, description, specification, category) {_DOCUMENT}"
+        )
+        cursor.execute(f"SELECT count(*) FROM {FTS_TABLE}")
+        return cursor.fetchone()[0]
+
+
+def install_index(connection=None):
+    """Create the FTS table and triggers (SQLite only) and fill the index. Returns the rows indexed."""
+    connection = connection or default_connection
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+            "pid UNINDEXED, name, description, specification, category, "
+            "tokenize = 'porter unicode61')"
+        )
+        for name, sql in TRIGGERS.items():
+            cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+            cursor.execute(sql)
+    return rebuild_index(connection)
+
+
+def uninstall_index(connection=None):
+    connection = connection or default_connection
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        for name in TRIGGERS:
+            cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+        cursor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+
+
+def index_available(connection=None):
+    connection = connection or default_connection
+    if connection.vendor != "sqlite":
+        return False
+    with connection.cursor() as cursor:
+        return FTS_TABLE in _existing(cursor, "table")
+
+
+def ensure_index(sender=None, using="default", **kwargs):
+    """
+    post_migrate receiver: put back triggers that a table rebuild dropped,
+    and resync the index if its rowids no longer match the products.
+    """
+    from django.db import connections
+    connection = connections[using]
+    if not index_available(connection):
+        return
+    with connection.cursor() as cursor:
+        missing = set(TRIGGERS) - _existing(cursor, "trigger")
+        cursor.execute(
+            f"SELECT count(*) FROM hardware_product p LEFT JOIN {FTS_TABLE} f "
+            "ON f.rowid = p.rowid AND f.pid = p.pid WHERE f.rowid IS NULL"
+        )
+        drifted = cursor.fetchone()[0]
+    if missing or drifted:
+        install_index(connection)
+
+
+# ------------------------------
+# QUERIES
+# ------------------------------
+def match_expression(query):
+    """
+    FTS5 MATCH string for free text: every word must match, as a prefix,
+    so "dril bos" finds "Bosch drill". Returns None if the text has no words.
+    """
+    words = re.findall(r"\w+", query.lower())
+    if not words:
+        return None
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def ranked_pids(query, category_name=None, limit=None, after=None, within=None):
+    """
+    [(pid, score)] of products matching `query`, best first. Lower scores
+    are better (bm25), and ties are broken by pid. `after` is the (score,
+    pid) of the last row already shown; `within` a Product queryset the
+    results must belong to (facet filters). Falls back to LIKE (score 0)
+    where FTS5 is unavailable.
+    """
+    expression = match_expression(query)
+    if expression is None:
+        return []
+    if not index_available():
+        return _like_pids(query, category_name, limit, after, within)
+
+    # bm25() is only allowed next to the MATCH, so the cursor filters the ranked subquery
+    weights = ", ".join(str(w) for w in WEIGHTS.values())
+    sql = [
+        f"SELECT pid, score FROM (SELECT pid, bm25({FTS_TABLE}, {weights}) AS score "
+        f"FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s"
+    ]
+    params = [expression]
+    if category_name:
+        sql.append("AND category = %s")
+        params.append(category_name)
+    if within is not None:
+        within_sql, within_params = within.values("pid").query.sql_with_params()
+        sql.append(f"AND pid IN ({within_sql})")
+        params.extend(within_params)
+    sql.append(")")
+    if after:
+        sql.append("WHERE score > %s OR (score = %s AND pid > %s)")
+        params.extend([after[0], after[0], after[1]])
+    sql.append("ORDER BY score, pid")
+    if limit:
+        sql.append("LIMIT %s")
+        params.append(limit)
+    with default_connection.cursor() as cursor:
+        cursor.execute(" ".join(sql), params)
+        return cursor.fetchall()
+
+
+def _like_q(query):
+    return (
+        Q(name__icontains=query) | Q(description__icontains=query) | Q(specification__icontains=query)
+        | Q(category__name__icontains=query)
+    )
+
+
+def _like_pids(query, category_name, limit, after=None, within=None):
+    products = Product.objects.filter(_like_q(query))
+    if within is not None:
+        products = products.filter(pid__in=within.values("pid"))
+    return _browse_pids(products, category_name, limit, after)
+
+
+def _browse_pids(products, category_name, limit, after):
+    """[(pid, 0.0)] of `products` in pid order, after the cursor."""
+    if category_name:
+        products = products.filter(category__name=category_name)
+    if after:
+        products = products.filter(pid__gt=after[1])
+    pids = products.order_by("pid").values_list("pid", flat=True)
+    return [(pid, 0.0) for pid in (pids[:limit] if limit else pids)]
+
+
+def matching_products(query, category_name=None):
+    """Unranked queryset of what `query` matches (everything when it is blank), for facet counts."""
+    products = Product.objects.all()
+    if category_name:
+        products = products.filter(category__name=category_name)
+    if not query.strip():
+        return products
+    expression = match_expression(query)
+    if expression is None:
+        return products.none()
+    if not index_available():
+        return products.filter(_like_q(query))
+    return products.filter(pid__in=RawSQL(f"SELECT pid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s", [expression]))
+
+
+def search_products(query, category_name=None, limit=None):
+    """Matching products in rank order (one FTS query plus one product fetch)."""
+    return _fetch(ranked_pids(query, category_name, limit))
+
+
+def _fetch(ranked):
+    by_pid = Product.objects.select_related("category").in_bulk([pid for pid, _ in ranked])
+    return [by_pid[pid] for pid, _ in ranked if pid in by_pid]
+
+
+# ------------------------------
+# PAGINATION
+# ------------------------------
+def encode_cursor(*key):
+    """Opaque, URL-safe token for a sort key of JSON values, such as (score, pid)."""
+    raw = json.dumps(list(key), separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_key(token, length):
+    """The sort key list from encode_cursor(), or None if `token` is missing, malformed or not `length` long."""
+    if not token:
+        return None
+    try:
+        key = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except (binascii.Error, ValueError):
+        return None
+    return key if isinstance(key, list) and len(key) == length else None
+
+
+def decode_cursor(token):
+    """(score, pid) from encode_cursor(), or None if `token` is missing or malformed."""
+    key = decode_key(token, 2)
+    try:
+        return (float(key[0]), str(key[1])) if key else None
+    except (ValueError, TypeError):
+        return None
+
+
+def page_pids(query, category_name=None, after=None, size=None, filters=None):
+    """
+    One page of results as ([(pid, score)], next_cursor). With no query
+    the catalog is listed in pid order. `filters` are selected facets
+    (see hardware.facets). next_cursor is None on the last page.
+    """
+    size = size or settings.SEARCH_PAGE_SIZE
+    within = Product.objects.filter(facets.filter_q(filters, cached_categories())) if filters else None
+    if query.strip():
+        ranked = ranked_pids(query, category_name, limit=size + 1, after=after, within=within)
+    else:
+        ranked = _browse_pids(within if within is not None else Product.objects.all(), category_name, size + 1, after)
+    next_cursor = None
+    if len(ranked) > size:
+        ranked = ranked[:size]
+        last_pid, last_score = ranked[-1]
+        next_cursor = encode_cursor(last_score, last_pid)
+    return ranked, next_cursor
+
+
+def search_page(query, category_name=None, after=None, size=None, filters=None):
+    """One page of results: (products, next_cursor)."""
+    ranked, next_cursor = page_pids(query, category_name, after, size, filters)
+    return _fetch(ranked), next_cursor
+
+
+# ------------------------------
+# RESULT CACHE
+# ------------------------------
+def catalog_version():
+    """Counter bumped on every Product/Category write; part of every result cache key."""
+    return versions.current(versions.CATALOG)
+
+
+def result_cache_key(version, query, category_name, after, filters=None, kind="page"):
+    browse = not query.strip()  # lists the catalog, whereas "?!" matches nothing
+    words = " ".join(re.findall(r"\w+", query.lower()))
+    raw = json.dumps([
+        kind, browse, words, category_name or "", after and list(after), sorted((filters or {}).items()),
+        settings.SEARCH_PAGE_SIZE,
+    ])
+    return f"search:{version}:{hashlib.md5(raw.encode()).hexdigest()}"
+
+
+def _recommended_pids(first_pid, exclude):
+    """A few other products from the category of the first result; `exclude` is a pid list or subquery."""
+    first = Product.objects.filter(pid=first_pid).values("category")[:1]
+    return list(
+        Product.objects.filter(category=first).exclude(pid__in=exclude)
+        .order_by("pid").values_list("pid", flat=True)[:settings.SEARCH_RECOMMENDATION_LIMIT]
+    )
+
+
+def cached_results(query, category_name=None, after=None, filters=None):
+    """
+    What the search view shows: (products, next_cursor, recommended_products).
+    On a cache hit the only query is the fetch of those products.
+    """
+    key = result_cache_key(catalog_version(), query, category_name, after, filters)
+    hit = cache.get(key)
+    if hit is None:
+        metrics.incr("search.cache_miss")
+        ranked, next_cursor = page_pids(query, category_name, after, filters=filters)
+        pids = [pid for pid, _ in ranked]
+        # Nothing the search matched, on this page or any other
+        matched = matching_products(query, category_name)
+        if filters:
+            matched = matched.filter(facets.filter_q(filters, cached_categories()))
+        recommended = _recommended_pids(pids[0], matched.values("pid")) if pids else []
+        hit = (pids, next_cursor, recommended)
+        cache.set(key, hit, settings.SEARCH_CACHE_TIMEOUT)
+    else:
+        metrics.incr("search.cache_hit")
+
+    pids, next_cursor, recommended = hit
+    by_pid = Product.objects.select_related("category").in_bulk(pids + recommended)
+    return (
+        [by_pid[pid] for pid in pids if pid in by_pid],
+        next_cursor,
+        [by_pid[pid] for pid in recommended if pid in by_pid],
+    )
+
+
+def cached_categories():
+    """All categories, for the search filter; cached until the catalog changes."""
+    key = f"search:{catalog_version()}:categories"
+    categories = cache.get(key)
+    if categories is None:
+        categories = list(Category.objects.all())
+        cache.set(key, categories, settings.SEARCH_CACHE_TIMEOUT)
+    return categories
+
+
+def cached_facets(query, category_name=None, filters=None):
+    """Facet counts (see facets.facet_counts) for a search; one query on a miss."""
+    key = result_cache_key(catalog_version(), query, category_name, None, filters, kind="facets")
+    counts = cache.get(key)
+    if counts is None:
+        counts = facets.facet_counts(matching_products(query, category_name), filters or {}, cached_categories())
+        cache.set(key, counts, settings.SEARCH_CACHE_TIMEOUT)
+    return counts
@@ -0,0 +1,112 @@
+"""
+Write-behind logging of search queries into SearchHistory.
+
+The search view used to INSERT one row per search, taking SQLite's
+write lock inside the request. Now log_search() only appends to an
+in-process buffer and returns. A background thread writes the buffer
+with one bulk_create every SEARCH_LOG_BATCH_SIZE entries or
+SEARCH_LOG_FLUSH_MS milliseconds, whichever comes first, and the rest
+is flushed when the process exits.
+
+Entries are coalesced: the same user searching the same text again
+before the next flush (a double submit, a reload) is one row. If the
+buffer is full (the database is stuck), new entries are dropped rather
+than letting memory grow, and counted.
+
+bulk_create sends no post_save, so the flush itself invalidates the
+cached recommendations of the users it wrote for. Rows are stamped
+(auto_now_add) when they are written, at most one flush interval after
+the search.
+"""
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+
+from hardware import metrics
+
+logger = logging.getLogger(__name__)
+
+_pending = {}  # (user_id, query) -> None, in arrival order
+_lock = threading.Lock()
+_wakeup = threading.Condition(_lock)
+_writer = None
+
+
+def log_search(user, query):
+    """Queue a search for SearchHistory. Anonymous users and empty queries are not logged."""
+    if not user.is_authenticated or not query.strip():
+        return
+    key = (user.pk, query)
+    with _lock:
+        if key in _pending:
+            metrics.incr("search_log.coalesced")
+            return
+        if len(_pending) >= settings.SEARCH_LOG_MAX_PENDING:
+            metrics.incr("search_log.dropped")
+            return
+        _pending[key] = None
+        if len(_pending) >= settings.SEARCH_LOG_BATCH_SIZE:
+            _wakeup.notify()
+    _ensure_writer()
+
+
+def _take():
+    """Everything buffered so far (caller holds _lock)."""
+    global _pending
+    batch, _pending = list(_pending), {}
+    return batch
+
+
+def _write(batch):
+    from hardware import recommender
+    from hardware.models import SearchHistory
+
+    with metrics.span("search_log.flush"):
+        try:
+            SearchHistory.objects.bulk_create(
+                [SearchHistory(user_id=user_id, query=query) for user_id, query in batch]
+            )
+        except Exception:
+            logger.exception("Dropped %d search log entries", len(batch))
+            metrics.incr("search_log.dropped", len(batch))
+            return
+    metrics.incr("search_log.written", len(batch))
+    for user_id in {user_id for user_id, _ in batch}:
+        recommender.invalidate_recommendations(user_id)
+
+
+def flush():
+    """Write everything buffered now, in the calling thread. Returns the number of entries written."""
+    with _lock:
+        batch = _take()
+    if batch:
+        _write(batch)
+    return len(batch)
+
+
+def _run():
+    from django.db import connection
+    while True:
+        with _lock:
+            if len(_pending) < settings.SEARCH_LOG_BATCH_SIZE:
+                _wakeup.wait(settings.SEARCH_LOG_FLUSH_MS / 1000)
+            batch = _take()
+        if batch:
+            metrics.observe("search_log.batch_size", len(batch))
+            _write(batch)
+            connection.close()
+
+
+def _ensure_writer():
+    """Start the background writer on first use (at most one per process)."""
+    global _writer
+    if _writer is not None:
+        return
+    with _lock:
+        if _writer is not None:
+            return
+        _writer = threading.Thread(target=_run, name="search-log-writer", daemon=True)
+        _writer.start()
+    atexit.register(flush)
@@ -0,0 +1,79 @@
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from hardware import autocomplete, recommender, versions
+from hardware.models import (
+    Category, Product, Product_Review, SimilarProduct, ProductView, SearchHistory, cartOrder, cartOrderItem
+)
+
+
+# ------------------------------
+# Keep the recommender model and SimilarProduct table in step with the catalog
+# ------------------------------
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance, raw=False, **kwargs):
+    if raw:  # loaddata
+        return
+    if recommender.update_product(instance):  # the text changed (not just price or stock)
+        recommender.refresh_similar_products(instance)
+    autocomplete.update_product(instance)
+
+
+@receiver(pre_delete, sender=Product)
+def product_deleting(sender, instance, **kwargs):
+    # Rows pointing at this product cascade away; remember whose lists need refilling
+    instance._similar_referrers = list(
+        SimilarProduct.objects.filter(neighbor=instance)
+        .exclude(product=instance)
+        .values_list('product_id', flat=True)
+    )
+
+
+@receiver(post_delete, sender=Product)
+def product_deleted(sender, instance, **kwargs):
+    recommender.remove_product(instance.pk)
+    autocomplete.remove_product(instance.pk)
+    referrers = getattr(instance, '_similar_referrers', None)
+    if referrers:
+        recommender.refill_similar_products(referrers, removed_pid=instance.pk)
+
+
+# ------------------------------
+# Keep search-box suggestions in step with category names
+# ------------------------------
+@receiver(post_save, sender=Category)
+def category_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    autocomplete.update_category(instance)
+
+
+@receiver(post_delete, sender=Category)
+def category_deleted(sender, instance, **kwargs):
+    autocomplete.remove_category(instance.pk)
+
+
+# ------------------------------
+# Cached search and listing pages are keyed on these versions
+# ------------------------------
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=Category)
+def catalog_changed(sender, instance, **kwargs):
+    versions.bump(versions.CATALOG)
+
+
+@receiver([post_save, post_delete], sender=Product_Review)
+def reviews_changed(sender, instance, **kwargs):
+    versions.bump(versions.REVIEWS)
+
+
+# ------------------------------
+# Drop a user's cached recommendations when their seeds change
+# ------------------------------
+@receiver([post_save, post_delete], sender=ProductView)
+@receiver([post_save, post_delete], sender=SearchHistory)
+@receiver([post_save, post_delete], sender=cartOrderItem)
+@receiver([post_save, post_delete], sender=cartOrder)  # status moves items between cart and orders
+def seed_changed(sender, instance, **kwargs):
+    if instance.user_id:
+        recommender.invalidate_recommendations(instance.user_id)
@@ -0,0 +1,58 @@
+"""
+{% product_cards products "grid" as cards %} renders the inner markup of
+each product's card, the same everywhere it appears (listings, search,
+home page, similar products), through a shared fragment cache.
+
+A card is cached under (variant, pid, updated_at), so a save() of the
+product retires it. A grid of any size costs one get_many and, for the
+misses, one set_many: one round trip each on Redis (the file backend
+reads one file per card). Writes that skip updated_at (queryset.update())
+show up when the card times out (PRODUCT_CARD_CACHE_TIMEOUT).
+"""
+from django import template
+from django.conf import settings
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from hardware import metrics
+
+register = template.Library()
+
+CARD_TEMPLATE = "hardware/includes/product_card.html"
+CARD_VERSION = 1  # bump when the card markup changes
+
+# CSS classes of each page's card styles
+VARIANTS = {
+    "grid": {"badge": "badge", "image": "product-image", "name": "product-name", "price": "price",
+             "old_price": "old-price", "button": "add-to-cart", "link": "addtocartname", "image_link": False},
+    "home": {"badge": "badge", "image": "product-image", "name": "product-name", "price": "price",
+             "old_price": "old-price", "button": "add-to-cart-btn", "link": "addtocartname", "image_link": False},
+    "similar": {"badge": "badge1", "image": "product-image1", "name": "product-name1", "price": "price1",
+                "old_price": "old-price1", "button": "add-to-cart-btn1", "link": "addtocartname1",
+                "image_link": True},
+}
+
+
+def card_cache_key(variant, product):
+    stamp = product.updated_at.timestamp() if product.updated_at else ""
+    return f"card:{CARD_VERSION}:{variant}:{product.pk}:{stamp}"
+
+
+@register.simple_tag
+def product_cards(products, variant="grid"):
+    """[(product, card html)] for `products`, in order."""
+    classes = VARIANTS[variant]
+    products = list(products)
+    keys = [card_cache_key(variant, product) for product in products]
+    cached = cache.get_many(keys)
+    metrics.incr("cards.cache_hit", len(cached))
+    missing = {}
+    for key, product in zip(keys, products):
+        if key not in cached:
+            missing[key] = render_to_string(CARD_TEMPLATE, {"product": product, "classes": classes})
+    if missing:
+        metrics.incr("cards.cache_miss", len(missing))
+        cache.set_many(missing, settings.PRODUCT_CARD_CACHE_TIMEOUT)
+        cached.update(missing)
+    return [(product, mark_safe(cached[key])) for key, product in zip(keys, products)]
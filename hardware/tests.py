@@ -1,3 +1,1334 @@
-from django.test import TestCase
+import inspect
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from scipy import sparse
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from hardware import (
+    ann, autocomplete, benchmark, evaluation, facets, listing, metrics, recommender, replay, search, search_log,
+    training, versions,
+)
+from hardware.models import (
+    Category, Product, Product_Review, ProductView, SearchHistory, SimilarProduct, cartOrder, cartOrderItem
+)
+from hardware.templatetags import product_cards
+from userauths.models import User
+
+
+def make_products(category, words, description, specification="Steel", price=10):
+    """
+    Published products "<Word> <i>", described "<description> <word>", one
+    per entry of `words`. bulk_create() skips the Product signals, so the
+    recommender is left for the test to train.
+    """
+    return Product.objects.bulk_create([
+        Product(
+            name=f"{word.title()} {i}", description=f"{description} {word}",
+            specification=specification, price=price, category=category,
+            image="user_directory_path/tool.webp", product_status="published",
+        )
+        for i, word in enumerate(words)
+    ])
+
+
+def setUpModule():
+    # The real cache (var/cache, or Redis with REDIS_URL) and artifact directory
+    # outlive the test database; the tests get their own, in a temporary directory
+    directory = tempfile.mkdtemp()
+    unittest.addModuleCleanup(shutil.rmtree, directory)
+    isolated = override_settings(
+        CACHES={"default": {
+            "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+            "LOCATION": os.path.join(directory, "cache"),
+        }},
+        RECOMMENDER_ARTIFACT_DIR=os.path.join(directory, "artifacts"),
+    )
+    isolated.enable()
+    unittest.addModuleCleanup(isolated.disable)
+
+
+class ArtifactStartupTests(TestCase):
+    """build_recommender writes a versioned artifact that app startup loads back."""
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name="Fasteners")
+        make_products(category, ["bolt", "nut", "washer", "screw", "rivet"] * 3, "Zinc", price=5)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.addCleanup(setattr, recommender, "_snapshot", recommender.current_model())
+
+    def build(self):
+        call_command("build_recommender", output=self.directory, workers=1, skip_similar=True, stdout=StringIO())
+        return recommender.current_model()
+
+    def test_startup_loads_the_current_build(self):
+        built = self.build()
+        product = Product.objects.first()
+        expected = [p.pid for p in recommender.knn_similar_products(product)]
+
+        recommender._snapshot = None
+        with self.settings(RECOMMENDER_ARTIFACT_DIR=self.directory):
+            apps.get_app_config("hardware").ready()
+        loaded = recommender.current_model()
+        self.assertEqual(loaded.version, built.version)
+        self.assertEqual(recommender.current_artifact_version(self.directory), built.version)
+        self.assertEqual((loaded.matrix != built.matrix).nnz, 0)
+        self.assertEqual([p.pid for p in recommender.knn_similar_products(product)], expected)
+
+    def test_pinned_version_wins_over_current(self):
+        first = self.build().version
+        Product.objects.filter(pk=Product.objects.first().pk).update(name="Anchor 99")  # no signals
+        second = self.build().version
+        self.assertNotEqual(first, second)
+        with self.settings(RECOMMENDER_MODEL_VERSION=first):
+            self.assertEqual(recommender.load_artifact(directory=self.directory), first)
+        self.assertEqual(recommender.load_artifact(directory=self.directory), second)
+
+
+class SimilarProductRefreshTests(TestCase):
+    """Patching the SimilarProduct table after an edit matches a full rebuild."""
+
+    WORDS = ["drill", "saw", "blade", "bit", "chuck", "cordless", "brushless", "torque", "impact", "sander",
+             "orbital", "grit", "clamp", "vise", "jaw", "level", "laser", "router", "plunge", "collet"]
+
+    @classmethod
+    def setUpClass(cls):
+        patcher = mock.patch.object(recommender, "schedule_refit")
+        patcher.start()
+        cls.addClassCleanup(patcher.stop)
+        super().setUpClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.rng = np.random.default_rng(7)
+        # Products only share the category's term within a category
+        cls.categories = [Category.objects.create(name=name) for name in ("Workshop", "Garage", "Shed")]
+        Product.objects.bulk_create([
+            Product(name=f"N{i:02d}", description=cls.words(), specification="", price=10,
+                    category=cls.categories[i % 3], image="user_directory_path/tool.webp")
+            for i in range(45)
+        ])
+
+    @classmethod
+    def words(cls):
+        return " ".join(cls.rng.choice(cls.WORDS, size=cls.rng.integers(2, 6)))
+
+    def setUp(self):
+        self.addCleanup(setattr, recommender, "_snapshot", recommender.current_model())
+        recommender.train_model()
+        recommender.build_similar_products(top_k=4)
+
+    def table(self):
+        """{owner: (scores in rank order, neighbours above the cut-off)}; products tied at the cut-off may differ."""
+        lists = {}
+        for owner, neighbor, score in SimilarProduct.objects.order_by("product_id", "rank").values_list(
+            "product_id", "neighbor_id", "score"
+        ):
+            lists.setdefault(owner, []).append((neighbor, round(score, 9)))
+        return {
+            owner: ([s for _, s in row], {n for n, s in row if s > row[-1][1]})
+            for owner, row in lists.items()
+        }
+
+    def assertMatchesFullRebuild(self):
+        patched = self.table()
+        recommender.build_similar_products(top_k=4, model=recommender.current_model())
+        self.assertEqual(patched, self.table())
+
+    def test_edit_that_leaves_a_neighbour_list_keeps_the_rest_of_it(self):
+        product = Product.objects.get(name="N00")
+        listing = SimilarProduct.objects.filter(neighbor=product).values_list("product_id", flat=True)
+        referrer = listing.first()
+        before = SimilarProduct.objects.filter(product_id=referrer).count()
+        product.name, product.description = "Unrelated", "unrelated"
+        product.category = next(c for c in self.categories if c != product.category)
+        with self.settings(SIMILAR_PRODUCTS_TOP_K=4):
+            product.save()
+        self.assertFalse(SimilarProduct.objects.filter(product_id=referrer, neighbor=product).exists())
+        self.assertEqual(SimilarProduct.objects.filter(product_id=referrer).count(), before)
+        self.assertMatchesFullRebuild()
+
+    def test_only_lists_it_enters_or_leaves_are_rewritten(self):
+        product = Product.objects.get(name="N01")
+        held = set(SimilarProduct.objects.filter(neighbor=product).values_list("product_id", flat=True))
+        product.description = self.words()
+        with self.settings(SIMILAR_PRODUCTS_TOP_K=4), CaptureQueriesContext(connection) as queries, \
+                mock.patch.object(recommender, "_write_similar_rows", wraps=recommender._write_similar_rows) as write:
+            product.save()
+        holds = set(SimilarProduct.objects.filter(neighbor=product).values_list("product_id", flat=True))
+        self.assertLessEqual(set(write.call_args.args[0]), {product.pid} | held | holds)
+        # Every product in its category shares a term with it; no query lists them all
+        shares_terms = Product.objects.filter(category=product.category).count() - 1
+        reads = [query["sql"] for query in queries if query["sql"].startswith("SELECT")]
+        self.assertLess(max(sql.count("'prod") for sql in reads), shares_terms)
+        self.assertMatchesFullRebuild()
+
+    def test_rebuild_in_small_transactions_matches_one_pass(self):
+        whole = self.table()
+        with mock.patch.object(transaction, "atomic", wraps=transaction.atomic) as atomic:
+            recommender.build_similar_products(top_k=4, chunk_size=10, model=recommender.current_model())
+        blocks = [call for call in atomic.call_args_list if call == mock.call()]  # not delete()/bulk_create()'s own
+        self.assertEqual(len(blocks), 5)  # 45 products
+        self.assertEqual(self.table(), whole)
+
+    def test_random_edits_match_a_full_rebuild(self):
+        products = list(Product.objects.order_by("pid"))
+        with self.settings(SIMILAR_PRODUCTS_TOP_K=4):
+            for i in self.rng.integers(0, len(products), size=15):
+                products[i].description = self.words()
+                products[i].category = self.categories[self.rng.integers(0, 3)]
+                products[i].save()
+            Product.objects.create(name="N99", description=self.words(), price=10,
+                                   category=self.categories[0], image="user_directory_path/tool.webp")
+        self.assertMatchesFullRebuild()
+
+
+class IncrementalModelTests(TestCase):
+    """Product edits patch the model, drift triggers one refit, and every worker follows."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name="Plumbing")
+        make_products(cls.category, ["pipe", "valve", "elbow", "tap", "washer"] * 2,
+                      "Brass", specification="Copper", price=15)
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(setattr, recommender, "_snapshot", recommender.current_model())
+        self.addCleanup(setattr, recommender, "_seen_current", recommender._seen_current)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.enterContext(self.settings(RECOMMENDER_ARTIFACT_DIR=self.directory))
+        recommender.train_model()
+
+    def row_of(self, product):
+        model = recommender.current_model()
+        return model.matrix[model.pid_index[product.pid]]
+
+    def test_patch_and_remove(self):
+        product = Product.objects.first()
+        product.description = "Brass pipe valve"
+        with mock.patch.object(recommender, "schedule_refit"):
+            product.save()
+        model = recommender.current_model()
+        expected = model.vectorizer.transform([recommender._product_text(product)])
+        self.assertEqual((self.row_of(product) != expected).nnz, 0)
+        self.assertEqual(model.patch_count, 1)
+
+        rows = model.matrix.shape[0]
+        recommender.remove_product(product.pid)
+        self.assertEqual(recommender.current_model().matrix.shape[0], rows - 1)
+        self.assertNotIn(product.pid, recommender.current_model().pid_index)
+
+    def test_drift_past_the_threshold_schedules_one_refit(self):
+        product = Product.objects.first()
+        vocabulary = len(recommender.current_model().vectorizer.vocabulary_)
+        self.addCleanup(recommender._release_refit_lock)  # the mocked refit never ends
+        with mock.patch.object(recommender, "schedule_refit") as schedule, \
+                self.settings(RECOMMENDER_REFIT_DRIFT=2.5 / vocabulary):
+            product.description = "galvanised"
+            product.save()
+            product.description = "galvanised threaded"
+            product.save()
+            schedule.assert_not_called()  # 2 unseen terms
+            product.description = "galvanised threaded flange"
+            product.save()
+            product.description = "galvanised threaded flange compression"
+            product.save()
+        schedule.assert_called_once()  # the refit lock holds back the second one
+        self.assertEqual(len(recommender.current_model().unseen_terms), 4)
+
+    @unittest.skipIf(recommender.fcntl is None, "flock() needs fcntl")
+    def test_refit_lock_holds_across_processes(self):
+        path = os.path.join(self.directory, recommender.REFIT_LOCK_FILE)
+        try_lock = "import fcntl, sys; fcntl.flock(open(sys.argv[1], 'a'), fcntl.LOCK_EX | fcntl.LOCK_NB)"
+        self.assertTrue(recommender._take_refit_lock())
+        self.assertFalse(recommender._take_refit_lock())
+        self.assertNotEqual(subprocess.run([sys.executable, "-c", try_lock, path], capture_output=True).returncode, 0)
+        recommender._release_refit_lock()
+        self.assertEqual(subprocess.run([sys.executable, "-c", try_lock, path], capture_output=True).returncode, 0)
+        self.assertTrue(recommender._take_refit_lock())
+        recommender._release_refit_lock()
+
+    def test_workers_follow_each_others_edits_and_refits(self):
+        recommender.save_artifact()
+        old = recommender.current_model()
+
+        # Another worker saved a product: this one patches it in on its next check
+        product = Product.objects.first()
+        Product.objects.filter(pk=product.pk).update(description="Brass pipe valve", updated_at=timezone.now())
+        product.refresh_from_db()
+        recommender.follow_catalog(force=True)
+        model = recommender.current_model()
+        self.assertEqual(model.base_version, old.version)
+        self.assertNotEqual(model.version, old.version)
+        expected = model.vectorizer.transform([recommender._product_text(product)])
+        self.assertEqual((self.row_of(product) != expected).nnz, 0)
+        recommender.follow_catalog(force=True)
+        self.assertIs(recommender.current_model(), model)  # nothing new
+
+        # The worker that saved it got there through the signal: same version,
+        # so both read and write the same cached recommendations
+        recommender.publish(old)
+        self.assertEqual(recommender.update_product(product), 1)
+        self.assertEqual(recommender.current_model().version, model.version)
+        self.assertEqual(recommender.update_product(product), 0)  # already in
+        recommender.publish(model)
+
+        # Another worker refitted: the build is published, and this one loads it.
+        # The SimilarProduct table is left to build_recommender, off the web workers.
+        with mock.patch.object(connection, "close"), mock.patch.object(recommender, "build_similar_products") as rebuild:
+            recommender._refit()
+        rebuild.assert_not_called()
+        published = recommender.current_model().version
+        self.assertEqual(recommender.current_artifact_version(), published)
+        recommender.publish(model)
+        recommender._seen_current = old.version
+        recommender.follow_catalog(force=True)
+        self.assertEqual(recommender.current_model().version, published)
+
+
+class BatchedSeedScoringTests(SimpleTestCase):
+    """_score_seeds ranks exactly like the per-seed kneighbors() loop it replaced."""
+
+    def setUp(self):
+        rng = np.random.default_rng(11)
+        words = [f"term{i}" for i in range(30)]
+        docs = [f"item{i} " + " ".join(rng.choice(words, size=rng.integers(2, 7))) for i in range(80)]
+        vectorizer = TfidfVectorizer(stop_words="english")
+        pids = [f"p{i:02d}" for i in range(80)]
+        self.model = recommender.make_snapshot(vectorizer, vectorizer.fit_transform(docs), pids)
+        self.rng = rng
+
+    def per_seed_loop(self, seeds, top_n, exclude_pids):
+        model = self.model
+        scored = []
+        for row, weight in seeds:
+            distances, indices = model.knn_model.kneighbors(model.matrix[row], n_neighbors=top_n + 1)
+            for i, d in zip(indices[0][1:], distances[0][1:]):
+                pid = str(model.pids[i])
+                if pid not in exclude_pids:
+                    scored.append((weight * (1 - d), pid))
+        scored.sort(key=lambda x: -x[0])
+        top_pids = []
+        for _, pid in scored[:top_n]:
+            if pid not in top_pids:
+                top_pids.append(pid)
+        return top_pids
+
+    def test_matches_the_per_seed_loop(self):
+        for _ in range(200):
+            rows = self.rng.choice(80, size=self.rng.integers(1, 12), replace=False)
+            seeds = [(int(row), float(weight)) for row, weight in zip(rows, self.rng.uniform(0.5, 2.0, len(rows)))]
+            exclude = {f"p{i:02d}" for i in self.rng.choice(80, size=self.rng.integers(0, 6), replace=False)}
+            top_n = int(self.rng.integers(1, 10))
+            self.assertEqual(
+                recommender._score_seeds(self.model, seeds, top_n, exclude),
+                self.per_seed_loop(seeds, top_n, exclude),
+            )
+
+
+class RecommendationCacheTests(TestCase):
+    """A user's cached ranking is dropped when their own seeds change or the model does."""
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name="Painting")
+        make_products(category, ["brush", "roller", "tray", "tape", "primer"] * 2,
+                      "Wall", specification="Acrylic", price=12)
+        cls.user = User.objects.create_user(username="painter", email="p@example.com", password="x")
+        cls.other = User.objects.create_user(username="plasterer", email="q@example.com", password="x")
+        cls.products = list(Product.objects.order_by("pid"))
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(setattr, recommender, "_snapshot", recommender.current_model())
+        recommender.train_model()
+
+    def assertRecomputed(self, expected):
+        with mock.patch.object(recommender, "_recommend_pids", wraps=recommender._recommend_pids) as compute:
+            recommender.recommend_for_user(self.user, top_n=4)
+        self.assertEqual(compute.called, expected)
+
+    def test_views_and_orders_invalidate_only_their_user(self):
+        recommender.recommend_for_user(self.user, top_n=4)
+        recommender.recommend_for_user(self.other, top_n=4)
+        self.assertRecomputed(False)
+
+        ProductView.objects.create(user=self.user, product=self.products[0])
+        self.assertIsNotNone(cache.get(recommender.recommendation_cache_key(self.other.pk)))
+        self.assertRecomputed(True)
+        self.assertRecomputed(False)
+
+        order = cartOrder.objects.create(user=self.user, price=12)
+        self.assertRecomputed(True)
+        cartOrderItem.objects.create(user=self.user, order=order, item=self.products[1], price=12)
+        self.assertRecomputed(True)
+        order.order_status = "completed"
+        order.save()
+        self.assertRecomputed(True)
+        self.assertRecomputed(False)
+
+    def test_new_model_version_recomputes(self):
+        recommender.recommend_for_user(self.user, top_n=4)
+        product = Product.objects.get(name="Brush 0")
+        product.description = "Wall roller"
+        with mock.patch.object(recommender, "schedule_refit"):
+            product.save()  # patched model, new version
+        self.assertRecomputed(True)
+
+
+class QueryNeighborCacheTests(SimpleTestCase):
+    """Nearest products for a search query are memoised per snapshot, LRU-bounded."""
+
+    def setUp(self):
+        docs = ["cordless drill", "hammer drill", "claw hammer", "hand saw", "circular saw", "tape measure"]
+        vectorizer = TfidfVectorizer(stop_words="english")
+        pids = [f"p{i}" for i in range(6)]
+        self.model = recommender.make_snapshot(vectorizer, vectorizer.fit_transform(docs), pids)
+
+    def test_hits_match_a_fresh_lookup_and_old_entries_are_evicted(self):
+        query = recommender.normalize_query("  Hammer   DRILL ")
+        self.assertEqual(query, "hammer drill")
+        first = self.model.query_neighbors(query)
+        self.assertEqual(first[0][0], "p1")
+        with mock.patch.object(self.model.vectorizer, "transform") as transform:
+            self.assertEqual(self.model.query_neighbors(query), first)
+        transform.assert_not_called()
+
+        with self.settings(RECOMMENDER_QUERY_CACHE_SIZE=2):
+            self.model.query_neighbors("saw")
+            self.model.query_neighbors("tape")
+        self.assertNotIn(query, self.model._query_cache)
+        self.assertEqual(list(self.model._query_cache), ["saw", "tape"])
+
+        fresh = recommender.make_snapshot(self.model.vectorizer, self.model.matrix, self.model.pids)
+        self.assertFalse(fresh._query_cache)
+        self.assertEqual(fresh.query_neighbors(query), first)
+
+
+class NeighbourEngineTests(SimpleTestCase):
+    """The LSH engine finds nearly the same neighbours as brute force; the setting picks the engine."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        rng = np.random.default_rng(3)
+        topics = [[f"t{t}w{i}" for i in range(15)] for t in range(20)]
+        docs = [" ".join(rng.choice(topics[rng.integers(20)], size=rng.integers(3, 8))) for _ in range(2000)]
+        cls.matrix = TfidfVectorizer().fit_transform(docs)
+
+    def test_lsh_recall_against_brute_force(self):
+        queries = self.matrix[:200]
+        brute_d, brute_i = ann.build_index(self.matrix, engine="brute").kneighbors(queries, n_neighbors=10)
+        lsh_d, lsh_i = ann.build_index(self.matrix, engine="lsh").kneighbors(queries, n_neighbors=10)
+        recall = np.mean([len(set(b) & set(a)) / len(b) for b, a in zip(brute_i, lsh_i)])
+        self.assertGreaterEqual(recall, 0.9)
+        for distances in lsh_d:
+            self.assertTrue(np.all(np.diff(distances) >= 0))  # best first
+
+    def test_setting_selects_the_engine(self):
+        with self.settings(RECOMMENDER_ENGINE="lsh"):
+            self.assertIsInstance(ann.build_index(self.matrix), ann.LSHIndex)
+            model = recommender.make_snapshot(TfidfVectorizer(), self.matrix, [str(i) for i in range(2000)])
+            self.assertEqual(ann.engine_name(model.knn_model), "lsh")
+        with self.settings(RECOMMENDER_ENGINE="brute"):
+            self.assertIsInstance(ann.build_index(self.matrix), ann.BruteForceIndex)
+        with self.settings(RECOMMENDER_ENGINE="kdtree"), self.assertRaises(ValueError):
+            ann.build_index(self.matrix)
+
+
+class ParallelTrainingTests(TestCase):
+    """train_parallel gives the same TF-IDF model as a single-process fit_transform."""
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name="Electrical")
+        words = ["cable", "switch", "socket", "fuse", "breaker", "conduit", "insulated", "copper", "plug"]
+        Product.objects.bulk_create([
+            Product(
+                name=f"{words[i % 9].title()} {i}", description=" ".join(words[i % 4:i % 4 + 1 + i % 5]),
+                specification="The 240V rating" if i % 3 else "", label="Hot" if i % 4 == 0 else "",
+                price=9, category=category, image="user_directory_path/tool.webp", product_status="published",
+            )
+            for i in range(23)
+        ])
+
+    def test_matches_fit_transform(self):
+        docs = [
+            recommender.product_document(*fields)
+            for fields in Product.objects.order_by("pk").values_list(*recommender.DOCUMENT_FIELDS)
+        ]
+        reference = TfidfVectorizer(stop_words="english")
+        expected = reference.fit_transform(docs)
+
+        vectorizer, matrix, pids, stats = training.train_parallel(workers=2, chunk_size=4)
+        self.assertEqual(pids, list(Product.objects.order_by("pk").values_list("pid", flat=True)))
+        self.assertEqual(vectorizer.vocabulary_, reference.vocabulary_)
+        self.assertTrue(np.allclose(vectorizer.idf_, reference.idf_, rtol=0, atol=1e-12))
+        self.assertEqual(matrix.shape, expected.shape)
+        self.assertLess(abs(matrix - expected).max(), 1e-12)
+        self.assertEqual(stats["documents"], 23)
+
+
+class UserSeedQueryCountTests(TestCase):
+    """Seed collection must not issue a query per history row."""
+
+    @classmethod
+    def setUpClass(cls):
+        # setUpTestData trains and publishes a model; later classes get the previous one back
+        cls.addClassCleanup(setattr, recommender, "_snapshot", recommender.current_model())
+        super().setUpClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name="Power Tools")
+        words = ["drill", "hammer", "saw", "wrench", "pliers", "spanner", "chisel", "trowel"]
+        make_products(category, words * 3, "Heavy duty", price=100)
+        recommender.train_model()
+
+        products = list(Product.objects.all())
+        cls.light_user = User.objects.create_user(username="light", email="light@example.com", password="x")
+        cls.heavy_user = User.objects.create_user(username="heavy", email="heavy@example.com", password="x")
+
+        SearchHistory.objects.create(user=cls.light_user, query="drill")
+        SearchHistory.objects.bulk_create([
+            SearchHistory(user=cls.heavy_user, query=f"{words[i % len(words)]} {i}")
+            if i % 2 else SearchHistory(user=cls.heavy_user, product=products[i % len(products)])
+            for i in range(1000)
+        ])
+        ProductView.objects.bulk_create([
+            ProductView(user=cls.heavy_user, product=product) for product in products
+        ])
+
+    def test_seed_collection_query_count_is_constant(self):
+        for user in (self.light_user, self.heavy_user):
+            with self.subTest(user=user.username), self.assertNumQueries(3):
+                seeds = recommender._user_seeds(user)
+            self.assertTrue(seeds)
+
+    def test_recommendations_query_count_is_bounded(self):
+        recommender.follow_catalog(force=True)  # so the periodic catalog sync does not land in the count
+        for user in (self.light_user, self.heavy_user):
+            with self.subTest(user=user.username), CaptureQueriesContext(connection) as ctx:
+                recommendations = recommender.recommend_for_user(user, top_n=4, use_cache=False)
+            # cart exclusion + 3 seed sources + optional newest-product filler + one product fetch
+            self.assertLessEqual(len(ctx.captured_queries), 6)
+            self.assertEqual(len(recommendations), 4)
+
+
+class SharedArtifactTests(TestCase):
+    """A loaded artifact is used straight from the memory-mapped files."""
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name="Hand Tools")
+        make_products(category, ["chisel", "mallet", "rasp", "file"] * 4, "Forged", price=50)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_load_attaches_without_copying(self):
+        recommender.train_model()
+        product = Product.objects.first()
+        expected = list(recommender.knn_similar_products(product))
+        recommender.save_artifact(self.directory)
+        recommender.load_artifact(directory=self.directory)
+
+        model = recommender.current_model()
+        self.assertIsInstance(model.pids, np.memmap)
+        self.assertIsInstance(model.pid_index.sorted_pids, np.memmap)
+        for name in ("data", "indices", "indptr"):
+            array = getattr(model.matrix, name)
+            self.assertFalse(array.flags.writeable)
+            self.assertTrue(np.shares_memory(array, getattr(model.knn_model._matrix, name)))
+        self.assertEqual(list(recommender.knn_similar_products(product)), expected)
+
+    def test_patches_are_republished_for_every_worker_to_map(self):
+        self.enterContext(self.settings(
+            RECOMMENDER_ARTIFACT_DIR=self.directory, RECOMMENDER_REPUBLISH_PATCHES=2, RECOMMENDER_REFIT_DRIFT=1,
+        ))
+        self.addCleanup(setattr, recommender, "_snapshot", recommender.current_model())
+        self.addCleanup(setattr, recommender, "_seen_current", recommender._seen_current)
+        self.addCleanup(recommender._release_refit_lock)
+        recommender.train_model()
+        recommender.save_artifact()
+        with mock.patch.object(recommender, "schedule_refit", return_value=True) as schedule:
+            for name, description in [("Chisel 0", "Forged rasp"), ("Mallet 1", "Forged rasp gouge")]:
+                product = Product.objects.get(name=name)
+                product.description = description
+                product.save()
+        schedule.assert_called_once_with(recommender._republished)
+        patched = recommender.current_model()
+        self.assertTrue(patched.matrix.data.flags.writeable)  # this worker's private copy
+
+        with mock.patch.object(connection, "close"):
+            recommender._refit(recommender._republished)
+        model = recommender.current_model()
+        self.assertEqual(recommender.current_artifact_version(), model.version)
+        self.assertEqual(model.patch_count, 0)
+        self.assertIsInstance(model.pids, np.memmap)
+        self.assertFalse(model.matrix.data.flags.writeable)
+        self.assertEqual((model.matrix != patched.matrix).nnz, 0)
+        self.assertEqual(model.unseen_terms, {"gouge"})  # drift carries over
+
+
+class ModelSnapshotTests(TestCase):
+    """Readers keep a consistent snapshot and never train inside a request."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name="Garden Tools")
+        make_products(cls.category, ["rake", "hoe", "spade", "shears"] * 3, "Garden", price=30)
+        cls.user = User.objects.create_user(username="gardener", email="g@example.com", password="x")
+        SearchHistory.objects.create(user=cls.user, query="rake")
+
+    def setUp(self):
+        recommender.train_model()
+        self.addCleanup(recommender.publish, recommender.current_model())
+
+    def test_patch_publishes_new_snapshot_and_leaves_old_one_intact(self):
+        before = recommender.current_model()
+        rows, version = before.matrix.shape[0], before.version
+        with mock.patch.object(recommender, "schedule_refit"):
+            Product.objects.create(
+                name="Rake Deluxe", description="Garden rake", specification="Steel",
+                price=45, category=self.category, image="user_directory_path/tool.webp",
+            )
+        after = recommender.current_model()
+        self.assertIsNot(after, before)
+        self.assertEqual(after.matrix.shape[0], rows + 1)
+        self.assertTrue(after.version.startswith(f"{version}+"))
+        self.assertEqual((before.matrix.shape[0], before.version), (rows, version))
+
+    def test_edit_that_leaves_the_text_alone_does_not_patch(self):
+        before = recommender.current_model()
+        product = Product.objects.get(name="Rake 0")
+        product.price = 99
+        product.save()
+        self.assertIs(recommender.current_model(), before)
+
+    def test_patched_index_matches_a_full_fit(self):
+        rng = np.random.default_rng(5)
+        words = [f"w{i}" for i in range(40)]
+        docs = [" ".join(rng.choice(words, size=rng.integers(2, 6))) for _ in range(300)]
+        vectorizer = TfidfVectorizer().fit(docs)
+        matrix = vectorizer.transform(docs).tocsr()
+        index = ann.build_index(matrix, engine="lsh", bits=4)
+        tables = index._order.copy(), index._sorted_codes.copy()
+
+        # Rows 3 and 40 edited and two rows appended, then row 7 removed
+        edited = vectorizer.transform(["w1 w2 w3", "w39", "w5 w6", "w7 w8 w9"]).tocsr()
+        patched = sparse.vstack([matrix[:3], edited[0], matrix[4:40], edited[1], matrix[41:], edited[2:]], format="csr")
+        step = index.updated(patched, changed=[3, 40, 300, 301])
+        removed = sparse.vstack([patched[:7], patched[8:]], format="csr")
+        step = step.updated(removed, removed=7)
+
+        fresh = ann.LSHIndex(**index.get_params()).fit(removed)
+        self.assertTrue(np.array_equal(step._sorted_codes, fresh._sorted_codes))
+        for t in range(index.tables):
+            self.assertEqual(
+                sorted(zip(step._sorted_codes[t], step._order[t])),
+                sorted(zip(fresh._sorted_codes[t], fresh._order[t])),
+            )
+        self.assertTrue(np.array_equal(step.kneighbors(removed[:50], 5)[1], fresh.kneighbors(removed[:50], 5)[1]))
+        # The index the old snapshot still serves is untouched
+        self.assertTrue(np.array_equal(index._order, tables[0]))
+        self.assertTrue(np.array_equal(index._sorted_codes, tables[1]))
+
+    def test_requests_do_not_train_without_a_model(self):
+        recommender._snapshot = None
+        with mock.patch.object(recommender, "schedule_refit") as schedule, \
+                mock.patch.object(recommender, "build_model") as build:
+            recommendations = recommender.recommend_for_user(self.user, top_n=4, use_cache=False)
+        schedule.assert_called()
+        build.assert_not_called()
+        self.assertEqual(len(recommendations), 4)
+
+
+class RecommenderMetricsTests(TestCase):
+    """Stages of a recommendation are timed and exposed in Prometheus format."""
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name="Measuring Tools")
+        make_products(category, ["tape", "level", "caliper", "square"] * 3,
+                      "Precise", specification="Metal", price=20)
+        cls.user = User.objects.create_user(username="measurer", email="m@example.com", password="x")
+        SearchHistory.objects.create(user=cls.user, query="caliper")
+
+    def setUp(self):
+        recommender.train_model()
+        metrics.histogram().reset()
+
+    def test_stages_and_counters_are_recorded(self):
+        recommender.recommend_for_user(self.user, top_n=4)
+        recommender.recommend_for_user(self.user, top_n=4)
+
+        data = metrics.histogram().snapshot()
+        for stage in ("recommend_for_user", "seeds.search_history", "seeds.product_views",
+                      "knn.kneighbors", "recommend.fetch_products"):
+            self.assertIn(stage, data["stages"])
+        self.assertEqual(data["stages"]["recommend_for_user"]["count"], 2)
+        self.assertEqual(data["counters"]["recommend.cache_hit"], 1)
+        self.assertGreater(data["counters"]["recommend.candidates_scored"], 0)
+        self.assertEqual(data["values"]["recommend.seeds_per_user"]["count"], 1)
+
+    def test_timed_functions_keep_their_metadata(self):
+        function = recommender.recommend_for_user
+        self.assertEqual((function.__module__, function.__qualname__), ("hardware.recommender", "recommend_for_user"))
+        self.assertIn("top_n", inspect.signature(function).parameters)
+        self.assertEqual(function.__doc__, function.__wrapped__.__doc__)
+
+    def test_prometheus_endpoint(self):
+        recommender.recommend_for_user(self.user, top_n=4, use_cache=False)
+        staff = User.objects.create_user(username="ops", email="ops@example.com", password="x", is_staff=True)
+        self.client.force_login(staff)
+        response = self.client.get("/metrics/")
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        self.assertIn('toolhub_stage_seconds{stage="recommend_for_user",quantile="0.99"}', body)
+        self.assertIn("toolhub_knn_calls_total", body)
+
+        self.client.logout()
+        self.assertEqual(self.client.get("/metrics/").status_code, 403)
+        self.assertEqual(self.client.get("/metrics/", REMOTE_ADDR="127.0.0.1").status_code, 403)
+        with self.settings(METRICS_TOKEN="s3cret"):
+            self.assertEqual(self.client.get("/metrics/", HTTP_AUTHORIZATION="Bearer s3cret").status_code, 200)
+            self.assertEqual(self.client.get("/metrics/", HTTP_AUTHORIZATION="Bearer wrong").status_code, 403)
+        with self.settings(METRICS_TOKEN=""):
+            self.assertEqual(self.client.get("/metrics/", HTTP_AUTHORIZATION="Bearer ").status_code, 403)
+
+
+class MajorityVoteTests(SimpleTestCase):
+    """The bincount vote matches a per-row vote, with ties going to the nearest label."""
+
+    def test_matches_per_row_vote(self):
+        rng = np.random.default_rng(0)
+        neighbors = rng.integers(0, 6, size=(200, 7))
+        votes = evaluation.majority_vote(neighbors, 6)
+        for row, vote in zip(neighbors, votes):
+            counts = np.bincount(row, minlength=6)
+            tied = np.flatnonzero(counts == counts.max())
+            self.assertEqual(vote, next(code for code in row if code in tied))
+
+
+class BenchmarkSmokeTests(TestCase):
+    """The benchmark runs end to end on a tiny synthetic catalog."""
+
+    def test_run_size(self):
+        self.addCleanup(setattr, recommender, "_snapshot", recommender.current_model())
+        result = benchmark.run_size(300, queries=5)
+
+        self.assertEqual(result["catalog"]["products"], 300)
+        self.assertEqual(result["train"]["matrix"]["rows"], 300)
+        self.assertEqual([run["label"] for run in result["engines"]], ["brute", "lsh", "lsh-fast"])
+        for run in result["engines"]:
+            self.assertEqual(run["knn_similar_products"]["n"], 5)
+            self.assertEqual(run["recommend_for_user"]["n"], 5)
+        self.assertIn("recall_vs_brute", result["engines"][1])
+
+
+class AsOfReplayTests(TestCase):
+    """as_of rebuilds a user's seeds from the history before that time only."""
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name="Bathroom")
+        make_products(category, ["shower", "faucet", "basin", "mirror"] * 2,
+                      "Bathroom", specification="Chrome", price=80)
+        cls.user = User.objects.create_user(username="replayer", email="r@example.com", password="x")
+        cls.first, cls.second = Product.objects.all()[:2]
+        now = timezone.now()
+        cls.cutoff = now - timezone.timedelta(days=1)
+        ProductView.objects.create(user=cls.user, product=cls.first, viewed_at=now - timezone.timedelta(days=2))
+        ProductView.objects.create(user=cls.user, product=cls.second, viewed_at=now)
+
+    def setUp(self):
+        recommender.train_model()
+        recommender.invalidate_recommendations(self.user.pk)
+
+    def test_seeds_ignore_later_history(self):
+        seeds = dict(recommender._user_seeds(self.user, as_of=self.cutoff))
+        self.assertEqual(set(seeds), {self.first.pid})
+        self.assertEqual(set(dict(recommender._user_seeds(self.user))), {self.first.pid, self.second.pid})
+
+    def test_as_of_bypasses_the_cache(self):
+        recommender.recommend_for_user(self.user, top_n=4, as_of=self.cutoff)
+        self.assertIsNone(cache.get(recommender.recommendation_cache_key(self.user.pk)))
+
+    def test_replay_workers_keep_their_model_when_current_moves(self):
+        directory, live = tempfile.mkdtemp(), tempfile.mkdtemp()
+        for path in (directory, live):
+            self.addCleanup(shutil.rmtree, path)
+        self.enterContext(self.settings(RECOMMENDER_ARTIFACT_DIR=live))
+        for name in ("_snapshot", "_seen_current", "_synced", "_pinned"):
+            self.addCleanup(setattr, recommender, name, getattr(recommender, name))
+        version = recommender.save_artifact(directory=directory)
+        with mock.patch("django.setup"), mock.patch.object(replay, "use_snapshot"):
+            replay._init_worker("replay.sqlite3", directory, version)
+        model = recommender.current_model()
+
+        # Mid-run, the live site edits a product and publishes a refit
+        Product.objects.filter(pk=self.first.pk).update(description="Copper basin", updated_at=timezone.now())
+        recommender.save_artifact(model=recommender.build_model())
+        self.assertNotEqual(recommender.current_artifact_version(), version)
+        recommender._next_follow = 0.0
+        results = replay.replay_user((self.user.pk, [(self.cutoff, self.second.pid, "view")], 4))
+        self.assertEqual(len(results), 1)
+        self.assertIs(recommender.current_model(), model)
+
+
+class FullTextSearchTests(TestCase):
+    """The FTS5 index follows product and category writes and ranks name hits first."""
+
+    @classmethod
+    def setUpClass(cls):
+        # Product writes here are about the search index; keep the recommender from
+        # refitting, and write the search log in the test thread (search_log.flush())
+        for target in ((recommender, "schedule_refit"), (search_log, "_ensure_writer")):
+            patcher = mock.patch.object(*target)
+            patcher.start()
+            cls.addClassCleanup(patcher.stop)
+        super().setUpClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name="Power Tools")
+        defaults = dict(price=10, image="user_directory_path/tool.webp", product_status="published")
+        cls.named = Product.objects.create(
+            name="Cordless Drill", description="18V", specification="Li-ion", category=cls.category, **defaults
+        )
+        cls.described = Product.objects.create(
+            name="Impact Driver", description="Pairs with any drill bit set", specification="",
+            category=cls.category, **defaults
+        )
+        cls.other = Product.objects.create(name="Garden Rake", description="Steel tines", **defaults)
+
+    def setUp(self):
+        cache.clear()  # cached pages outlive each test's rollback
+
+    def pids(self, query, **kwargs):
+        return [pid for pid, _ in search.ranked_pids(query, **kwargs)]
+
+    def test_ranks_name_matches_above_description_matches(self):
+        self.assertEqual(self.pids("drill"), [self.named.pid, self.described.pid])
+        self.assertEqual(self.pids("drilling"), [self.named.pid, self.described.pid])  # stemmed
+        self.assertEqual(self.pids("cordl"), [self.named.pid])  # prefix
+
+    def test_matches_category_and_filters_by_it(self):
+        self.assertEqual(set(self.pids("power")), {self.named.pid, self.described.pid})
+        self.assertEqual(self.pids("steel"), [self.other.pid])
+        self.assertEqual(self.pids("steel", category_name="Power Tools"), [])
+
+    def test_index_follows_writes(self):
+        self.other.name = "Garden Drill Auger"
+        self.other.save()
+        self.assertIn(self.other.pid, self.pids("auger"))
+
+        self.category.name = "Cordless Tools"
+        self.category.save()
+        self.assertEqual(set(self.pids("cordless tools")), {self.named.pid, self.described.pid})
+
+        self.described.delete()
+        self.assertEqual(self.pids("driver"), [])
+
+    def test_ensure_index_restores_dropped_triggers(self):
+        with connection.cursor() as cursor:
+            cursor.execute("DROP TRIGGER hardware_product_fts_insert")
+        Product.objects.create(name="Torque Wrench", price=5, image="x.webp")
+        search.ensure_index()
+        self.assertEqual(len(self.pids("torque")), 1)
+
+    def test_keyset_pages_cover_the_ranking_once(self):
+        for i in range(5):
+            Product.objects.create(name=f"Drill Stand {i}", price=5, image="x.webp", category=self.category)
+        expected = self.pids("drill")
+        seen, after = [], None
+        while True:
+            products, cursor = search.search_page("drill", after=search.decode_cursor(after), size=2)
+            seen.extend(p.pid for p in products)
+            if cursor is None:
+                break
+            after = cursor
+        self.assertEqual(seen, expected)
+
+        browsed, cursor = search.search_page("", category_name="Power Tools", size=10)
+        self.assertEqual([p.pid for p in browsed], sorted(p.pid for p in browsed))
+        self.assertIsNone(cursor)
+        self.assertIsNone(search.decode_cursor("not-a-cursor"))
+
+    def test_cached_pages_cost_one_query_until_the_catalog_changes(self):
+        products = search.cached_results("drill")[0]
+        search.cached_categories()
+        self.assertEqual([p.pid for p in products], [self.named.pid, self.described.pid])
+        with self.assertNumQueries(1):
+            self.assertEqual(search.cached_results("  DRILL ")[0], products)
+            search.cached_categories()
+
+        self.other.description = "Drill-free assembly"
+        self.other.save()
+        self.assertIn(self.other.pid, [p.pid for p in search.cached_results("drill")[0]])
+        self.assertNotEqual(search.cached_results("")[0], search.cached_results("?!")[0])
+
+    def test_search_view_uses_ranked_results(self):
+        user = User.objects.create_user(username="searcher", email="s@example.com", password="x")
+        self.client.force_login(user)
+        response = self.client.get("/search/", {"query": "drill"})
+        self.assertEqual([p.pid for p in response.context["products"]], [self.named.pid, self.described.pid])
+        self.assertIsNone(response.context["next_page_url"])
+        self.assertLessEqual(len(response.context["recommended_products"]), settings.SEARCH_RECOMMENDATION_LIMIT)
+
+        grinder = Product.objects.create(name="Bench Grinder", price=5, image="x.webp", category=self.category)
+        with self.settings(SEARCH_PAGE_SIZE=1):
+            response = self.client.get("/search/", {"query": "drill"})
+            self.assertEqual([p.pid for p in response.context["products"]], [self.named.pid])
+            # The driver matched too (it is on page 2), so it is not recommended
+            self.assertEqual([p.pid for p in response.context["recommended_products"]], [grinder.pid])
+            response = self.client.get("/search/" + response.context["next_page_url"])
+            self.assertEqual([p.pid for p in response.context["products"]], [self.described.pid])
+        search_log.flush()
+        self.assertEqual(SearchHistory.objects.filter(user=user).count(), 1)  # not once per page (or per repeat)
+
+
+class AutocompleteTests(TestCase):
+    """Suggestions come from memory, follow catalog writes and rank by popularity."""
+
+    @classmethod
+    def setUpClass(cls):
+        # Tests build the index themselves (catalog writes would start a rebuild thread)
+        for target in ((recommender, "schedule_refit"), (autocomplete, "schedule_rebuild")):
+            patcher = mock.patch.object(*target)
+            patcher.start()
+            cls.addClassCleanup(patcher.stop)
+        super().setUpClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name="Power Tools")
+        cls.drill = Product.objects.create(name="Cordless Drill", price=10, image="x.webp", category=cls.category)
+        cls.driver = Product.objects.create(name="Impact Driver", price=10, image="x.webp")
+        user = User.objects.create_user(username="typer", email="t@example.com", password="x")
+        ProductView.objects.create(user=user, product=cls.driver)
+        for query in ("drill bits", "Drill  Bits", "dremel"):  # "dremel" only once: not popular
+            SearchHistory.objects.create(user=user, query=query)
+
+    def setUp(self):
+        self.addCleanup(setattr, autocomplete, "_index", autocomplete._index)
+        autocomplete._index = autocomplete.build_index()
+
+    def texts(self, prefix):
+        return [s.text for s in autocomplete.suggest(prefix)]
+
+    def test_prefix_matches_any_word_ranked_by_weight(self):
+        # "drill bits" (searched twice) ties with "Impact Driver" (viewed once); ties go alphabetically
+        self.assertEqual(self.texts("dr"), ["drill bits", "Impact Driver", "Cordless Drill"])
+        self.assertEqual(self.texts("drill b"), ["drill bits"])
+        self.assertEqual(self.texts("tool"), ["Power Tools"])
+        self.assertEqual(self.texts("dre"), [])
+        self.assertEqual(self.texts("  "), [])
+
+    def test_incremental_updates(self):
+        self.drill.name = "Hammer Drill"
+        self.drill.save()
+        self.assertIn("Hammer Drill", self.texts("ham"))
+        self.assertNotIn("Cordless Drill", self.texts("cord"))
+
+        Product.objects.create(name="Drywall Saw", price=5, image="x.webp")
+        self.assertIn("Drywall Saw", self.texts("dryw"))
+        self.driver.delete()
+        self.assertEqual(self.texts("impact"), [])
+
+        self.category.name = "Cordless Tools"
+        self.category.save()
+        self.assertEqual(self.texts("cordless"), ["Cordless Tools"])
+
+        fresh = autocomplete.build_index()
+        for prefix in ("d", "dr", "dri", "ham", "co", "t"):
+            self.assertEqual(
+                [s.text for s in autocomplete._index.lookup(prefix, 20)],
+                [s.text for s in fresh.lookup(prefix, 20)],
+            )
+
+    def test_follows_catalog_writes_made_by_other_workers(self):
+        self.addCleanup(setattr, autocomplete, "_next_follow", autocomplete._next_follow)
+        autocomplete._next_follow = 0.0
+        # Another worker renamed the drill: the shared catalog version moved, this index did not
+        Product.objects.filter(pk=self.drill.pk).update(name="Hammer Drill")
+        versions.bump(versions.CATALOG)
+        with mock.patch.object(autocomplete, "schedule_rebuild", side_effect=autocomplete._rebuild) as rebuild, \
+                mock.patch.object(connection, "close"):
+            self.assertEqual(self.texts("ham"), [])  # served from the old index while it rebuilds
+            self.assertEqual(self.texts("ham"), ["Hammer Drill"])
+            self.assertEqual(self.texts("ham"), ["Hammer Drill"])
+        rebuild.assert_called_once_with()
+
+    def test_endpoint_does_not_query_the_database(self):
+        with self.assertNumQueries(0):
+            response = self.client.get("/autocomplete/", {"q": "cord"})
+        self.assertEqual(response.json()["suggestions"], [
+            {"text": "Cordless Drill", "kind": "product", "url": f"/productdetail/{self.drill.pid}/"},
+        ])
+        self.assertEqual(self.client.get("/autocomplete/", {"q": "x", "limit": "many"}).status_code, 400)
+
+
+class SearchLogTests(TestCase):
+    """Searches are buffered, coalesced and bulk-written off the request path."""
+
+    def setUp(self):
+        patcher = mock.patch.object(search_log, "_ensure_writer")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(search_log.flush)
+        self.user = User.objects.create_user(username="logger", email="l@example.com", password="x")
+
+    def test_flush_coalesces_and_invalidates_recommendations(self):
+        cache.set(recommender.recommendation_cache_key(self.user.pk), ["stale"])
+        for query in ("drill", "drill", "saw"):
+            search_log.log_search(self.user, query)
+        self.assertFalse(SearchHistory.objects.exists())  # nothing written yet
+
+        with self.assertNumQueries(1):
+            self.assertEqual(search_log.flush(), 2)
+        self.assertEqual(
+            sorted(SearchHistory.objects.values_list("query", flat=True)), ["drill", "saw"]
+        )
+        self.assertIsNone(cache.get(recommender.recommendation_cache_key(self.user.pk)))
+
+    def test_skips_anonymous_users_and_drops_when_full(self):
+        response = self.client.get("/search/", {"query": "drill"})  # used to crash on AnonymousUser
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(search_log.flush(), 0)
+
+        with self.settings(SEARCH_LOG_MAX_PENDING=2), mock.patch.object(metrics, "incr") as incr:
+            for query in ("a", "b", "c"):
+                search_log.log_search(self.user, query)
+        incr.assert_called_once_with("search_log.dropped")
+        self.assertEqual(search_log.flush(), 2)
+
+
+class FacetTests(TestCase):
+    """Facet counts come from one query and leave out their own facet's filter."""
+
+    @classmethod
+    def setUpClass(cls):
+        for target in ((recommender, "schedule_refit"), (search_log, "_ensure_writer")):
+            patcher = mock.patch.object(*target)
+            patcher.start()
+            cls.addClassCleanup(patcher.stop)
+        super().setUpClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.power = Category.objects.create(name="Power Tools")
+        cls.hand = Category.objects.create(name="Hand Tools")
+        rows = [
+            ("Cheap Drill", 300, "Hot", True, cls.power),
+            ("Pro Drill", 8000, "Sale", True, cls.power),
+            ("Drill Bits", 700, "Hot", False, cls.hand),
+            ("Claw Hammer", 450, "", True, cls.hand),
+        ]
+        cls.products = {
+            name: Product.objects.create(
+                name=name, price=price, label=label, in_stock=in_stock, category=category, image="x.webp"
+            )
+            for name, price, label, in_stock, category in rows
+        }
+
+    def setUp(self):
+        cache.clear()
+
+    def params(self, **values):
+        from django.http import QueryDict
+        params = QueryDict(mutable=True)
+        for key, value in values.items():
+            params.setlist(key, value if isinstance(value, list) else [value])
+        return params
+
+    def test_counts_in_one_query_with_drill_down(self):
+        filters = facets.parse_filters(self.params(label="Hot", price=["0-500", "bogus"]), [self.power, self.hand])
+        self.assertEqual(filters, {"price": ("0-500",), "label": ("Hot",)})
+        with self.assertNumQueries(1):
+            counts = facets.facet_counts(Product.objects.all(), filters, [self.power, self.hand])
+        self.assertEqual(counts["total"], 1)  # Cheap Drill
+        self.assertEqual(counts["label"], {"Hot": 1, "Sale": 0, "New": 0})  # within Rs 0-500
+        self.assertEqual(counts["price"]["500-1000"], 1)  # Drill Bits, which is Hot
+        self.assertEqual(counts["cid"], {self.power.cid: 1, self.hand.cid: 0})
+
+    def test_search_narrows_by_facets(self):
+        response = self.client.get("/search/", {"query": "drill", "in_stock": "1", "cid": self.power.cid})
+        self.assertEqual(
+            {p.name for p in response.context["products"]}, {"Cheap Drill", "Pro Drill"}
+        )
+        self.assertEqual(response.context["facet_total"], 2)
+        groups = {group["name"]: group for group in response.context["facet_groups"]}
+        # Drill Bits is out of stock, so Hand Tools has nothing to offer and is hidden
+        [power] = groups["cid"]["options"]
+        self.assertEqual((power["value"], power["count"], power["selected"]), (self.power.cid, 2, True))
+        self.assertEqual(power["url"], "?query=drill&in_stock=1")  # toggles the category off
+
+    def test_category_page_filters(self):
+        response = self.client.get("/powertool/", {"label": "Sale"})
+        self.assertEqual([p.name for p in response.context["products"]], ["Pro Drill"])
+        self.assertNotIn("cid", [group["name"] for group in response.context["facet_groups"]])
+
+
+class CategoryListingTests(TestCase):
+    """One keyset-paged, cached listing serves every category."""
+
+    @classmethod
+    def setUpClass(cls):
+        patcher = mock.patch.object(recommender, "schedule_refit")
+        patcher.start()
+        cls.addClassCleanup(patcher.stop)
+        super().setUpClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name="Power Tools")
+        cls.products = [
+            Product.objects.create(name=f"Tool {i}", price=price, image="x.webp", category=cls.category)
+            for i, price in enumerate([300, 100, 300, 250, 999, 100, 50])
+        ]
+        Product.objects.create(name="Elsewhere", price=1, image="x.webp")
+        cls.user = User.objects.create_user(username="rater", email="r@example.com", password="x")
+
+    def setUp(self):
+        cache.clear()
+
+    def walk(self, sort, size=3):
+        seen, after = [], None
+        while True:
+            page, after = listing.listing_page(self.category, sort, after=after, size=size)
+            seen.extend(p.pid for p in page)
+            if after is None:
+                return seen
+
+    def test_keyset_pages_match_the_full_order(self):
+        by_price = sorted(self.products, key=lambda p: (p.price, p.pid))
+        self.assertEqual(self.walk("price"), [p.pid for p in by_price])
+        newest = sorted(self.products, key=lambda p: (p.created_at, p.pid), reverse=True)
+        self.assertEqual(self.walk("newest"), [p.pid for p in newest])
+
+        Product_Review.objects.create(user=self.user, product=self.products[3], review="ok", rating=3)
+        Product_Review.objects.create(user=self.user, product=self.products[5], review="great", rating=5)
+        rated = self.walk("rating")
+        self.assertEqual(rated[:2], [self.products[5].pid, self.products[3].pid])
+        self.assertEqual(sorted(rated[2:]), rated[2:])  # unrated, by pid
+
+    def test_rendered_page_is_cached_until_a_write(self):
+        url = f"/category/{self.category.cid}/"
+        first = self.client.get(url, {"sort": "price"}).content
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url, {"sort": "price"}).content, first)
+
+        self.products[0].name = "Renamed Tool"
+        self.products[0].save()
+        self.assertIn(b"Renamed Tool", self.client.get(url, {"sort": "price"}).content)
+
+    def test_facet_counts_cover_this_category_only(self):
+        namesake = Category.objects.create(name="Power Tools")
+        Product.objects.create(name="Namesake Tool", price=100, image="x.webp", category=namesake)
+        counts = listing.cached_counts(self.category, {})
+        self.assertEqual(counts["total"], len(self.products))
+        self.assertEqual(listing.cached_counts(namesake, {})["total"], 1)
+        self.assertNotIn("cid", counts)
+
+    def test_old_urls_and_unknown_categories(self):
+        response = self.client.get("/powertool/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context["products"]), len(self.products))
+        self.assertEqual(self.client.get("/handtool/").status_code, 404)
+        self.assertEqual(self.client.get("/category/nope/").status_code, 404)
+
+
+class ConditionalGetTests(TestCase):
+    """Unchanged catalog pages revalidate with a 304 before the view runs."""
+
+    @classmethod
+    def setUpClass(cls):
+        patcher = mock.patch.object(recommender, "schedule_refit")
+        patcher.start()
+        cls.addClassCleanup(patcher.stop)
+        super().setUpClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name="Hand Tools", image="categories/hand.webp")
+        cls.product = Product.objects.create(name="Chisel", price=80, image="x.webp", category=cls.category)
+
+    def test_revalidation_without_queries_until_a_write(self):
+        url = f"/category/{self.category.cid}/"
+        response = self.client.get(url)
+        etag, last_modified = response["ETag"], response["Last-Modified"]
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+            self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+
+        Product_Review.objects.create(product=self.product, review="sharp", rating=5)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_similar_product_rebuild_changes_the_product_page(self):
+        url = f"/productdetail/{self.product.pid}/"
+        etag = self.client.get(url)["ETag"]
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.addCleanup(setattr, recommender, "_snapshot", recommender.current_model())
+        recommender.build_similar_products(model=recommender.train_model())
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_personal_pages_are_validated_for_anonymous_visitors_only(self):
+        self.assertTrue(self.client.get("/collection/").has_header("ETag"))
+        self.assertTrue(self.client.get("/first/").has_header("ETag"))
+
+        user = User.objects.create_user(username="member", email="m@example.com", password="x")
+        self.client.force_login(user)
+        with mock.patch.object(recommender, "recommend_for_user", return_value=[]):
+            self.assertFalse(self.client.get("/first/").has_header("ETag"))
+        self.assertTrue(self.client.get("/collection/").has_header("ETag"))
+
+    def test_pending_messages_skip_validation(self):
+        self.client.cookies["messages"] = "pending"
+        self.assertFalse(self.client.get("/collection/").has_header("ETag"))
+
+
+class SharedVersionTests(SimpleTestCase):
+    """A version bump made by one worker process is seen by the others."""
+
+    def test_bump_in_another_process(self):
+        self.assertNotIn("locmem", settings.CACHES["default"]["BACKEND"])
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        backend = {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": directory}
+        with self.settings(CACHES={"default": backend}):
+            before = versions.current(versions.CATALOG)
+            env = {key: value for key, value in os.environ.items() if key != "REDIS_URL"}
+            subprocess.run(
+                [sys.executable, "manage.py", "shell", "-c",
+                 "from hardware import versions; versions.bump(versions.CATALOG)"],
+                cwd=settings.BASE_DIR, env={**env, "TOOLHUB_CACHE_DIR": directory}, check=True, capture_output=True,
+            )
+            self.assertEqual(versions.current(versions.CATALOG), before + 1)
+
+
+class ProductCardCacheTests(TestCase):
+    """Product cards come from one batched cache lookup and re-render after a save."""
+
+    @classmethod
+    def setUpClass(cls):
+        patcher = mock.patch.object(recommender, "schedule_refit")
+        patcher.start()
+        cls.addClassCleanup(patcher.stop)
+        super().setUpClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.products = [
+            Product.objects.create(name=f"Card {i}", price=100 + i, image="x.webp", label="Hot") for i in range(5)
+        ]
+
+    def setUp(self):
+        cache.clear()
+
+    def render(self, variant="grid"):
+        return product_cards.product_cards(Product.objects.order_by("pid"), variant)
+
+    def test_second_render_is_one_cache_read(self):
+        first = self.render()
+        self.assertIn('class="badge hot"', str(first[0][1]))
+        with mock.patch.object(product_cards.cache, "get_many", wraps=cache.get_many) as get_many, \
+                mock.patch.object(product_cards, "render_to_string") as render:
+            self.assertEqual(self.render(), first)
+        get_many.assert_called_once()
+        render.assert_not_called()
+        self.assertIn('class="badge1 hot"', str(self.render("similar")[0][1]))
+
+    def test_saved_product_is_rendered_again(self):
+        self.render()
+        product = Product.objects.get(pk=self.products[2].pk)
+        product.name = "Renamed Card"
+        product.save()
+        cards = dict((p.pid, str(card)) for p, card in self.render())
+        self.assertIn("Renamed Card", cards[product.pid])
+        self.assertIn("Card 0", cards[self.products[0].pid])
+
+
+class PageCacheTests(TestCase):
+    """Anonymous catalog pages are served whole from the cache until a write."""
+
+    @classmethod
+    def setUpClass(cls):
+        patcher = mock.patch.object(recommender, "schedule_refit")
+        patcher.start()
+        cls.addClassCleanup(patcher.stop)
+        super().setUpClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name="Garden", image="categories/garden.webp")
+        cls.product = Product.objects.create(name="Rake", price=120, image="x.webp", category=cls.category)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_hits_skip_the_database_until_a_review(self):
+        url = f"/productdetail/{self.product.pid}/"
+        first = self.client.get(url)
+        self.assertContains(first, 'href="/user/login/"')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).content, first.content)
+
+        Product_Review.objects.create(product=self.product, review="Sturdy handle", rating=4)
+        self.assertContains(self.client.get(url), "Sturdy handle")
+
+    def test_query_string_order_does_not_matter(self):
+        url = f"/category/{self.category.cid}/"
+        self.client.get(url, {"sort": "price", "in_stock": "1"})
+        with self.assertNumQueries(0):
+            self.client.get(f"{url}?in_stock=1&sort=price")
+
+    def test_session_cookie_bypasses_the_cache(self):
+        self.client.get("/collection/")
+        user = User.objects.create_user(username="gardener", email="g@example.com", password="x")
+        self.client.force_login(user)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get("/collection/").status_code, 200)
+        self.assertTrue(queries.captured_queries)
+        self.assertEqual(self.client.get("/productdetail/missing/").status_code, 404)
+
+    def test_home_page_is_cached_for_anonymous_visitors_only(self):
+        self.client.get("/first/")
+        with self.assertNumQueries(0):
+            anonymous = self.client.get("/first/")
+        self.product.featured = True
+        self.product.save()
+        self.assertNotEqual(self.client.get("/first/").content, anonymous.content)
+
+        user = User.objects.create_user(username="planter", email="p@example.com", password="x")
+        self.client.force_login(user)
+        with mock.patch("hardware.views.recommend_for_user", return_value=[]) as recommend:
+            self.client.get("/first/")
+            self.client.get("/first/")
+        self.assertEqual(recommend.call_count, 2)
@@ -0,0 +1,183 @@
+"""
+Parallel offline training for the TF-IDF recommender.
+
+Products are streamed from the database in chunks, and every chunk is one
+shard for a process pool. There are two passes over the stream:
+
+1. Each shard counts document frequencies. The parent sums them into the
+   vocabulary and idf weights, with the same defaults as
+   TfidfVectorizer(stop_words='english').fit().
+2. Each shard is transformed with that fixed vocabulary, which workers
+   read once from a temporary file. The parent stacks the CSR shards in
+   stream order.
+
+The result matches a single-core fit_transform(). No process ever holds
+more than a few chunks of text at a time.
+
+Workers are started with the "spawn" method and only touch scikit-learn
+and numpy, so they never inherit or open a database connection.
+"""
+import multiprocessing
+import os
+import pickle
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+STOP_WORDS = "english"
+
+_worker_vectorizer = (None, None)  # (model file, vectorizer) cached per worker process
+
+
+def _count_terms(docs):
+    """Pass 1: document frequency of every term in one shard."""
+    counter = CountVectorizer(stop_words=STOP_WORDS, binary=True)
+    try:
+        counts = counter.fit_transform(docs)
+    except ValueError:  # shard has no terms at all (empty vocabulary)
+        return {}
+    df = np.asarray(counts.sum(axis=0)).ravel()
+    return dict(zip(counter.get_feature_names_out(), df.tolist()))
+
+
+def _make_vectorizer(vocabulary, idf):
+    vectorizer = TfidfVectorizer(stop_words=STOP_WORDS, vocabulary=vocabulary)
+    vectorizer.idf_ = idf
+    return vectorizer
+
+
+def _transform_shard(task):
+    """Pass 2: TF-IDF rows of one shard as plain arrays (cheap to pickle)."""
+    global _worker_vectorizer
+    model_path, docs = task
+    if _worker_vectorizer[0] != model_path:
+        with open(model_path, "rb") as f:
+            _worker_vectorizer = (model_path, _make_vectorizer(*pickle.load(f)))
+    matrix = _worker_vectorizer[1].transform(docs)
+    return matrix.data, matrix.indices, matrix.indptr
+
+
+def stream_documents(chunk_size):
+    """Yield (pids, docs) chunks of the catalog in primary-key order."""
+    from hardware.models import Product
+    from hardware.recommender import DOCUMENT_FIELDS, product_document
+
+    pids, docs = [], []
+    rows = (
+        Product.objects.order_by("pk")
+        .values_list("pid", *DOCUMENT_FIELDS)
+        .iterator(chunk_size=chunk_size)
+    )
+    for pid, *fields in rows:
+        pids.append(pid)
+        docs.append(product_document(*fields))
+        if len(docs) >= chunk_size:
+            yield pids, docs
+            pids, docs = [], []
+    if docs:
+        yield pids, docs
+
+
+def _bounded_map(pool, fn, items, limit):
+    """Like pool.map, but keeps at most `limit` shards in flight so text never piles up."""
+    pending = []
+    for item in items:
+        pending.append(pool.submit(fn, item))
+        if len(pending) >= limit:
+            yield pending.pop(0).result()
+    for future in pending:
+        yield future.result()
+
+
+def peak_memory_mb():
+    """Peak resident memory of this process and of its finished children, in MB (Linux)."""
+    if resource is None:
+        return None, None
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return own / 1024, children / 1024
+
+
+def train_parallel(workers=None, chunk_size=5000):
+    """
+    Fit the TF-IDF model across `workers` processes.
+    Returns (vectorizer, csr_matrix, pids, stats) or None if there are no products.
+    """
+    workers = workers or os.cpu_count() or 1
+    in_flight = workers * 2
+    context = multiprocessing.get_context("spawn")
+    started = time.perf_counter()
+
+    df = Counter()
+    n_docs = 0
+    pids, data, indices, indptrs = [], [], [], [np.zeros(1, dtype=np.int64)]
+    offset = 0
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool, \
+            tempfile.TemporaryDirectory() as tmp:
+        # Pass 1: vocabulary and document frequencies
+        def count_shards():
+            nonlocal n_docs
+            for _, docs in stream_documents(chunk_size):
+                n_docs += len(docs)
+                yield docs
+
+        for shard_df in _bounded_map(pool, _count_terms, count_shards(), in_flight):
+            df.update(shard_df)
+        if not n_docs:
+            return None
+        vocab_time = time.perf_counter() - started
+
+        terms = sorted(df)
+        vocabulary = {term: i for i, term in enumerate(terms)}
+        doc_freq = np.array([df[term] for term in terms], dtype=np.float64)
+        idf = np.log((1 + n_docs) / (1 + doc_freq)) + 1  # smooth_idf=True, as in TfidfVectorizer
+        model_path = os.path.join(tmp, "vocabulary.pkl")
+        with open(model_path, "wb") as f:
+            pickle.dump((vocabulary, idf), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        # Pass 2: transform shards against the fixed vocabulary
+        def transform_shards():
+            for chunk_pids, docs in stream_documents(chunk_size):
+                pids.extend(chunk_pids)
+                yield model_path, docs
+
+        for shard_data, shard_indices, shard_indptr in _bounded_map(
+            pool, _transform_shard, transform_shards(), in_flight
+        ):
+            data.append(shard_data)
+            indices.append(shard_indices)
+            indptrs.append(shard_indptr[1:].astype(np.int64) + offset)
+            offset += len(shard_data)
+
+    indptr = np.concatenate(indptrs)
+    index_dtype = np.int32 if offset < np.iinfo(np.int32).max else np.int64
+    matrix = sparse.csr_matrix(
+        (np.concatenate(data), np.concatenate(indices).astype(index_dtype), indptr.astype(index_dtype)),
+        shape=(len(pids), len(vocabulary)),
+    )
+
+    elapsed = time.perf_counter() - started
+    parent_mb, children_mb = peak_memory_mb()
+    stats = {
+        "documents": len(pids),
+        "terms": len(vocabulary),
+        "nnz": int(matrix.nnz),
+        "workers": workers,
+        "vocabulary_seconds": round(vocab_time, 3),
+        "total_seconds": round(elapsed, 3),
+        "docs_per_second": round(len(pids) / elapsed, 1) if elapsed else None,
+        "peak_memory_mb": parent_mb and round(parent_mb, 1),
+        "peak_worker_memory_mb": children_mb and round(children_mb, 1),
+    }
+    return _make_vectorizer(vocabulary, idf), matrix, pids, stats
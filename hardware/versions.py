@@ -0,0 +1,62 @@
+"""
+Named version counters for cache keys.
+
+A cached page is stored under the version of everything it was built
+from ("catalog" for products and categories, "reviews" for ratings,
+"similar" for the precomputed similar-product lists).
+Writes bump the counter through signals, which orphans every entry
+built from the old version at once; the orphans age out through the
+cache's own culling and timeouts.
+
+Counters live in the default cache, which settings.CACHES points at a
+backend every worker shares (Redis, or files on a single host); a bump
+made by one worker is seen by the next request on any other. With a
+per-process cache such as LocMemCache it would not be. A counter starts
+from the clock, so one that was evicted or culled never comes back as an
+old version. Each counter also records when it last moved, for
+Last-Modified headers.
+"""
+import time
+from datetime import datetime, timezone
+
+from django.core.cache import cache
+
+CATALOG = "catalog"
+REVIEWS = "reviews"
+SIMILAR = "similar"  # SimilarProduct rows (rewritten by the recommender)
+
+
+def _key(name):
+    return f"{name}:version"
+
+
+def _changed_key(name):
+    return f"{name}:changed"
+
+
+def current(name):
+    version = cache.get(_key(name))
+    if version is None:
+        now = time.time_ns()
+        # Whatever happened while the counter was gone, treat it as changed now
+        cache.set(_changed_key(name), now // 1000 ** 3, timeout=None)
+        cache.add(_key(name), now, timeout=None)
+        version = cache.get(_key(name))
+    return version
+
+
+def changed_at(name):
+    """When the counter last moved (to the second), or when it was started if it never has."""
+    changed = cache.get(_changed_key(name))
+    if changed is None:
+        cache.add(_changed_key(name), int(time.time()), timeout=None)
+        changed = cache.get(_changed_key(name))
+    return datetime.fromtimestamp(changed, tz=timezone.utc)
+
+
+def bump(name):
+    cache.set(_changed_key(name), int(time.time()), timeout=None)
+    try:
+        cache.incr(_key(name))
+    except ValueError:  # not set yet (or evicted)
+        current(name)
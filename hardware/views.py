@@ -1,6 +1,6 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import HttpResponse,HttpResponseBadRequest
-from hardware.models import Product, Category, cartOrder,cartOrderItem, Wishlist, ProductImage,Product_Review,Order,OrderItem,ProductView,SearchHistory
+from django.http import Http404,HttpResponse,HttpResponseBadRequest,JsonResponse
+from hardware.models import Product, Category, cartOrder,cartOrderItem, Wishlist, ProductImage,Product_Review,Order,OrderItem,ProductView
 from hardware.form import ReviewForm , OrderForm
 from django.contrib.auth.models import User
 import uuid
@@ -16,12 +16,22 @@ import hmac
 import hashlib
 import base64
 import json
-from .recommender import  knn_similar_products
+from .recommender import similar_products_for
 from .recommender import recommend_for_user
+from . import autocomplete, metrics, search_log
+from .search import cached_categories, cached_facets, cached_results, decode_cursor
+from . import facets, listing, versions
+from .conditional import validated_by
+from .page_cache import cached_page
+from urllib.parse import urlencode
 
 
 
 # # view for index page.
+# Anonymous visitors get ETag/Last-Modified from the catalog version (see hardware/conditional.py),
+# and the featured-products page they all share comes from the page cache
+@validated_by(versions.CATALOG, personal=True)
+@cached_page(versions.CATALOG)
 def index(request):
     featured_products = Product.objects.filter(featured=True)
 
@@ -40,6 +50,7 @@ def index(request):
     return render(request, 'hardware/index.html', context)
 
 #view for landing page
+@cached_page()
 def landingpage(request):
     return render(request, 'hardware/landingpage.html')
 
@@ -54,6 +65,7 @@ def loginpage(request):
 
 
 #view for aboutus page
+@cached_page()
 def aboutpage(request):
     return render(request, 'hardware/aboutus.html')
 
@@ -145,6 +157,8 @@ def updateprofilepage(request):
 
 
 #view for collection page
+@validated_by(versions.CATALOG)
+@cached_page(versions.CATALOG)
 def collectionpage(request):
     
     categories = Category.objects.all()
@@ -156,85 +170,39 @@ def collectionpage(request):
 
 
 
-#view for product category pages
-def powertools(request):
-    products = Product.objects.filter(category__name='Power Tools')
+#view for product category pages (see hardware/listing.py)
+@validated_by(versions.CATALOG, versions.REVIEWS)
+@cached_page(versions.CATALOG, versions.REVIEWS)
+def category_page(request, cid):
+    categories = cached_categories()
+    category = next((c for c in categories if c.cid == cid), None)
+    if category is None:
+        raise Http404("No such category")
     context = {
-        'products': products
+        'category': category,
+        'listing': listing.render_listing(category, request.GET, categories),
     }
-    
-    return render(request, 'hardware/powertool.html', context)
-
-
+    return render(request, 'hardware/category.html', context)
 
 
-def handTools(request):
-    products = Product.objects.filter(category__name='Hand Tools')
-    context = {
-        'products': products
-    }
-    
-    return render(request, 'hardware/handtool.html', context)
-
-def gardenTools(request):
-    products = Product.objects.filter(category__name='Garden & Outdoor')
-    context = {
-        'products': products
-    } 
-    
-    return render(request, 'hardware/gardentool.html', context)
-
-def plumbingTools(request):
-    products = Product.objects.filter(category__name='Plumbing Supplies')
-    context = {
-        'products': products
-    }
-    
-    return render(request, 'hardware/plumbingtool.html', context)
-
-def electricalTools(request):
-    
-    products = Product.objects.filter(category__name='Electrical Supplies')
-    context = {
-        'products': products
-    }
-    
-    return render(request, 'hardware/electricaltool.html', context)
-
-def measuringTools(request):
-    products = Product.objects.filter(category__name='Measuring Tools')
-    context = {
-        'products': products
-    }
-    
-    return render(request, 'hardware/Measuringtool.html', context)
-
-def agricultureTools(request):
-    products = Product.objects.filter(category__name='Agricultural Tools')
-    context = {
-        'products': products
-    }
-    
-    return render(request, 'hardware/agriculturaltool.html', context)
-
-def bathroomTools(request):
-    products = Product.objects.filter(category__name='Bathroom utensils')
-    context = {
-        'products': products
-    }
-    
-    return render(request, 'hardware/bathroom.html', context)
+# The original per-category URLs (/powertool/ and so on) name their category
+def category_by_name(request, name):
+    category = next((c for c in cached_categories() if c.name == name), None)
+    if category is None:
+        raise Http404("No such category")
+    return category_page(request, category.cid)
 
 
 #view for product details page
+@validated_by(versions.CATALOG, versions.REVIEWS, versions.SIMILAR, personal=True)
+@cached_page(versions.CATALOG, versions.REVIEWS, versions.SIMILAR)
 def productDetailpage(request, pid):
-    product = Product.objects.get(pid=pid)  # get() returns a single product
+    product = get_object_or_404(Product, pid=pid)
     reviews = Product_Review.objects.filter(product=product)
     track_product_view(request.user, product)
     
-    #similar_products = recommend_similar_to_product(product.pid)
-    similar_products = []
-    similar_products = knn_similar_products(product, top_n=4)
+    # Read from the precomputed SimilarProduct table (one indexed query)
+    similar_products = similar_products_for(product, top_n=4)
    
 
     if request.method == "POST":
@@ -346,32 +314,41 @@ def remove_from_cart(request, pid):
 def searchs(request):
     query = request.GET.get('query', '')
     category_name = request.GET.get('category')
-    categories = Category.objects.all()
-    products = Product.objects.all()
-
-    if query:
-        SearchHistory.objects.create(user=request.user, query=query)
-        products = products.filter(name__icontains=query)
-
-    if category_name:
-        products = products.filter(category__name=category_name)
-
-    # Recommend similar products based on category if at least one result is found
-    recommended_products = []
-    if products.exists():
-        category = products.first().category
-        recommended_products = Product.objects.filter(category=category).exclude(
-            pid__in=products.values_list('pid', flat=True)
-        )
-
+    after = decode_cursor(request.GET.get('after'))
+    categories = cached_categories()
+    filters = facets.parse_filters(request.GET, categories)
+
+    if query and after is None:
+        # Log the search once, not again for every further page. Buffered and
+        # written in the background, so the request never waits on the insert
+        search_log.log_search(request.user, query)
+    # One page, ordered by (bm25 rank, pid), plus a few other products from the
+    # first result's category. Cached until the catalog changes (see hardware.search)
+    products, next_cursor, recommended_products = cached_results(query, category_name, after, filters)
+    counts = cached_facets(query, category_name, filters)
+
+    params = [(key, value) for key in request.GET for value in request.GET.getlist(key) if key != 'after']
     context = {
         'products': products,
         'recommended_products': recommended_products,
         'categories': categories,
+        'facet_groups': facets.facet_groups(counts, filters, request.GET, categories),
+        'facet_total': counts['total'],
+        'next_page_url': f"?{urlencode(params + [('after', next_cursor)])}" if next_cursor else None,
+        'first_page_url': f"?{urlencode(params)}" if after else None,
     }
     return render(request, 'hardware/search.html', context)
 
 
+# JSON suggestions for the search box, served from memory (no database query)
+def autocomplete_view(request):
+    try:
+        limit = int(request.GET.get('limit', settings.AUTOCOMPLETE_LIMIT))
+    except ValueError:
+        return HttpResponseBadRequest("limit must be an integer")
+    suggestions = autocomplete.suggest(request.GET.get('q', ''), limit=max(limit, 1))
+    return JsonResponse({'suggestions': [s.as_dict() for s in suggestions]})
+
 
 #view for checkout page
 def checkoutpage(request):
@@ -636,3 +613,17 @@ def payment_failure(request):
 
 
 
+
+
+#view for recommender metrics (Prometheus text format)
+def metrics_view(request):
+    # REMOTE_ADDR is the proxy's address behind one, so scrapers send the token instead
+    token = settings.METRICS_TOKEN
+    header = request.META.get('HTTP_AUTHORIZATION', '')
+    scraper = bool(token) and hmac.compare_digest(header.encode(), f'Bearer {token}'.encode())
+    if not (scraper or request.user.is_staff):
+        return HttpResponse(status=403)
+
+    sink = metrics.histogram()
+    body = sink.prometheus_text() if sink else ''
+    return HttpResponse(body, content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -6,9 +6,21 @@ It is read-only: model save/delete operations are disabled while this runs.
 Usage:
   - Place this file in the project root (same folder as manage.py).
   - Activate your project's virtualenv.
-  - Run: python knn_evaluation_db.py
+  - Run: python knn_evaluation_db.py [--mode loop|batched|grid]
+
+Modes:
+  batched  (default) one split, all test rows queried in a single kneighbors call,
+           majority vote with numpy bincount
+  loop     the original one-query-per-test-row evaluation, for comparison
+  grid     every K_GRID x MAX_FEATURES_GRID combination over CV_REPEATS x CV_FOLDS
+           cross-validated splits in a process pool; prints a latency/quality table
+           and writes it to GRID_RESULTS_CSV
 """
 
+import argparse
+import csv
+import multiprocessing
+
 import os
 import sys
 import time
@@ -30,6 +42,18 @@ TEST_SIZE = 0.25
 K_NEIGHBORS = 5
 MAX_FEATURES = 2000  # TF-IDF max features
 
+# Grid mode
+K_GRID = (1, 3, 5, 7, 9, 15)
+MAX_FEATURES_GRID = (500, 1000, 2000, 5000, None)  # None = whole vocabulary
+CV_FOLDS = 5
+CV_REPEATS = 2
+GRID_WORKERS = None  # None = one per CPU
+GRID_RESULTS_CSV = "knn_grid_results.csv"
+
+parser = argparse.ArgumentParser(description="Evaluate the TF-IDF KNN recommender on the product catalog.")
+parser.add_argument("--mode", choices=("batched", "loop", "grid"), default="batched")
+EVAL_MODE = parser.parse_args().mode
+
 # ------------ Helper: try to auto-detect settings module ------------
 def find_settings_module(start_dir="."):
     """
@@ -163,6 +187,62 @@ if MERGE_RARE:
         print(f"Merging {len(rare_labels)} rare labels into 'OTHER' (examples: {list(rare_labels)[:5]})")
         labels = [("OTHER" if lab in rare_labels else lab) for lab in labels]
 
+# ------------ Grid mode: k x MAX_FEATURES over cross-validated splits ------------
+from hardware import evaluation
+
+
+def run_grid():
+    from concurrent.futures import ProcessPoolExecutor
+    from sklearn.model_selection import RepeatedKFold, RepeatedStratifiedKFold
+
+    classes, codes = evaluation.encode_labels(labels)
+    min_count = min(Counter(labels).values())
+    if min_count >= CV_FOLDS:
+        splitter = RepeatedStratifiedKFold(n_splits=CV_FOLDS, n_repeats=CV_REPEATS, random_state=42)
+    else:
+        print(f"Smallest class has {min_count} samples (< {CV_FOLDS} folds): using non-stratified folds.")
+        splitter = RepeatedKFold(n_splits=CV_FOLDS, n_repeats=CV_REPEATS, random_state=42)
+    splits = list(splitter.split(np.zeros(len(codes)), codes))
+
+    tasks = []
+    for max_features in MAX_FEATURES_GRID:
+        # Fitted on all documents, as in the single-split evaluation below
+        X_all = TfidfVectorizer(stop_words="english", max_features=max_features).fit_transform(docs)
+        for split, (train_idx, test_idx) in enumerate(splits):
+            tasks.append((max_features, split, X_all, codes, train_idx, test_idx, K_GRID, len(classes)))
+
+    print(f"Grid: {len(MAX_FEATURES_GRID)} MAX_FEATURES x {len(K_GRID)} k x {len(splits)} splits "
+          f"= {len(tasks) * len(K_GRID)} evaluations")
+    started = time.time()
+    # Workers are forked: this file is a plain script, so a spawned worker would
+    # re-run it from the top. Where fork is unavailable (Windows) run in-process.
+    if "fork" in multiprocessing.get_all_start_methods():
+        with ProcessPoolExecutor(max_workers=GRID_WORKERS, mp_context=multiprocessing.get_context("fork")) as pool:
+            results = [row for rows in pool.map(evaluation.evaluate_split, tasks) for row in rows]
+    else:
+        results = [row for task in tasks for row in evaluation.evaluate_split(task)]
+    elapsed = time.time() - started
+
+    table = evaluation.summarize(results)
+    print("\n=== KNN Grid Results (mean over splits, best F1 first) ===")
+    print(evaluation.format_table(table))
+    print(f"\nGrid finished in {elapsed:.2f} seconds.")
+    with open(GRID_RESULTS_CSV, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(table[0]))
+        writer.writeheader()
+        writer.writerows(table)
+    print(f"Results saved as {GRID_RESULTS_CSV}")
+
+
+if EVAL_MODE == "grid":
+    run_grid()
+    if '_orig_save' in globals() and _orig_save is not None:
+        dj_models.Model.save = _orig_save
+    if '_orig_delete' in globals() and _orig_delete is not None:
+        dj_models.Model.delete = _orig_delete
+    print("Done.")
+    sys.exit(0)
+
 # ------------ Vectorize ------------
 vectorizer = TfidfVectorizer(stop_words="english", max_features=MAX_FEATURES)
 X = vectorizer.fit_transform(docs)
@@ -202,13 +282,20 @@ knn.fit(X_train)
 # ------------ Evaluate ------------
 y_pred = []
 start_time = time.time()
-for i in range(X_test.shape[0]):
+if EVAL_MODE == "batched":
+    # All test rows in one kneighbors call, vote with bincount
+    classes, train_codes = evaluation.encode_labels(y_train)
     n_req = min(k, X_train.shape[0])
-    distances, indices = knn.kneighbors(X_test[i], n_neighbors=n_req)
-    neighbor_labels = [y_train[j] for j in indices[0]]
-    # majority vote (tie handled by set order; acceptable for evaluation)
-    pred = max(set(neighbor_labels), key=neighbor_labels.count)
-    y_pred.append(pred)
+    indices = knn.kneighbors(X_test, n_neighbors=n_req, return_distance=False)
+    y_pred = list(classes[evaluation.majority_vote(train_codes[indices], len(classes))])
+else:
+    for i in range(X_test.shape[0]):
+        n_req = min(k, X_train.shape[0])
+        distances, indices = knn.kneighbors(X_test[i], n_neighbors=n_req)
+        neighbor_labels = [y_train[j] for j in indices[0]]
+        # majority vote (tie handled by set order; acceptable for evaluation)
+        pred = max(set(neighbor_labels), key=neighbor_labels.count)
+        y_pred.append(pred)
 end_time = time.time()
 exec_time = end_time - start_time
 
@@ -221,6 +308,7 @@ print("\n=== KNN Evaluation Results (DB) ===")
 print(f"Products total        : {n_products}")
 print(f"Train samples         : {X_train.shape[0]}")
 print(f"Test samples          : {X_test.shape[0]}")
+print(f"Mode                  : {EVAL_MODE}")
 print(f"K (neighbors)         : {k}")
 print(f"Precision (weighted)  : {precision:.4f}")
 print(f"Recall (weighted)     : {recall:.4f}")
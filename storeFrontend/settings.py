@@ -144,4 +144,99 @@ JAZZMIN_SETTINGS = {
     'image_logo': "logo.png" 
 }
 
-AUTH_USER_MODEL = 'userauths.User'  # Custom user model
\ No newline at end of file
+AUTH_USER_MODEL = 'userauths.User'  # Custom user model
+
+# Cache, shared by every worker process: Redis when REDIS_URL is set (across
+# hosts), otherwise files under TOOLHUB_CACHE_DIR (the processes of one host).
+# The cache version counters (hardware/versions.py) live here, so it must be
+# shared: with a per-process cache a write on one worker would leave the
+# others serving pages built before it.
+#
+# Multi-worker deployments should set REDIS_URL (with maxmemory-policy
+# allkeys-lru). The file backend is for development and single-host setups:
+#   - past MAX_ENTRIES it culls a third of the entries at random, not the
+#     least recently used
+#   - add()/incr() are not atomic across processes (the recommender's refit
+#     lock is an flock() for that reason, see recommender._take_refit_lock)
+#   - get_many() is one file read per key, where Redis does one round trip
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+            'TIMEOUT': 300,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.environ.get('TOOLHUB_CACHE_DIR', os.path.join(BASE_DIR, 'var', 'cache')),
+            'TIMEOUT': 300,
+            'OPTIONS': {
+                'MAX_ENTRIES': 10000,  # a third of the entries are culled past this
+            },
+        }
+    }
+
+
+# Recommender model artifacts (built with `python manage.py build_recommender`)
+RECOMMENDER_ARTIFACT_DIR = os.path.join(BASE_DIR, 'recommender_artifacts')
+RECOMMENDER_MODEL_VERSION = None  # pin a build on every node; None follows the CURRENT pointer
+SIMILAR_PRODUCTS_TOP_K = 8  # neighbours stored per product in SimilarProduct
+RECOMMENDER_REFIT_DRIFT = 0.05  # unseen terms / vocabulary size before a full refit is scheduled
+RECOMMENDATION_CACHE_TIMEOUT = 15 * 60  # seconds a user's ranked recommendations stay cached
+RECOMMENDER_QUERY_CACHE_SIZE = 4096  # search queries whose nearest products are memoised per process
+RECOMMENDER_FOLLOW_SECONDS = 30  # how often a worker checks CURRENT and patches in other workers' product edits
+RECOMMENDER_REPUBLISH_PATCHES = 20  # patches before the patched model is written as a new build every worker maps
+
+# Nearest-neighbour engine: 'brute' is exact and linear in catalog size,
+# 'lsh' (hardware/ann.py) is approximate and meant for very large catalogs.
+RECOMMENDER_ENGINE = 'brute'
+RECOMMENDER_ENGINE_OPTIONS = {
+    'lsh': {
+        'tables': 8,             # more tables -> higher recall, more candidates to re-rank
+        'bits': None,            # None sizes buckets to ~64 rows; more bits -> lower latency and recall
+        'probes': 1,             # 1 also probes buckets one bit-flip away
+        'max_candidates': 2000,  # rows re-ranked exactly per query
+    },
+}
+
+# Recommender instrumentation (see hardware/metrics.py). Add
+# 'hardware.metrics.LogSink' to log every stage at DEBUG level.
+RECOMMENDER_METRICS_SINKS = ['hardware.metrics.HistogramSink']
+RECOMMENDER_METRICS_SAMPLES = 2048  # recent samples per stage used for p50/p95/p99
+# /metrics/ (Prometheus text format) is served to staff users and to scrapers
+# sending "Authorization: Bearer <METRICS_TOKEN>"; no token, staff only
+METRICS_TOKEN = os.environ.get('TOOLHUB_METRICS_TOKEN', '')
+
+# Product search (see hardware/search.py)
+SEARCH_PAGE_SIZE = 24  # results per page; further pages follow a keyset cursor
+SEARCH_RECOMMENDATION_LIMIT = 8  # products in the "Recommended Products" strip
+SEARCH_CACHE_TIMEOUT = 10 * 60  # seconds a result page stays cached (any catalog write expires it sooner)
+# Searches are written to SearchHistory in the background (see hardware/search_log.py)
+SEARCH_LOG_BATCH_SIZE = 100  # entries per bulk insert
+SEARCH_LOG_FLUSH_MS = 500  # longest an entry waits before it is written
+SEARCH_LOG_MAX_PENDING = 10000  # buffered entries before new ones are dropped
+
+# Search-box suggestions (see hardware/autocomplete.py)
+AUTOCOMPLETE_LIMIT = 8  # suggestions returned per keystroke
+AUTOCOMPLETE_MIN_QUERY_COUNT = 2  # times a query must have been searched to be suggested
+AUTOCOMPLETE_MAX_QUERIES = 1000  # most popular queries kept in the index
+AUTOCOMPLETE_REBUILD_SECONDS = 60 * 60  # full rebuild interval (picks up new popular queries)
+AUTOCOMPLETE_FOLLOW_SECONDS = 30  # how often a worker checks for catalog writes made by the others
+
+# Facet filters on search and category pages (see hardware/facets.py)
+FACET_PRICE_EDGES = [0, 500, 1000, 5000, 20000]  # price buckets (Rs); the last one is open-ended
+
+# Category listing pages (see hardware/listing.py)
+CATEGORY_PAGE_SIZE = 24  # products per page; further pages follow a keyset cursor
+CATEGORY_PAGE_CACHE_TIMEOUT = 10 * 60  # seconds a rendered page stays cached (writes expire it sooner)
+
+# Product card fragment cache (see hardware/templatetags/product_cards.py)
+PRODUCT_CARD_CACHE_TIMEOUT = 24 * 60 * 60  # seconds a rendered card stays cached (a save re-keys it sooner)
+
+# Full-page cache for anonymous visitors (see hardware/page_cache.py)
+PAGE_CACHE_TIMEOUT = 10 * 60  # seconds a cached page lives (writes expire catalog pages sooner)